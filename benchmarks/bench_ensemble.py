@@ -0,0 +1,63 @@
+'''
+Benchmark: ensemble SEIR integration (Model_ensemble) against a Python loop over Model().
+
+Run from the benchmarks directory:
+    python bench_ensemble.py --members 10000 --days 100
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from infection_model import Model, Model_ensemble
+
+
+def sample_members(n_members, seed=42):
+    '''
+    Draws random parameter sets and populations inside the usual fitting bounds.
+    '''
+    rng = np.random.default_rng(seed)
+    return {'N': rng.integers(10_000, 10_000_000, n_members).astype(float),
+            'R_0_start': rng.uniform(2.0, 20.0, n_members),
+            'k': rng.uniform(0.01, 5.0, n_members),
+            'x0': rng.uniform(0, 120, n_members),
+            'R_0_end': rng.uniform(0.3, 8.0, n_members)}
+
+
+def run(n_members, days, n_check=200):
+    members = sample_members(n_members)
+
+    start = time.perf_counter()
+    _, y, R_0_t = Model_ensemble(days, **members)
+    t_ensemble = time.perf_counter() - start
+
+    start = time.perf_counter()
+    max_rel_err = 0.0
+    for i in range(n_members):
+        _, S, E, I, R, R_0 = Model(days, *(members[key][i] for key in 
+                                           ('N', 'R_0_start', 'k', 'x0', 'R_0_end')))
+        if i < n_check:
+            ref = np.stack([S, E, I, R], axis=1)
+            max_rel_err = max(max_rel_err, 
+                              np.max(np.abs(y[i] - ref)) / members['N'][i],
+                              np.max(np.abs(R_0_t[i] - np.asarray(R_0))))
+    t_loop = time.perf_counter() - start
+
+    print(f'members={n_members} days={days}')
+    print(f'  loop over Model(): {t_loop:8.3f} s')
+    print(f'  Model_ensemble():  {t_ensemble:8.3f} s')
+    print(f'  speedup:           {t_loop / t_ensemble:8.1f}x')
+    print(f'  max error (fraction of N) over first {min(n_check, n_members)} members: {max_rel_err:.2e}')
+    return t_loop, t_ensemble, max_rel_err
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--members', type=int, default=10_000)
+    parser.add_argument('--days', type=int, default=100)
+    args = parser.parse_args()
+    run(args.members, args.days)
@@ -0,0 +1,96 @@
+'''
+Benchmark: typed, column-pruned loaders (data_loader.py) against the previous read paths.
+
+Compares, for the COVID Tracking state file (open_merge_files) and the OWID world file,
+the load time and the peak memory allocated while loading (tracemalloc), plus the memory
+held by the resulting frame.
+
+Run from the benchmarks directory:
+    python bench_loader.py --repeat 5
+'''
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from data_loader import DATA_DIR, load_covid_tracking, load_owid
+
+TRACKING_PATH = os.path.join(DATA_DIR, 'us_states_covid19_daily.csv')
+POPULATION_PATH = os.path.join(DATA_DIR, 'us_state_population_2019.csv')
+OWID_PATH = os.path.join(DATA_DIR, 'owid-covid-data.csv')
+
+MERGED_COLUMNS = ['datetime','d_o_y','NAME', 'state', 'POPESTIMATE2019','positiveIncrease', 
+                  'positive', 'negativeIncrease', 'negative', 'pending', 'deathIncrease', 'death', 'recovered', 
+                  'hospitalizedIncrease','hospitalized','totalTestResultsIncrease',
+                  'totalTestResults','posNeg','total']
+
+
+def merge_legacy(df_population):
+    '''
+    The read/merge path open_merge_files used before the typed loader.
+    '''
+    df_usa_rates = pd.read_csv(TRACKING_PATH)
+    df_usa_rates['datetime'] = pd.to_datetime(df_usa_rates['date'].astype(str), format='%Y%m%d')
+    df_usa_rates['d_o_y'] = pd.DatetimeIndex(df_usa_rates['datetime']).dayofyear
+    return pd.merge(df_usa_rates, df_population, how='outer', left_on='state', right_on='ABBR',
+                    sort=True)[MERGED_COLUMNS]
+
+
+def merge_typed(df_population):
+    '''
+    The read/merge path of the current open_merge_files.
+    '''
+    df_usa_rates = load_covid_tracking(TRACKING_PATH)
+    return pd.merge(df_usa_rates, df_population[['ABBR', 'NAME', 'POPESTIMATE2019']], how='outer', 
+                    left_on='state', right_on='ABBR', sort=True)[MERGED_COLUMNS]
+
+
+def measure(func, repeat):
+    '''
+    Returns (best wall time, peak traced memory, memory of the result) for a loader.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    df = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak, df.memory_usage(deep=True).sum()
+
+
+def report(name, legacy, typed):
+    print(f'{name}')
+    print(f'  {"":8} {"time (ms)":>10} {"peak (MB)":>10} {"frame (MB)":>11}')
+    for label, (t, peak, size) in (('legacy', legacy), ('typed', typed)):
+        print(f'  {label:8} {t * 1000:10.1f} {peak / 1e6:10.2f} {size / 1e6:11.2f}')
+    print(f'  speedup {legacy[0] / typed[0]:.1f}x, peak memory reduction {legacy[1] / typed[1]:.1f}x, '
+          f'frame size reduction {legacy[2] / typed[2]:.1f}x')
+
+
+def run(repeat, chunksize):
+    df_population = pd.read_csv(POPULATION_PATH)
+    report('COVID Tracking states + population (open_merge_files)', 
+           measure(lambda: merge_legacy(df_population), repeat), 
+           measure(lambda: merge_typed(df_population), repeat))
+    report('OWID world data', 
+           measure(lambda: pd.read_csv(OWID_PATH, parse_dates=['date']), repeat), 
+           measure(lambda: load_owid(OWID_PATH), repeat))
+    report(f'OWID world data, streamed in chunks of {chunksize} rows', 
+           measure(lambda: pd.read_csv(OWID_PATH, parse_dates=['date']), repeat), 
+           measure(lambda: load_owid(OWID_PATH, chunksize=chunksize), repeat))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--chunksize', type=int, default=4000)
+    args = parser.parse_args()
+    run(args.repeat, args.chunksize)
@@ -0,0 +1,104 @@
+'''
+Benchmark: SEIR fit with the exact sensitivity-equation Jacobian (fit_seir_sensitivity)
+against the lmfit finite-difference path (fit_seir_result).
+
+Fits synthetic infection curves generated by Model() from known parameters, and reports 
+RHS evaluations of the SEIR equations and wall-clock time per fit.  For the sensitivity 
+path each RHS evaluation covers the state and all four sensitivities.  The finite-difference
+path is timed twice: as it runs now (Model passes the analytic deriv_seir_jac to odeint) and
+as the original baseline, with odeint estimating the ODE Jacobian itself (no Dfun).
+
+Run from the benchmarks directory:
+    python bench_sensitivity.py --fits 5
+'''
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import infection_model
+from infection_model import Model, fit_seir_result, summarize_fit, fit_seir_sensitivity
+from fit_regions import DEFAULT_PARAMS_INIT_MIN_MAX
+
+
+@contextlib.contextmanager
+def without_ode_jacobian():
+    '''
+    Makes Model() call odeint without Dfun (the original integration path) while active.
+    '''
+    original = infection_model.deriv_seir_jac
+    infection_model.deriv_seir_jac = None
+    try:
+        yield
+    finally:
+        infection_model.deriv_seir_jac = original
+
+
+def synthetic_series(n_fits, days=40, N=1_000_000, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(n_fits):
+        params = (rng.uniform(3, 6), rng.uniform(0.2, 1.5), rng.uniform(15, 30), rng.uniform(0.5, 1.2))
+        I = Model(days, N, *params)[3]
+        yield N, params, I * rng.normal(1, 0.05, days)
+
+
+def count_rhs_finite_difference(infect_data, N, ode_jacobian = True):
+    '''
+    Runs the finite-difference fit while counting deriv_seir calls; without ode_jacobian,
+        on the original integration path (see without_ode_jacobian).
+    '''
+    original = infection_model.deriv_seir
+    calls = [0]
+
+    def counted(*args):
+        calls[0] += 1
+        return original(*args)
+
+    infection_model.deriv_seir = counted
+    try:
+        with contextlib.nullcontext() if ode_jacobian else without_ode_jacobian():
+            summary = summarize_fit(fit_seir_result(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX))
+    finally:
+        infection_model.deriv_seir = original
+    return summary, calls[0]
+
+
+def run(n_fits):
+    totals = {f'{path}_{stat}': 0 for path in ('base', 'fd', 'sens') for stat in ('rhs', 'time')}
+    # Untimed fit, so the first timed path does not pay for imports and first-call setup
+    N, _, infect_data = next(synthetic_series(1, seed=1))
+    count_rhs_finite_difference(infect_data, N)
+    for N, params, infect_data in synthetic_series(n_fits):
+        for path, ode_jacobian in (('base', False), ('fd', True)):
+            start = time.perf_counter()
+            fd, fd_rhs = count_rhs_finite_difference(infect_data, N, ode_jacobian)
+            totals[f'{path}_time'] += time.perf_counter() - start
+            totals[f'{path}_rhs'] += fd_rhs
+
+        start = time.perf_counter()
+        sens = fit_seir_sensitivity(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX)
+        totals['sens_time'] += time.perf_counter() - start
+        totals['sens_rhs'] += sens['n_rhs']
+
+        print(f'true={np.round(params, 3)}  fd rmse={fd["rmse"]:.2f} nfev={fd["nfev"]}  '
+              f'sensitivity rmse={sens["rmse"]:.2f} nfev={sens["nfev"]}')
+
+    print(f'per fit, averaged over {n_fits} fits:')
+    for path, label in (('base', 'baseline (no Dfun)'), ('fd', 'finite difference'), ('sens', 'sensitivity')):
+        print(f'  {label + ":":20} {totals[f"{path}_rhs"] / n_fits:9.0f} RHS evals  '
+              f'{totals[f"{path}_time"] / n_fits:7.3f} s')
+    print(f'  reduction vs baseline: {totals["base_rhs"] / totals["sens_rhs"]:5.1f}x            '
+          f'{totals["base_time"] / totals["sens_time"]:7.1f}x')
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fits', type=int, default=5)
+    args = parser.parse_args()
+    run(args.fits)
@@ -0,0 +1,123 @@
+'''
+Cold-start benchmark of the command-line entry point (src/cli.py).
+
+Every command is timed as a fresh interpreter process, the way it is run from a shell,
+against the offline fixtures of run_benchmarks.py (passed to the subprocesses through
+the COVID_* environment variables, with the download cache filled by one untimed run).
+For each command the best and median wall time over --repeat runs are reported, along
+with the heavy modeling packages it imported (from python -X importtime).  The data
+commands (--help, ingest, features) are expected to start in under TARGET_S seconds:
+
+    python bench_startup.py
+    python bench_startup.py --repeat 10
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CLI_PATH = os.path.join(BENCH_DIR, '..', 'src', 'cli.py')
+
+# Packages that only the modeling and plotting commands should import
+HEAVY_MODULES = ('scipy', 'matplotlib', 'lmfit', 'statsmodels', 'pymc3', 'theano', 'arviz')
+
+# Data commands that must start in under this many seconds
+TARGET_S = 1.0
+
+
+def startup_commands(out_dir):
+    '''
+    Returns {name: (argv, target seconds or None)} of the commands timed.
+    '''
+    python = [sys.executable]
+    return {'cli --help': (python + [CLI_PATH, '--help'], TARGET_S),
+            'cli ingest': (python + [CLI_PATH, 'ingest', '--level', 'state'], TARGET_S),
+            'cli features': (python + [CLI_PATH, 'features', '--level', 'state',
+                                       '--out', os.path.join(out_dir, 'features.parquet')], TARGET_S),
+            'import infection_model': (python + ['-c', 'import infection_model'], None),
+            'cli forecast': (python + [CLI_PATH, 'forecast', 'New York', '--horizon', '60',
+                                       '--out', os.path.join(out_dir, 'forecast.csv')], None)}
+
+
+def fixture_env(fixtures):
+    '''
+    Environment pointing the subprocesses at the fixtures built by run_benchmarks.build_fixtures.
+    '''
+    fixture_dir = os.path.dirname(fixtures['paths']['states'])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(CLI_PATH),
+                                                                        os.environ.get('PYTHONPATH')])),
+               COVID_NYT_STATES_URL='file://' + os.path.abspath(fixtures['paths']['states']),
+               COVID_NYT_COUNTIES_URL='file://' + os.path.abspath(fixtures['paths']['counties']),
+               COVID_CENSUS_URL='file://' + os.path.abspath(fixtures['paths']['census']),
+               COVID_CACHE_DIR=os.path.join(fixture_dir, 'cache'),
+               COVID_IMAGES_DIR=fixture_dir, MPLBACKEND='Agg')
+    env.pop('COVID_PROFILE', None)
+    return env
+
+
+def run_command(argv, env):
+    '''
+    Runs a command once and returns its wall time in seconds.
+    '''
+    start = time.perf_counter()
+    subprocess.run(argv, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def heavy_imports(argv, env):
+    '''
+    Returns the heavy packages (HEAVY_MODULES) a command imports.
+    '''
+    result = subprocess.run(argv[:1] + ['-X', 'importtime'] + argv[1:], env=env, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            package = line.rsplit('|', 1)[1].strip().split('.')[0]
+            if package in HEAVY_MODULES:
+                loaded.add(package)
+    return sorted(loaded)
+
+
+def run_startup(fixtures, repeat = 5):
+    '''
+    Times every startup command; returns {name: {'best_s', 'median_s', 'heavy', 'target_s', 'ok'}}.
+    '''
+    env = fixture_env(fixtures)
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        for name, (argv, target) in startup_commands(out_dir).items():
+            # Untimed run: fills the download cache and warms the file system cache
+            run_command(argv, env)
+            times = [run_command(argv, env) for _ in range(repeat)]
+            best = min(times)
+            results[name] = {'best_s': best, 'median_s': statistics.median(times),
+                             'heavy': heavy_imports(argv, env), 'target_s': target,
+                             'ok': target is None or best < target}
+    return results
+
+
+def print_results(results):
+    for name, result in results.items():
+        target = '' if result['target_s'] is None else (
+            f"{'ok  ' if result['ok'] else 'SLOW'} (< {result['target_s']:.1f} s)")
+        heavy = ', '.join(result['heavy']) or '-'
+        print(f"{name:25} best {result['best_s'] * 1000:7.0f} ms  median {result['median_s'] * 1000:7.0f} ms  "
+              f"{target:14} heavy imports: {heavy}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    sys.path.insert(0, BENCH_DIR)
+    from run_benchmarks import build_fixtures
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        results = run_startup(build_fixtures(fixture_dir), args.repeat)
+    print_results(results)
+    sys.exit(0 if all(result['ok'] for result in results.values()) else 1)
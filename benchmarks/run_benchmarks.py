@@ -0,0 +1,333 @@
+'''
+Benchmark suite for the forecasting pipeline: ingest, features, ODE integration, fitting 
+and rendering.
+
+Runs offline: the NYT/census downloads are replaced by fixture files derived from data/
+(state series from the COVID Tracking file, synthetic counties split from them), served 
+through file:// URLs and a temporary data cache.  Each stage is timed separately (best of
+--repeat runs) and its peak traced memory is measured in one extra run.  Scaling curves 
+cover the number of regions, number of days, ensemble size and fit restarts.
+
+Results are appended as one JSON line per run to a history file (default 
+benchmarks/history.jsonl) with the git commit, so runs can be compared across commits:
+
+    python run_benchmarks.py                 # run everything, append to the history
+    python run_benchmarks.py --filter ode    # only benchmarks whose name contains 'ode'
+    python run_benchmarks.py --quick         # smaller scaling curves
+    python run_benchmarks.py --compare       # compare the last two runs in the history
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'src'))
+
+import data_cache
+import infection_model
+from data_loader import load_covid_tracking, load_owid, load_state_population
+from features import add_region_features
+from fit_regions import DEFAULT_PARAMS_INIT_MIN_MAX
+
+HISTORY_PATH = os.path.join(BENCH_DIR, 'history.jsonl')
+
+# name -> (function(fixtures, **params) returning the callable to time, {param: [values]})
+BENCHMARKS = {}
+
+
+def benchmark(name, **scaling):
+    '''
+    Registers a benchmark.  Keyword arguments give the values of a scaling parameter;
+        the benchmark is then run once per value.
+    '''
+    def register(func):
+        BENCHMARKS[name] = (func, scaling)
+        return func
+    return register
+
+
+# Fixtures
+def build_fixtures(fixture_dir, counties_per_state = 20):
+    '''
+    Writes NYT-style state and county files and a census-style population file derived from
+        data/, and points infection_model at them through file:// URLs.
+    '''
+    tracking = load_covid_tracking()
+    population = load_state_population()
+    abbr_to_name = dict(zip(population['ABBR'], population['NAME']))
+    states = pd.DataFrame({'date': tracking['datetime'], 
+                           'state': tracking['state'].astype(str).map(abbr_to_name),
+                           'fips': tracking['state'].cat.codes.astype(int),
+                           'cases': tracking['positive'].fillna(0).astype(int),
+                           'deaths': tracking['death'].fillna(0).astype(int)}).dropna(subset=['state'])
+    states = states.sort_values(['date', 'state'])
+
+    # Split every state into counties with random, fixed shares of its cases and population
+    rng = np.random.default_rng(0)
+    county_frames, census_rows = [], []
+    for name, pop in zip(population['NAME'], population['POPESTIMATE2019']):
+        census_rows.append((name, name, pop))
+        df_state = states[states['state'] == name]
+        shares = rng.dirichlet(np.ones(counties_per_state))
+        for i, share in enumerate(shares):
+            county = f'County{i:03d}'
+            df_county = df_state.assign(county=county, cases=(df_state['cases'] * share).astype(int),
+                                        deaths=(df_state['deaths'] * share).astype(int))
+            county_frames.append(df_county)
+            census_rows.append((name, f'{county} County', int(pop * share)))
+    counties = pd.concat(county_frames)[['date', 'county', 'state', 'fips', 'cases', 'deaths']]
+    census = pd.DataFrame(census_rows, columns=['STNAME', 'CTYNAME', 'POPESTIMATE2019'])
+
+    paths = {}
+    for key, df in (('states', states), ('counties', counties.sort_values(['date', 'state', 'county'])), 
+                    ('census', census)):
+        paths[key] = os.path.join(fixture_dir, f'{key}.csv')
+        df.to_csv(paths[key], index=False)
+
+    infection_model.NYT_STATES_URL = 'file://' + os.path.abspath(paths['states'])
+    infection_model.NYT_COUNTIES_URL = 'file://' + os.path.abspath(paths['counties'])
+    infection_model.CENSUS_COUNTIES_URL = 'file://' + os.path.abspath(paths['census'])
+    data_cache.CACHE_DIR = os.path.join(fixture_dir, 'cache')
+
+    state_regions = [(name, '') for name in states['state'].unique()]
+    county_regions = list(counties[['state', 'county']].drop_duplicates().itertuples(index=False, name=None))
+    return {'paths': paths, 'states': state_regions, 'counties': county_regions, 'counties_frame': counties}
+
+
+def _cold_cache():
+    data_cache.clear_memory_cache()
+    for sub in ('parsed', 'blobs'):
+        path = os.path.join(data_cache.CACHE_DIR, sub)
+        for name in os.listdir(path) if os.path.isdir(path) else []:
+            os.remove(os.path.join(path, name))
+    if os.path.exists(os.path.join(data_cache.CACHE_DIR, 'index.json')):
+        os.remove(os.path.join(data_cache.CACHE_DIR, 'index.json'))
+
+
+# Ingest
+@benchmark('ingest.region_cold')
+def bench_region_cold(fixtures):
+    def run():
+        _cold_cache()
+        infection_model.get_state_or_county_data(fixtures['counties'][0])
+    return run
+
+
+@benchmark('ingest.regions_warm', n_regions=[10, 100, 1000])
+def bench_regions_warm(fixtures, n_regions):
+    regions = (fixtures['counties'] * (n_regions // len(fixtures['counties']) + 1))[:n_regions]
+    infection_model.get_state_or_county_data(regions[0])
+    return lambda: [infection_model.get_state_or_county_data(region) for region in regions]
+
+
+@benchmark('ingest.regions_mapped', n_regions=[10, 100, 1000])
+def bench_regions_mapped(fixtures, n_regions):
+    regions = (fixtures['counties'] * (n_regions // len(fixtures['counties']) + 1))[:n_regions]
+    store_path = os.path.join(os.path.dirname(fixtures['paths']['states']), 'series_store')
+    infection_model.export_region_series('county', store_path)
+    return lambda: [infection_model.get_region_series_mapped(region, 7, store_path) for region in regions]
+
+
+@benchmark('ingest.covid_tracking')
+def bench_covid_tracking(fixtures):
+    return lambda: load_covid_tracking()
+
+
+@benchmark('ingest.owid')
+def bench_owid(fixtures):
+    return lambda: load_owid()
+
+
+# Features
+@benchmark('features.counties_all')
+def bench_features(fixtures):
+    counties = fixtures['counties_frame']
+    return lambda: add_region_features(counties, ('state', 'county'), 'date', 
+                                       diff_cols={'cases': 'daily_cases', 'deaths': 'daily_deaths'},
+                                       smooth_cols=['daily_cases'], windows=(7, 14))
+
+
+# ODE integration
+@benchmark('ode.model', days=[50, 100, 200, 400])
+def bench_model(fixtures, days):
+    return lambda: infection_model.Model(days, 1e6, 4.0, 0.5, 60, 0.8)
+
+
+@benchmark('ode.ensemble', members=[100, 1000, 10000])
+def bench_ensemble(fixtures, members):
+    rng = np.random.default_rng(0)
+    params = dict(N=rng.uniform(1e4, 1e7, members), R_0_start=rng.uniform(2, 20, members), 
+                  k=rng.uniform(0.01, 5, members), x0=rng.uniform(0, 120, members), 
+                  R_0_end=rng.uniform(0.3, 8, members))
+    return lambda: infection_model.Model_ensemble(100, **params)
+
+
+# Fitting
+def _synthetic_infections(days = 40, N = 1e6):
+    I = infection_model.Model(days, N, 4.5, 0.6, 20, 0.8)[3]
+    return I * np.random.default_rng(0).normal(1, 0.05, days), N
+
+
+@benchmark('fit.baseline')
+def bench_fit_baseline(fixtures):
+    # The original path: finite differences, with odeint estimating the ODE Jacobian (no Dfun)
+    from bench_sensitivity import without_ode_jacobian
+    infect_data, N = _synthetic_infections()
+
+    def fit():
+        with without_ode_jacobian():
+            return infection_model.fit_seir(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX)
+    return fit
+
+
+@benchmark('fit.finite_difference')
+def bench_fit_fd(fixtures):
+    # Finite differences over the parameters; Model passes deriv_seir_jac to odeint
+    infect_data, N = _synthetic_infections()
+    return lambda: infection_model.fit_seir(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX)
+
+
+@benchmark('fit.sensitivity')
+def bench_fit_sensitivity(fixtures):
+    infect_data, N = _synthetic_infections()
+    return lambda: infection_model.fit_seir(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX, jacobian='sensitivity')
+
+
+@benchmark('fit.restarts', restarts=[1, 4, 16])
+def bench_fit_restarts(fixtures, restarts):
+    infect_data, N = _synthetic_infections()
+    rng = np.random.default_rng(0)
+    starts = []
+    for _ in range(restarts):
+        starts.append({name: (rng.uniform(mini, maxi), mini, maxi) 
+                       for name, (_, mini, maxi) in DEFAULT_PARAMS_INIT_MIN_MAX.items()})
+    return lambda: [infection_model.fit_seir(infect_data, N, params, jacobian='sensitivity') for params in starts]
+
+
+@benchmark('fit.multistart', restarts=[4, 16])
+def bench_fit_multistart(fixtures, restarts):
+    from multistart import multistart_fit
+    infect_data, N = _synthetic_infections()
+    return lambda: multistart_fit(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX, n_starts=restarts, seed=0)
+
+
+# Rendering
+@benchmark('render.region_charts', n_regions=[1, 10])
+def bench_render(fixtures, n_regions):
+    from render_batch import region_infection_spec, render_specs
+    specs = []
+    for region in fixtures['states'][:n_regions]:
+        df, pop, date_range = infection_model.get_state_or_county_data(region)
+        specs.append(region_infection_spec(df, pop, date_range, region))
+    out_dir = os.path.join(os.path.dirname(fixtures['paths']['states']), 'images')
+    return lambda: render_specs(specs, out_dir, max_workers=1)
+
+
+# Startup (fresh interpreter per run, see bench_startup.py)
+@benchmark('startup.cli', command=['cli --help', 'cli ingest', 'cli features', 'import infection_model'])
+def bench_startup(fixtures, command):
+    from bench_startup import startup_commands, fixture_env, run_command
+    argv, _ = startup_commands(os.path.dirname(fixtures['paths']['states']))[command]
+    env = fixture_env(fixtures)
+    return lambda: run_command(argv, env)
+
+
+def measure(make_run, repeat):
+    '''
+    Returns the best wall time over `repeat` runs and the peak traced memory of one more run.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        make_run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    make_run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def run_suite(name_filter = '', repeat = 3, quick = False):
+    results = {}
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        fixtures = build_fixtures(fixture_dir)
+        for name, (func, scaling) in BENCHMARKS.items():
+            if name_filter not in name:
+                continue
+            (param, values), = scaling.items() if scaling else ((None, [None]),)
+            if quick and param is not None:
+                values = values[:2]
+            for value in values:
+                key = name if param is None else f'{name}[{param}={value}]'
+                run = func(fixtures) if param is None else func(fixtures, **{param: value})
+                wall_time, peak = measure(run, repeat)
+                results[key] = {'time_s': wall_time, 'peak_mb': peak / 1e6}
+                print(f'{key:45} {wall_time * 1000:10.2f} ms {peak / 1e6:9.2f} MB', flush=True)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, 
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def append_history(results, path = HISTORY_PATH):
+    record = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(),
+              'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+              'machine': platform.machine(), 'cpus': os.cpu_count(), 'results': results}
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def compare(path = HISTORY_PATH, threshold = 0.10):
+    '''
+    Prints the change of every benchmark between the last two runs in the history, flagging
+        slowdowns and memory growth larger than threshold.
+    '''
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if len(records) < 2:
+        print('Need at least two runs in the history to compare')
+        return
+    old, new = records[-2], records[-1]
+    print(f"{old['commit']} ({old['timestamp']}) -> {new['commit']} ({new['timestamp']})")
+    for key, result in new['results'].items():
+        if key not in old['results']:
+            continue
+        before = old['results'][key]
+        time_ratio = result['time_s'] / before['time_s']
+        mem_ratio = result['peak_mb'] / before['peak_mb'] if before['peak_mb'] else 1.0
+        flag = ' REGRESSION' if time_ratio > 1 + threshold or mem_ratio > 1 + threshold else ''
+        print(f'{key:45} time x{time_ratio:5.2f}  memory x{mem_ratio:5.2f}{flag}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='only the first two points of each scaling curve')
+    parser.add_argument('--history', default=HISTORY_PATH)
+    parser.add_argument('--no-history', action='store_true', help='do not append the results to the history')
+    parser.add_argument('--compare', action='store_true', help='compare the last two runs in the history and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.history)
+    else:
+        results = run_suite(args.filter, args.repeat, args.quick)
+        if not args.no_history:
+            append_history(results, args.history)
@@ -0,0 +1,257 @@
+'''
+Rolling-origin backtesting of the SEIR forecasts.
+
+For every region, forecast origins (cutoff dates) are walked forward over the history
+every `step` days.  At each origin the model is fitted to the data known at the cutoff
+only (the centered rolling mean of the truncated series, without its incomplete trailing
+windows), warm-started from the previous origin's fit, and the modelled daily infections
+are kept for `max_horizon` days past the cutoff.  The forecasts are compared with the
+smoothed series observed since: MAE and MAPE per horizon, and the error of the date the
+series falls below the reopen threshold.
+
+Fits and forecasts are cached per region and cutoff in a directory, together with a
+signature of the data they were fitted to, so a rerun only fits new origins (e.g. after
+one day is appended) and origins whose data was revised upstream.  Regions are scheduled
+on a process pool; a region's origins run in order in one worker so each can start from
+the previous fit.
+'''
+import math
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from infection_model import get_region_series, Model, fit_seir, PARAM_NAMES
+from incremental import warm_start_params, data_signature
+from fit_regions import DEFAULT_PARAMS_INIT_MIN_MAX
+from bootstrap import reopen_crossing_day
+from features import REOPEN_THRESH
+from data_cache import RegionPickleCache
+import data_loader
+
+
+def centered_mean(daily, num_days):
+    '''
+    Centered rolling mean of a daily series, without the trailing days whose window is
+        incomplete (they are not known yet at the end of the series).
+    '''
+    rolled = pd.Series(daily).rolling(window=num_days, center = True).mean().to_numpy()
+    return rolled[:len(rolled) - (num_days - num_days // 2 - 1)]
+
+
+def _origin_worker(region, daily, N, cutoffs, best_values, num_days_smooth, max_horizon, params_init_min_max,
+                   jacobian):
+    '''
+    Fits one region at each cutoff in order, each warm-started from the previous fit.
+
+    INPUT:
+        - daily: the region's daily infections (full history)
+        - cutoffs: increasing day indices; the fit at cutoff c uses daily[:c]
+        - best_values: (Optional) fit of the origin before the first cutoff
+    OUTPUT:
+        - list of dicts with 'cutoff', 'best_values', 'trajectory' (modelled daily infections
+            from the first day to max_horizon days past the cutoff), 'nfev', 'wall_time' and 'error'
+    '''
+    results = []
+    for cutoff in cutoffs:
+        start = time.perf_counter()
+        infect_data = np.nan_to_num(centered_mean(daily[:cutoff], num_days_smooth))
+        try:
+            summary = fit_seir(infect_data, N, warm_start_params(params_init_min_max, best_values),
+                               jacobian=jacobian)
+            values = [summary['best_values'][name] for name in PARAM_NAMES]
+            I = Model(cutoff + max_horizon, N, *values)[3]
+            best_values = summary['best_values']
+            results.append({'cutoff': cutoff, 'best_values': best_values, 'trajectory': I.astype(np.float32),
+                            'nfev': summary['nfev'], 'wall_time': time.perf_counter() - start, 'error': ''})
+        except Exception:
+            results.append({'cutoff': cutoff, 'best_values': None, 'trajectory': None, 'nfev': 0,
+                            'wall_time': time.perf_counter() - start, 'error': traceback.format_exc(limit=3)})
+    return results
+
+
+class Backtester:
+    '''
+    Rolling-origin backtests of many regions, with fits cached per (region, cutoff date).
+
+    INPUT:
+        - cache_dir: directory holding one pickle of fitted origins per region
+        - num_days_smooth: days of the centered rolling mean that is fitted and scored
+        - min_train_days: days of data before the first origin
+        - step: days between origins
+        - max_horizon: days forecast past each origin
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)}; the
+            guesses are only used for a region's first origin
+        - jacobian: passed to fit_seir
+        - reopen_thresh: daily cases per person below which a region may reopen
+    '''
+    def __init__(self, cache_dir, num_days_smooth = 7, min_train_days = 30, step = 7, max_horizon = 28,
+                 params_init_min_max = None, jacobian = 'sensitivity', reopen_thresh = REOPEN_THRESH):
+        self.cache_dir = cache_dir
+        self.num_days_smooth = num_days_smooth
+        self.min_train_days = min_train_days
+        self.step = step
+        self.max_horizon = max_horizon
+        self.params_init_min_max = DEFAULT_PARAMS_INIT_MIN_MAX if params_init_min_max is None else params_init_min_max
+        self.jacobian = jacobian
+        self.reopen_thresh = reopen_thresh
+        # Cached origins are only reused by a backtester with the same settings
+        self.cache = RegionPickleCache(cache_dir, repr((num_days_smooth, max_horizon, 
+                                                        sorted(self.params_init_min_max.items()), jacobian)))
+
+    def region_inputs(self, region):
+        '''
+        Returns the region's dates, daily infections, population and cutoff indices.
+        '''
+        df_raw, N, _ = get_region_series(region)
+        dates = pd.DatetimeIndex(df_raw['date'])
+        cases = df_raw['cases'].to_numpy(dtype=float)
+        daily = np.nan_to_num(np.diff(cases, prepend=np.nan))
+        cutoffs = np.arange(self.min_train_days, len(daily) + 1, self.step)
+        return dates, daily, float(N), cutoffs
+
+    def run(self, regions, max_workers = None):
+        '''
+        Backtests every region, fitting only the origins missing from (or stale in) the cache.
+
+        INPUT:
+            - regions: list of ('State', 'County') tuples
+            - max_workers: worker processes (default: os.cpu_count())
+        OUTPUT:
+            - df_errors: one row per region, origin and horizon with the forecast, the
+                observed smoothed value (NaN until it is observed) and the errors
+            - df_metrics: MAE, MAPE (%, over nonzero observations) and count per horizon
+            - df_crossing: one row per region and origin with the forecast and observed
+                reopen-threshold crossing dates and the error in days
+            - df_runs: one row per region with the number of origins fitted, reused and
+                failed; regions whose worker failed are not scored
+        '''
+        inputs, cached, runs, jobs = {}, {}, [], {}
+        for region in regions:
+            try:
+                dates, daily, N, cutoffs = inputs[region] = self.region_inputs(region)
+            except Exception:
+                runs.append({'state': region[0], 'county': region[1], 'status': 'failed',
+                             'error': traceback.format_exc(limit=3)})
+                continue
+            origins = cached[region] = self.cache.load(region) or {}
+            todo, best_values = [], None
+            for cutoff in cutoffs:
+                key = dates[cutoff - 1].strftime('%Y-%m-%d')
+                origin = origins.get(key)
+                # Failed fits are retried on the next run, like revised data
+                fresh = (origin is not None and not origin['error'] and 
+                         origin['signature'] == data_signature(daily[:cutoff], np.array([N])))
+                if fresh and not todo:
+                    best_values = origin['best_values'] or best_values
+                elif not fresh:
+                    todo.append(cutoff)
+            if todo:
+                jobs[region] = (todo, best_values)
+            else:
+                runs.append({'state': region[0], 'county': region[1], 'status': 'ok',
+                             'n_fitted': 0, 'n_cached': len(cutoffs), 'n_failed': 0, 'wall_time': 0.})
+
+        # Worker processes are only started when some origin needs fitting
+        if jobs:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                futures = {pool.submit(_origin_worker, region, inputs[region][1], inputs[region][2], todo, 
+                                       best_values, self.num_days_smooth, self.max_horizon, 
+                                       self.params_init_min_max, self.jacobian): region
+                           for region, (todo, best_values) in jobs.items()}
+                runs.extend(self._collect(futures, inputs, cached))
+
+        df_errors, df_crossing = self.score(inputs, cached)
+        return df_errors, self.metrics(df_errors), df_crossing, pd.DataFrame(runs)
+
+    def _collect(self, futures, inputs, cached):
+        '''
+        Stores the origins fitted by the workers as they finish; returns the run rows.
+        '''
+        runs = []
+        for future in as_completed(futures):
+            region = futures[future]
+            dates, daily, N, cutoffs = inputs[region]
+            origins = cached[region]
+            try:
+                results = future.result()
+            except Exception:
+                # The region's cached origins may be stale (that is why it was refitting),
+                # so none of them are scored
+                del inputs[region]
+                runs.append({'state': region[0], 'county': region[1], 'status': 'failed',
+                             'error': traceback.format_exc(limit=3)})
+                continue
+            for result in results:
+                cutoff = result['cutoff']
+                origins[dates[cutoff - 1].strftime('%Y-%m-%d')] = {
+                    **result, 'signature': data_signature(daily[:cutoff], np.array([N]))}
+            self.cache.save(region, origins)
+            runs.append({'state': region[0], 'county': region[1], 'status': 'ok',
+                         'n_fitted': len(results), 'n_cached': len(cutoffs) - len(results),
+                         'n_failed': sum(bool(result['error']) for result in results),
+                         'wall_time': sum(result['wall_time'] for result in results)})
+        return runs
+
+    def score(self, inputs, cached):
+        '''
+        Compares every cached forecast with the series observed since its origin.
+        '''
+        error_frames, crossing_rows = [], []
+        horizons = np.arange(1, self.max_horizon + 1)
+        for region, (dates, daily, N, cutoffs) in inputs.items():
+            observed = centered_mean(daily, self.num_days_smooth)
+            threshold = math.ceil(N * self.reopen_thresh)
+            observed_crossing = reopen_crossing_day(np.nan_to_num(observed), threshold)
+            for cutoff in cutoffs:
+                cutoff_date = dates[cutoff - 1]
+                origin = cached[region].get(cutoff_date.strftime('%Y-%m-%d'))
+                if origin is None or origin['trajectory'] is None:
+                    continue
+                trajectory = origin['trajectory'].astype(float)
+                forecast = trajectory[cutoff:]
+                days = cutoff + horizons - 1
+                actual = np.full(len(horizons), np.nan)
+                known = days < len(observed)
+                actual[known] = observed[days[known]]
+                error_frames.append(pd.DataFrame({'state': region[0], 'county': region[1], 'cutoff': cutoff_date,
+                                                  'horizon': horizons, 'forecast': forecast, 'actual': actual}))
+                forecast_crossing = reopen_crossing_day(trajectory, threshold)
+                crossing_rows.append({'state': region[0], 'county': region[1], 'cutoff': cutoff_date,
+                                      'threshold': threshold,
+                                      'forecast_crossing': self._day_to_date(dates, forecast_crossing),
+                                      'observed_crossing': self._day_to_date(dates, observed_crossing),
+                                      'crossing_error_days': forecast_crossing - observed_crossing})
+        df_errors = pd.concat(error_frames, ignore_index=True) if error_frames else pd.DataFrame(
+            columns=['state', 'county', 'cutoff', 'horizon', 'forecast', 'actual'])
+        df_errors['abs_error'] = (df_errors['forecast'] - df_errors['actual']).abs()
+        df_errors['ape'] = df_errors['abs_error'] / df_errors['actual'].where(df_errors['actual'] > 0) * 100
+        return df_errors, pd.DataFrame(crossing_rows)
+
+    @staticmethod
+    def _day_to_date(dates, day):
+        return pd.NaT if np.isnan(day) else dates[0] + pd.Timedelta(days=int(day))
+
+    @staticmethod
+    def metrics(df_errors):
+        '''
+        MAE, MAPE and number of scored forecasts per horizon.
+        '''
+        scored = df_errors.dropna(subset=['actual'])
+        return scored.groupby('horizon').agg(mae=('abs_error', 'mean'), mape=('ape', 'mean'),
+                                             n=('abs_error', 'size')).reset_index()
+
+
+if __name__ == "__main__":
+    backtester = Backtester(os.path.join(data_loader.DATA_DIR, 'backtest_cache'))
+    regions = data_loader.all_states()
+
+    start = time.perf_counter()
+    df_errors, df_metrics, df_crossing, df_runs = backtester.run(regions)
+    print(df_metrics.to_string(index=False))
+    print(df_crossing['crossing_error_days'].abs().describe())
+    print(f"{df_runs['n_fitted'].sum()} origins fitted, {df_runs['n_cached'].sum()} reused "
+          f"in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,202 @@
+'''
+Bayesian SEIR fitting with PyMC3, compiled once and reused across regions.
+
+The model graph is built and its theano functions compiled a single time for a given 
+number of days.  The observed series and the population are held in shared data 
+containers (pm.Data), so fitting another region only swaps their values (pm.set_data); 
+the compiled NUTS step, ADVI step function and posterior sampler are reused.
+
+Compartments are modelled as fractions of the population: the initial exposed fraction
+is 1/N, and the likelihood compares the infected fraction I(t)/N with the smoothed daily 
+infections divided by N, as fit_seir does on the count scale.
+'''
+import time
+
+import numpy as np
+import pymc3 as pm
+import theano.tensor as tt
+from pymc3.ode import DifferentialEquation
+
+from infection_model import gamma as GAMMA, delta as DELTA, PARAM_NAMES
+from fit_regions import DEFAULT_PARAMS_INIT_MIN_MAX
+
+
+def seir_fraction_rhs(y, t, p, gamma = GAMMA, delta = DELTA):
+    '''
+    SEIR rates on population fractions with the logistic R_0 of logistic_R_0, written 
+        with theano operations for pymc3's DifferentialEquation.
+    
+    INPUT:
+        - y: (s, e, i, r) fractions
+        - t: the time at which the rates will be calculated
+        - p: (R_0_start, k, x0, R_0_end)
+    OUTPUT: 
+        - [ds/dt, de/dt, di/dt, dr/dt]
+    '''
+    R_0_t = (p[0] - p[3]) / (1 + tt.exp(-p[1] * (p[2] - t))) + p[3]
+    new_exposed = R_0_t * gamma * y[0] * y[2]
+    return [-new_exposed, 
+            new_exposed - delta * y[1], 
+            delta * y[1] - gamma * y[2], 
+            gamma * y[2]]
+
+
+class BayesianSEIR:
+    '''
+    SEIR model graph compiled once for a fixed number of days and fitted region by region.
+    
+    INPUT:
+        - n_days: length of the fitted series (day 0 is the initial condition)
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)}; the
+            bounds define uniform priors, the guesses the starting point
+        - sigma_scale: scale of the half-normal prior on the observation noise, as a 
+            fraction of the population
+    '''
+    def __init__(self, n_days, params_init_min_max = None, sigma_scale = 1e-4):
+        start = time.perf_counter()
+        params_init_min_max = DEFAULT_PARAMS_INIT_MIN_MAX if params_init_min_max is None else params_init_min_max
+        self.n_days = n_days
+        self.ode = DifferentialEquation(func=seir_fraction_rhs, times=np.arange(1, n_days), 
+                                        n_states=4, n_theta=4, t0=0)
+        with pm.Model() as self.model:
+            self.infections = pm.Data('infections', np.zeros(n_days - 1))
+            self.N = pm.Data('N', 1.0)
+            theta = [pm.Uniform(name, lower=params_init_min_max[name][1], upper=params_init_min_max[name][2],
+                                testval=params_init_min_max[name][0]) 
+                     for name in PARAM_NAMES]
+            sigma = pm.HalfNormal('sigma', sigma=sigma_scale)
+            y0 = tt.stack([1 - 1 / self.N, 1 / self.N, 0., 0.])
+            curves = self.ode(y0=y0, theta=theta)
+            pm.Normal('obs', mu=curves[:, 2], sigma=sigma, observed=self.infections / self.N)
+        self.build_time = time.perf_counter() - start
+        # Compiled steps, keyed by the setting they were compiled with
+        self._nuts = {}
+        self._advi = {}
+        self.compile_time = {'build': self.build_time}
+
+    def _add_compile_time(self, stage, start):
+        self.compile_time[stage] = self.compile_time.get(stage, 0.) + time.perf_counter() - start
+
+    def set_region(self, infect_data, N):
+        '''
+        Swaps in a region's observed series (length n_days) and population.
+        '''
+        infect_data = np.nan_to_num(np.asarray(infect_data, dtype=float))
+        if len(infect_data) != self.n_days:
+            raise ValueError(f'Expected {self.n_days} days of data, got {len(infect_data)}')
+        pm.set_data({'infections': infect_data[1:], 'N': float(N)}, model=self.model)
+
+    def _compile_nuts(self, target_accept):
+        if target_accept not in self._nuts:
+            start = time.perf_counter()
+            self._nuts[target_accept] = pm.NUTS(model=self.model, target_accept=target_accept)
+            self._add_compile_time('nuts', start)
+        return self._nuts[target_accept]
+
+    def _compile_advi(self, learning_rate):
+        # The optimizer's learning rate is baked into the compiled step
+        if learning_rate not in self._advi:
+            start = time.perf_counter()
+            advi = pm.ADVI(model=self.model)
+            step = advi.objective.step_function(obj_optimizer=pm.adam(learning_rate=learning_rate), score=True)
+            # Compile the posterior sampler now rather than on the first region
+            advi.approx.sample(1)
+            # Every shared variable the step updates: the approximation's parameters, the
+            # optimizer's moment accumulators and step count, and the random streams
+            initial = {inp.variable: inp.variable.get_value() 
+                       for inp in step.maker.inputs if inp.implicit and inp.update is not None}
+            self._advi[learning_rate] = (advi, step, initial)
+            self._add_compile_time('advi', start)
+        return self._advi[learning_rate]
+
+    def sample_nuts(self, draws = 1000, tune = 1000, chains = 4, cores = None, target_accept = 0.9, 
+                    random_seed = None):
+        '''
+        Samples the current region's posterior with NUTS, chains running in parallel processes.
+        
+        OUTPUT: 
+            - trace: pymc3 MultiTrace
+        '''
+        step = self._compile_nuts(target_accept)
+        step.reset_tuning()
+        return pm.sample(draws, tune=tune, step=step, chains=chains, cores=cores or chains, 
+                         model=self.model, random_seed=random_seed, progressbar=False, 
+                         return_inferencedata=False, compute_convergence_checks=False)
+
+    def fit_advi(self, n_iter = 20000, draws = 1000, learning_rate = 0.01):
+        '''
+        Fits a mean-field variational approximation to the current region's posterior.
+        
+        OUTPUT: 
+            - trace: pymc3 MultiTrace of draws from the approximation
+            - loss: array of the negative ELBO per iteration
+        '''
+        advi, step, initial = self._compile_advi(learning_rate)
+        # Start every region from the same state, so its fit does not depend on earlier regions
+        for variable, value in initial.items():
+            variable.set_value(value)
+        loss = np.array([step() for _ in range(n_iter)])
+        return advi.approx.sample(draws), loss
+
+    def fit(self, infect_data, N, method = 'advi', **kwargs):
+        '''
+        Fits one region and summarizes the posterior of the SEIR parameters.
+        
+        INPUT:
+            - infect_data: smoothed daily infections, n_days long
+            - N: population of the region
+            - method: 'advi' (fast variational approximation) or 'nuts'
+            - kwargs: passed to fit_advi or sample_nuts
+        OUTPUT: 
+            - summary: dict with the 'mean', 'sd' and 3% / 97% quantiles ('q3%', 'q97%') of 
+                each parameter, 'compile_time' (seconds per compilation stage; stages 
+                compiled for earlier regions with the same learning_rate / target_accept are
+                not repeated) and 'sampling_time' for this region
+        '''
+        if method not in ('advi', 'nuts'):
+            raise ValueError(f"method must be 'advi' or 'nuts', not {method!r}")
+        if method == 'advi':
+            self._compile_advi(kwargs.get('learning_rate', 0.01))
+        else:
+            self._compile_nuts(kwargs.get('target_accept', 0.9))
+        self.set_region(infect_data, N)
+
+        start = time.perf_counter()
+        if method == 'advi':
+            trace, _ = self.fit_advi(**kwargs)
+        else:
+            trace = self.sample_nuts(**kwargs)
+        sampling_time = time.perf_counter() - start
+
+        summary = {'method': method, 'compile_time': dict(self.compile_time), 'sampling_time': sampling_time}
+        for name in PARAM_NAMES + ['sigma']:
+            values = trace.get_values(name)
+            summary[name] = {'mean': float(np.mean(values)), 'sd': float(np.std(values)), 
+                             'q3%': float(np.quantile(values, 0.03)), 'q97%': float(np.quantile(values, 0.97))}
+        return summary
+
+
+def fit_regions_bayesian(region_data, method = 'advi', params_init_min_max = None, **kwargs):
+    '''
+    Fits many regions with one compiled model.
+    
+    INPUT:
+        - region_data: dict {region: (infect_data, N)}, all series of the same length
+        - method, kwargs: passed to BayesianSEIR.fit
+        - params_init_min_max: passed to BayesianSEIR
+    OUTPUT: 
+        - summaries: dict {region: summary from BayesianSEIR.fit}
+    '''
+    n_days = len(next(iter(region_data.values()))[0])
+    model = BayesianSEIR(n_days, params_init_min_max)
+    return {region: model.fit(infect_data, N, method, **kwargs) 
+            for region, (infect_data, N) in region_data.items()}
+
+
+if __name__ == "__main__":
+    from fit_regions import region_fit_inputs
+    regions = [('Colorado', ''), ('New York', ''), ('Florida', '')]
+    summaries = fit_regions_bayesian({region: region_fit_inputs(region) for region in regions}, method='advi')
+    for region, summary in summaries.items():
+        print(region, {name: round(summary[name]['mean'], 3) for name in PARAM_NAMES}, 
+              f"compile {summary['compile_time']}, sampling {summary['sampling_time']:.1f} s")
@@ -0,0 +1,237 @@
+'''
+Parametric bootstrap of SEIR forecasts: quantile bands for the compartments and R_0_t,
+and for the date the modelled daily infections fall below the reopen threshold.
+
+The point fit's residuals on the smoothed daily_cases_roll{n}mean series are used either
+to resample new series (moving blocks of residuals, keeping the autocorrelation the
+rolling mean introduces) or to fit a noise model (variance proportional to the fitted
+curve) that new series are drawn from.  Each replicate series is refitted on a process
+pool, warm-started from the point fit, and its forecast is streamed into P² quantile
+estimators, so memory stays bounded by the number of quantiles rather than the number of
+replicates.
+'''
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+
+from infection_model import Model, fit_seir, PARAM_NAMES
+from features import REOPEN_THRESH
+
+SERIES = ['S', 'E', 'I', 'R', 'R_0_t']
+
+
+class P2Quantile:
+    '''
+    Streaming estimate of one quantile of every element of an array, with the P² algorithm
+        (Jain & Chlamtac, 1985): five markers per element, no stored observations.
+
+    INPUT:
+        - p: quantile to estimate, between 0 and 1
+        - size: number of elements observed together on each update
+    '''
+    def __init__(self, p, size):
+        self.p = p
+        self.count = 0
+        self.q = np.empty((5, size))
+        self.n = np.tile(np.arange(1., 6.)[:, None], (1, size))
+        self.desired = np.array([1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5])
+        self.step = np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+    def update(self, x):
+        x = np.asarray(x, dtype=float).ravel()
+        if self.count < 5:
+            self.q[self.count] = x
+            self.count += 1
+            if self.count == 5:
+                self.q.sort(axis=0)
+            return
+        self.count += 1
+        q, n = self.q, self.n
+        np.minimum(q[0], x, out=q[0])
+        np.maximum(q[4], x, out=q[4])
+        cell = (q[1:4] <= x).sum(axis=0)
+        n += np.arange(5)[:, None] > cell
+        self.desired = self.desired + self.step
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            move = ((d >= 1) & (n[i + 1] - n[i] > 1)) | ((d <= -1) & (n[i - 1] - n[i] < -1))
+            if not move.any():
+                continue
+            d = np.where(move, np.sign(d), 0.)
+            parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+            j = np.where(d > 0, i + 1, i - 1)
+            cols = np.arange(q.shape[1])
+            linear = q[i] + d * (q[j, cols] - q[i]) / (n[j, cols] - n[i])
+            ok = (q[i - 1] < parabolic) & (parabolic < q[i + 1])
+            q[i] = np.where(move, np.where(ok, parabolic, linear), q[i])
+            n[i] += d
+
+    def value(self):
+        if self.count < 5:
+            return np.quantile(self.q[:self.count], self.p, axis=0) if self.count else np.full(self.q.shape[1], np.nan)
+        return self.q[2].copy()
+
+
+class StreamingQuantiles:
+    '''
+    Several P2Quantile estimators over arrays of a fixed shape.
+    '''
+    def __init__(self, quantiles, shape):
+        self.shape = shape
+        self.estimators = {p: P2Quantile(p, int(np.prod(shape))) for p in quantiles}
+
+    def update(self, x):
+        for estimator in self.estimators.values():
+            estimator.update(x)
+
+    def values(self):
+        return {p: estimator.value().reshape(self.shape) for p, estimator in self.estimators.items()}
+
+
+def reopen_crossing_day(I, threshold):
+    '''
+    Returns the first day after the peak of I that is below threshold (NaN if none).
+    '''
+    peak = int(np.argmax(I))
+    below = np.flatnonzero(I[peak:] < threshold)
+    return float(peak + below[0]) if len(below) else np.nan
+
+
+def replicate_series(fitted, residuals, method, block, rng):
+    '''
+    Draws one bootstrap series around the fitted curve.
+
+    INPUT:
+        - fitted: the point fit's modelled daily infections over the fitted days
+        - residuals: observed minus fitted
+        - method: 'residual' (moving-block resampling of the residuals) or 'noise'
+            (Gaussian noise with variance proportional to the fitted curve)
+        - block: block length for 'residual', e.g. the rolling-mean window
+        - rng: numpy Generator
+    '''
+    days = len(fitted)
+    if method == 'residual':
+        block = max(1, min(block, days))
+        starts = rng.integers(0, days - block + 1, size=math.ceil(days / block))
+        noise = np.concatenate([residuals[s:s + block] for s in starts])[:days]
+    elif method == 'noise':
+        scale = np.maximum(fitted, 1.)
+        dispersion = np.mean(residuals**2 / scale)
+        noise = rng.normal(0., np.sqrt(dispersion * scale))
+    else:
+        raise ValueError(f"method must be 'residual' or 'noise', not {method!r}")
+    return np.maximum(fitted + noise, 0.)
+
+
+def _replicate_worker(seed, fitted, residuals, method, block, N, params_init_min_max, horizon, threshold):
+    '''
+    Refits one bootstrap replicate and returns its forecast (5 x horizon) and crossing day,
+        or None when the fit fails.
+    '''
+    rng = np.random.default_rng(seed)
+    y = replicate_series(fitted, residuals, method, block, rng)
+    try:
+        summary = fit_seir(y, N, params_init_min_max, jacobian='sensitivity')
+    except Exception:
+        return None
+    values = [summary['best_values'][name] for name in PARAM_NAMES]
+    t, S, E, I, R, R_0_t = Model(horizon, N, *values)
+    return np.vstack([S, E, I, R, R_0_t]), reopen_crossing_day(I, threshold), values
+
+
+def bootstrap_forecast(infect_data, N, params_init_min_max, n_replicates = 200, horizon = 150,
+                       method = 'residual', block = 7, quantiles = (0.05, 0.25, 0.5, 0.75, 0.95),
+                       start_date = None, reopen_thresh = REOPEN_THRESH, seed = None, max_workers = None):
+    '''
+    Bootstraps the SEIR fit of an infection series into forecast quantile bands.
+
+    INPUT:
+        - infect_data: array of observed smoothed daily infections (the fitted window)
+        - N: population of the region
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)}
+        - n_replicates: number of bootstrap refits
+        - horizon: days to forecast from the start of the series
+        - method, block: how replicate series are drawn, see replicate_series
+        - quantiles: quantiles of the bands
+        - start_date: (Optional) date of the first day, to date the bands and crossings
+        - reopen_thresh: daily cases per person below which a region may reopen
+        - seed: (Optional) random seed
+        - max_workers: number of worker processes (default: os.cpu_count())
+    OUTPUT:
+        - df_bands: one row per forecast day; for every series in SERIES a column per
+            quantile named '{series}_q{quantile}', plus the point forecast '{series}_fit'
+        - crossing: {'fraction_crossed', 'point', 'quantiles'} for the day (or date) I(t)
+            falls below the reopen threshold; quantiles are over replicates that cross
+        - df_params: refitted parameters, one row per successful replicate
+    '''
+    infect_data = np.nan_to_num(np.asarray(infect_data, dtype=float))
+    days = len(infect_data)
+    point = fit_seir(infect_data, N, params_init_min_max, jacobian='sensitivity')['best_values']
+    point_values = [point[name] for name in PARAM_NAMES]
+    fitted = Model(days, N, *point_values)[3]
+    residuals = infect_data - fitted
+    threshold = math.ceil(N * reopen_thresh)
+    # Replicates are refitted from the point fit
+    warm_start = {name: (point[name],) + tuple(params_init_min_max[name][1:]) for name in PARAM_NAMES}
+
+    bands = StreamingQuantiles(quantiles, (len(SERIES), horizon))
+    crossings, params = [], []
+    seeds = np.random.SeedSequence(seed).spawn(n_replicates)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        # Keep a bounded number of replicates in flight so results never pile up
+        window = 4 * (max_workers or os.cpu_count() or 1)
+        pending, submitted = set(), 0
+        while submitted < n_replicates or pending:
+            while submitted < n_replicates and len(pending) < window:
+                pending.add(pool.submit(_replicate_worker, seeds[submitted], fitted, residuals, method, block,
+                                        N, warm_start, horizon, threshold))
+                submitted += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                if result is None:
+                    continue
+                trajectory, crossing_day, values = result
+                bands.update(trajectory)
+                crossings.append(crossing_day)
+                params.append(values)
+
+    t, S, E, I, R, R_0_t = Model(horizon, N, *point_values)
+    point_forecast = np.vstack([S, E, I, R, R_0_t])
+    df_bands = pd.DataFrame({'day': t})
+    if start_date is not None:
+        df_bands['date'] = pd.Timestamp(start_date) + pd.to_timedelta(t, unit='D')
+    for i, name in enumerate(SERIES):
+        df_bands[f'{name}_fit'] = point_forecast[i]
+        for p, values in bands.values().items():
+            df_bands[f'{name}_q{p:g}'] = values[i]
+
+    crossings = np.array(crossings)
+    crossed = crossings[~np.isnan(crossings)]
+    to_date = (lambda day: day) if start_date is None else (
+        lambda day: day if np.isnan(day) else pd.Timestamp(start_date) + pd.Timedelta(days=round(day)))
+    crossing = {'fraction_crossed': len(crossed) / len(crossings) if len(crossings) else np.nan,
+                'point': to_date(reopen_crossing_day(I, threshold)),
+                'quantiles': {p: to_date(np.quantile(crossed, p)) if len(crossed) else np.nan
+                              for p in quantiles}}
+    return df_bands, crossing, pd.DataFrame(params, columns=PARAM_NAMES)
+
+
+if __name__ == "__main__":
+    from fit_regions import region_fit_inputs, DEFAULT_PARAMS_INIT_MIN_MAX
+    from infection_model import get_state_or_county_data
+
+    region = ('Colorado', '')
+    infect_data, N = region_fit_inputs(region, fit_days=40)
+    # Day 0 of the fit is the region's first data date, not the plot start
+    df_region, _, _ = get_state_or_county_data(region)
+    df_bands, crossing, df_params = bootstrap_forecast(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX,
+                                                       start_date=df_region['date'].iloc[0], seed=0)
+    print(df_bands[['date', 'I_q0.05', 'I_q0.5', 'I_q0.95', 'R_0_t_q0.05', 'R_0_t_q0.95']].iloc[::10])
+    print(crossing)
+    print(df_params.describe())
@@ -0,0 +1,272 @@
+'''
+Command-line entry point for the forecasting pipeline.
+
+    python cli.py ingest --level county --export      # download (into the cache) and map
+    python cli.py features --level state --out data/state_features.parquet
+    python cli.py fit "New York" "New Jersey:Bergen" --starts 16
+    python cli.py forecast "New York" --horizon 150 --bootstrap 200 --out ny.csv
+    python cli.py plot --all-states
+    python cli.py backtest --all-states
+
+Regions are 'State' or 'State:County'.  The global options are exported as the COVID_*
+environment variables the modules read when they are imported (data and image
+directories, download cache, offline mode, profiling, source URLs), so they are set
+before any project module is loaded.  Only argparse is imported up front; each
+subcommand imports what it needs, so data commands never load scipy, matplotlib,
+lmfit or PyMC3 (see benchmarks/bench_startup.py).
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+# Global option -> environment variable read by the project modules
+ENV_OPTIONS = {'data_dir': 'COVID_DATA_DIR',
+               'images_dir': 'COVID_IMAGES_DIR',
+               'cache_dir': 'COVID_CACHE_DIR',
+               'series_store': 'COVID_SERIES_STORE',
+               'states_url': 'COVID_NYT_STATES_URL',
+               'counties_url': 'COVID_NYT_COUNTIES_URL',
+               'census_url': 'COVID_CENSUS_URL'}
+
+
+def parse_region(text):
+    '''
+    Turns 'State' or 'State:County' into a ('State', 'County') region tuple.
+    '''
+    state, _, county = text.partition(':')
+    return (state.strip(), county.strip())
+
+
+def selected_regions(args):
+    regions = [parse_region(text) for text in args.regions]
+    if args.all_states:
+        from data_loader import all_states
+        regions += all_states()
+    if not regions:
+        sys.exit(f'{args.command}: give at least one region or --all-states')
+    return regions
+
+
+def write_frame(df, path):
+    '''
+    Writes a frame to Parquet (.parquet) or CSV, or prints it when no path is given.
+    '''
+    if path is None:
+        print(df.to_string(index=False))
+    elif path.endswith('.parquet'):
+        from data_loader import save_columnar
+        save_columnar(df, path)
+        print(f'{len(df)} rows -> {path}')
+    else:
+        df.to_csv(path, index=False)
+        print(f'{len(df)} rows -> {path}')
+
+
+# Subcommands
+def cmd_ingest(args):
+    import infection_model
+    from data_cache import fetch_csv
+    frames = {'states': (infection_model.NYT_STATES_URL, dict(parse_dates=['date'], dtype={'fips': str})),
+              'census': (infection_model.CENSUS_COUNTIES_URL,
+                         dict(encoding='latin-1', usecols=['STNAME', 'CTYNAME', 'POPESTIMATE2019']))}
+    if args.level == 'county':
+        frames['counties'] = (infection_model.NYT_COUNTIES_URL, dict(parse_dates=['date'], dtype={'fips': str}))
+    for name, (url, read_csv_kwargs) in frames.items():
+        df = fetch_csv(url, **read_csv_kwargs)
+        print(f'{name}: {len(df)} rows from {url}')
+    if args.export:
+        for level in ['state', 'county'][:1 + (args.level == 'county')]:
+            print(f'series store -> {infection_model.export_region_series(level)}')
+
+
+def cmd_features(args):
+    import data_loader
+    from data_cache import fetch_csv
+    from features import add_region_features
+    import infection_model
+    if args.level == 'state':
+        df = fetch_csv(infection_model.NYT_STATES_URL, parse_dates=['date'], dtype={'fips': str})
+        key_cols = ('state',)
+    else:
+        df = fetch_csv(infection_model.NYT_COUNTIES_URL, parse_dates=['date'], dtype={'fips': str})
+        key_cols = ('state', 'county')
+    regions, populations = infection_model.region_populations(args.level)
+    population = {region[:len(key_cols)]: N for region, N in zip(regions, populations)}
+    df_features = add_region_features(df, key_cols, 'date',
+                                      diff_cols={'cases': 'daily_cases', 'deaths': 'daily_deaths'},
+                                      smooth_cols=['daily_cases', 'daily_deaths'], windows=tuple(args.windows),
+                                      population=population)
+    write_frame(df_features, args.out or os.path.join(data_loader.DATA_DIR, f'{args.level}_features.parquet'))
+
+
+def cmd_fit(args):
+    import pandas as pd
+    regions = selected_regions(args)
+    store_path = None
+    if args.mapped:
+        from infection_model import SERIES_STORE_DIR as store_path
+    if args.bayes:
+        from bayes_seir import fit_regions_bayesian, PARAM_NAMES
+        from fit_regions import region_fit_inputs
+        region_data = {region: region_fit_inputs(region, args.smooth, args.fit_days, store_path)
+                       for region in regions}
+        summaries = fit_regions_bayesian(region_data, method=args.bayes)
+        df = pd.DataFrame([{'state': region[0], 'county': region[1],
+                            **{name: summary[name]['mean'] for name in PARAM_NAMES},
+                            **{f'{name}_sd': summary[name]['sd'] for name in PARAM_NAMES},
+                            'sampling_time': summary['sampling_time']}
+                           for region, summary in summaries.items()])
+    elif args.starts:
+        from fit_regions import region_fit_inputs, DEFAULT_PARAMS_INIT_MIN_MAX
+        from multistart import multistart_fit
+        frames = []
+        for region in regions:
+            infect_data, N = region_fit_inputs(region, args.smooth, args.fit_days, store_path)
+            df_optima, _ = multistart_fit(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX, n_starts=args.starts,
+                                          sampler=args.sampler, seed=args.seed, max_workers=args.workers)
+            frames.append(df_optima.assign(state=region[0], county=region[1]))
+        df = pd.concat(frames, ignore_index=True)
+    else:
+        from fit_regions import fit_regions
+        df = fit_regions(regions, num_days_smooth=args.smooth, fit_days=args.fit_days, jacobian=args.jacobian,
+                         max_workers=args.workers, store_path=store_path)
+    write_frame(df, args.out)
+
+
+def cmd_forecast(args):
+    import numpy as np
+    import pandas as pd
+    from infection_model import get_state_or_county_data, fit_seir, Model
+    from fit_regions import DEFAULT_PARAMS_INIT_MIN_MAX
+    frames = []
+    for region in selected_regions(args):
+        df_region, N, _ = get_state_or_county_data(region, args.smooth)
+        infect_data = np.nan_to_num(df_region[f'daily_cases_roll{args.smooth}mean'].to_numpy(dtype=float)[:args.fit_days])
+        start_date = df_region['date'].iloc[0]
+        if args.bootstrap:
+            from bootstrap import bootstrap_forecast
+            df, crossing, _ = bootstrap_forecast(infect_data, float(N), DEFAULT_PARAMS_INIT_MIN_MAX,
+                                                 n_replicates=args.bootstrap, horizon=args.horizon,
+                                                 start_date=start_date, seed=args.seed, max_workers=args.workers)
+            print(f"{region}: {crossing['fraction_crossed']:.0%} of replicates cross the reopen threshold, "
+                  f"point forecast {crossing['point']}")
+        else:
+            best_values = fit_seir(infect_data, float(N), DEFAULT_PARAMS_INIT_MIN_MAX,
+                                   jacobian='sensitivity')['best_values']
+            t, S, E, I, R, R_0_t = Model(args.horizon, float(N),
+                                         *[best_values[name] for name in ('R_0_start', 'k', 'x0', 'R_0_end')])
+            df = pd.DataFrame({'date': pd.date_range(start_date, periods=args.horizon), 'S': S, 'E': E, 'I': I,
+                               'R': R, 'R_0_t': R_0_t})
+        frames.append(df.assign(state=region[0], county=region[1]))
+    write_frame(pd.concat(frames, ignore_index=True), args.out)
+
+
+def cmd_plot(args):
+    from render_batch import render_region_infections
+    paths = render_region_infections(selected_regions(args), args.out_dir, dpi=args.dpi, fmt=args.format,
+                                     num_days_smooth=args.smooth, max_workers=args.workers)
+    for path in paths:
+        print(path)
+
+
+def cmd_backtest(args):
+    import data_loader
+    from backtest import Backtester
+    backtester = Backtester(args.cache or os.path.join(data_loader.DATA_DIR, 'backtest_cache'),
+                            num_days_smooth=args.smooth, step=args.step, max_horizon=args.horizon)
+    df_errors, df_metrics, df_crossing, df_runs = backtester.run(selected_regions(args), args.workers)
+    print(df_metrics.to_string(index=False))
+    print(f"{df_runs['n_fitted'].sum()} origins fitted, {df_runs['n_cached'].sum()} reused")
+    if args.out:
+        write_frame(df_errors, args.out)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', help='data directory (COVID_DATA_DIR)')
+    parser.add_argument('--images-dir', help='directory figures are saved to (COVID_IMAGES_DIR)')
+    parser.add_argument('--cache-dir', help='download cache (COVID_CACHE_DIR)')
+    parser.add_argument('--series-store', help='memory-mapped series store root (COVID_SERIES_STORE)')
+    parser.add_argument('--offline', action='store_true', help='only use cached downloads (COVID_OFFLINE)')
+    parser.add_argument('--profile', nargs='?', const='', metavar='PATH',
+                        help='instrument the run; write the report to PATH (.json or .folded), '
+                             'or print it to stderr')
+    parser.add_argument('--states-url', help='NYT state series (COVID_NYT_STATES_URL)')
+    parser.add_argument('--counties-url', help='NYT county series (COVID_NYT_COUNTIES_URL)')
+    parser.add_argument('--census-url', help='census population estimates (COVID_CENSUS_URL)')
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+
+    def command(name, func, help, regions = False):
+        sub = commands.add_parser(name, help=help, description=help)
+        sub.set_defaults(func=func)
+        if regions:
+            sub.add_argument('regions', nargs='*', help="'State' or 'State:County'")
+            sub.add_argument('--all-states', action='store_true', help='add every state')
+            sub.add_argument('--smooth', type=int, default=7, help='days of the centered rolling mean')
+            sub.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+        return sub
+
+    sub = command('ingest', cmd_ingest, 'download the source files into the cache')
+    sub.add_argument('--level', choices=['state', 'county'], default='county')
+    sub.add_argument('--export', action='store_true', help='also write the memory-mapped series store(s)')
+
+    sub = command('features', cmd_features, 'daily, rolling-mean and per-capita features of every region')
+    sub.add_argument('--level', choices=['state', 'county'], default='state')
+    sub.add_argument('--windows', type=int, nargs='+', default=[7, 14], help='rolling-mean windows in days')
+    sub.add_argument('--out', help='.parquet or .csv file (default: DATA_DIR/<level>_features.parquet)')
+
+    sub = command('fit', cmd_fit, 'fit the SEIR model to regions', regions=True)
+    sub.add_argument('--fit-days', type=int, default=40, help='leading days of each series to fit')
+    sub.add_argument('--jacobian', choices=['finite_difference', 'sensitivity'], default='sensitivity')
+    sub.add_argument('--starts', type=int, help='multi-start fit with this many starting points')
+    sub.add_argument('--sampler', choices=['lhs', 'sobol'], default='lhs')
+    sub.add_argument('--seed', type=int)
+    sub.add_argument('--bayes', choices=['advi', 'nuts'], help='Bayesian fit with PyMC3')
+    sub.add_argument('--mapped', action='store_true', help='read regions from the series store (see ingest --export)')
+    sub.add_argument('--out', help='.csv or .parquet file (default: print)')
+
+    sub = command('forecast', cmd_forecast, 'fit regions and forecast their SEIR trajectories', regions=True)
+    sub.add_argument('--fit-days', type=int, default=40, help='leading days of each series to fit')
+    sub.add_argument('--horizon', type=int, default=150, help='days from the start of the series')
+    sub.add_argument('--bootstrap', type=int, metavar='N', help='quantile bands from N bootstrap refits')
+    sub.add_argument('--seed', type=int)
+    sub.add_argument('--out', help='.csv or .parquet file (default: print)')
+
+    sub = command('plot', cmd_plot, 'render the infection chart of regions', regions=True)
+    sub.add_argument('--out-dir', help='default: IMAGES_DIR')
+    sub.add_argument('--dpi', type=int, default=100)
+    sub.add_argument('--format', default='png')
+
+    sub = command('backtest', cmd_backtest, 'rolling-origin backtest of regions', regions=True)
+    sub.add_argument('--cache', help='fit cache directory (default: DATA_DIR/backtest_cache)')
+    sub.add_argument('--step', type=int, default=7, help='days between forecast origins')
+    sub.add_argument('--horizon', type=int, default=28, help='days forecast past each origin')
+    sub.add_argument('--out', help='write the per-horizon errors to this .csv or .parquet file')
+    return parser
+
+
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+    for option, variable in ENV_OPTIONS.items():
+        if getattr(args, option) is not None:
+            os.environ[variable] = getattr(args, option) if option.endswith('_url') else os.path.abspath(getattr(args, option))
+    if args.offline:
+        os.environ['COVID_OFFLINE'] = '1'
+    if args.profile is not None:
+        os.environ['COVID_PROFILE'] = '1'
+        if args.profile:
+            os.environ['COVID_PROFILE_OUT'] = args.profile
+    start = time.perf_counter()
+    args.func(args)
+    if args.profile == '':
+        import instrument
+        json.dump(instrument.report(), sys.stderr, indent=1)
+        print(file=sys.stderr)
+    print(f'{args.command} done in {time.perf_counter() - start:.2f} s', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+'''
+Local, content-addressed cache for the remote CSV files used by the forecasting code.
+
+Downloads are stored once per distinct content (keyed by SHA-256) and the parsed, typed
+DataFrame is snapshotted next to them, so repeated requests for the same file within the 
+freshness window never touch the network or re-parse the CSV.  In offline mode only the 
+cache is consulted, which allows running on machines without network access once the 
+cache directory has been populated (or copied over).
+
+Layout of the cache directory:
+    index.json              url -> {"sha256": ..., "fetched": <epoch seconds>}
+    blobs/<sha256>.csv      raw downloaded bytes
+    parsed/<sha256>-<key>.pkl  parsed DataFrame for a given set of read_csv options
+
+Configuration (arguments override environment variables):
+    COVID_CACHE_DIR      cache location (default: data/cache in the repository)
+    COVID_CACHE_MAX_AGE  freshness window in seconds (default: 1 day)
+    COVID_OFFLINE        set to 1 to never access the network
+    COVID_CACHE_MAX_FRAMES  parsed frames kept in memory, least recently used are dropped
+                         first (default: 8)
+'''
+import collections
+import hashlib
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+import urllib.request
+import warnings
+
+import pandas as pd
+
+import instrument
+
+CACHE_DIR = os.environ.get('COVID_CACHE_DIR', 
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'cache'))
+MAX_AGE = float(os.environ.get('COVID_CACHE_MAX_AGE', 24 * 60 * 60))
+OFFLINE = os.environ.get('COVID_OFFLINE', '0').lower() not in ('', '0', 'false', 'no')
+MAX_FRAMES = int(os.environ.get('COVID_CACHE_MAX_FRAMES', 8))
+
+# In-process memo of parsed frames: (sha256, parse key) -> DataFrame, in least to most 
+# recently used order; only the current version of each URL and at most MAX_FRAMES are kept
+_frames = collections.OrderedDict()
+# In-process copy of index.json per cache directory
+_indexes = {}
+# Guards _frames and _indexes (fetch_csv is called from server threads)
+_lock = threading.Lock()
+
+
+def _index_path(cache_dir):
+    return os.path.join(cache_dir, 'index.json')
+
+
+def _read_index(cache_dir):
+    try:
+        with open(_index_path(cache_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _load_index(cache_dir):
+    with _lock:
+        if cache_dir not in _indexes:
+            _indexes[cache_dir] = _read_index(cache_dir)
+        return dict(_indexes[cache_dir])
+
+
+def _temp_path(path):
+    '''
+    Creates a unique temporary file next to path (unique across threads and processes).
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    return tmp_path
+
+
+def _atomic_write(path, data, mode='wb'):
+    tmp_path = _temp_path(path)
+    try:
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class RegionPickleCache:
+    '''
+    One pickle per region in a directory, tagged with the settings it was computed under
+        and replaced atomically; used for the incremental update state and backtest origins.
+    
+    INPUT:
+        - directory: cache directory (created if needed)
+        - settings: value compared on load; entries saved under other settings are ignored
+    '''
+    def __init__(self, directory, settings):
+        self.directory = directory
+        self.settings = settings
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, region):
+        name = '_'.join(part for part in region if part).replace(' ', '_').replace('/', '-')
+        return os.path.join(self.directory, f'{name}.pkl')
+
+    def load(self, region):
+        '''
+        Returns the region's saved value, or None if there is none under the current settings.
+        '''
+        try:
+            with open(self.path(region), 'rb') as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        if not isinstance(entry, dict) or entry.get('settings') != self.settings:
+            return None
+        return entry['value']
+
+    def save(self, region, value):
+        _atomic_write(self.path(region), pickle.dumps({'settings': self.settings, 'value': value}))
+
+
+def _update_index(cache_dir, url, entry):
+    '''
+    Records a download in the index, merged into the index on disk (which other processes 
+        may have updated), and drops the in-memory frames of the URL's previous version.
+    '''
+    with _lock:
+        index = _read_index(cache_dir)
+        old = {_indexes.get(cache_dir, {}).get(url, {}).get('sha256'), index.get(url, {}).get('sha256')}
+        index[url] = entry
+        _atomic_write(_index_path(cache_dir), json.dumps(index, indent=1, sort_keys=True), mode='w')
+        _indexes[cache_dir] = index
+        in_use = {other['sha256'] for other in index.values()}
+        for key in [key for key in _frames if key[0] in old and key[0] not in in_use]:
+            del _frames[key]
+
+
+def _parse_key(read_csv_kwargs):
+    return hashlib.sha1(repr(sorted(read_csv_kwargs.items())).encode()).hexdigest()[:12]
+
+
+def _download(url, timeout=60):
+    with instrument.stage('download'), urllib.request.urlopen(url, timeout=timeout) as response:
+        data = response.read()
+    instrument.count('bytes_downloaded', len(data))
+    return data
+
+
+def _parsed_frame(cache_dir, sha, read_csv_kwargs):
+    '''
+    Returns the parsed frame for a blob, from memory, a pickled snapshot or by parsing the CSV.
+    '''
+    key = (sha, _parse_key(read_csv_kwargs))
+    with _lock:
+        if key in _frames:
+            _frames.move_to_end(key)
+            return _frames[key]
+    snapshot_path = os.path.join(cache_dir, 'parsed', f'{key[0]}-{key[1]}.pkl')
+    if os.path.exists(snapshot_path):
+        with instrument.stage('load_snapshot'):
+            df = pd.read_pickle(snapshot_path)
+    else:
+        with instrument.stage('parse_csv'), open(os.path.join(cache_dir, 'blobs', f'{sha}.csv'), 'rb') as f:
+            data = f.read()
+            df = pd.read_csv(io.BytesIO(data), **read_csv_kwargs)
+        instrument.count('bytes_parsed', len(data))
+        instrument.count('rows_parsed', len(df))
+        tmp_path = _temp_path(snapshot_path)
+        try:
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, snapshot_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    # Threads that parsed the same blob concurrently all return the first frame stored
+    with _lock:
+        df = _frames.setdefault(key, df)
+        _frames.move_to_end(key)
+        while len(_frames) > max(MAX_FRAMES, 1):
+            _frames.popitem(last=False)
+        return df
+
+
+def fetch_csv(url, max_age=None, offline=None, cache_dir=None, **read_csv_kwargs):
+    '''
+    Returns the CSV at a URL as a parsed DataFrame, going through the local cache.
+    
+    INPUT:
+        - url: location of the CSV (http(s):// or file://)
+        - max_age: seconds a cached download stays fresh (default MAX_AGE)
+        - offline: if True never access the network; raise if the URL was never cached
+            (default OFFLINE)
+        - cache_dir: cache location (default CACHE_DIR)
+        - read_csv_kwargs: passed to pd.read_csv; part of the snapshot key, so the same
+            file read with different options is parsed and stored separately
+    OUTPUT: 
+        - df: the parsed DataFrame.  It is shared between calls and must be treated as 
+            read-only; slice or copy it before modifying.
+    '''
+    with instrument.stage('fetch_csv'):
+        return _fetch_csv(url, max_age, offline, cache_dir, read_csv_kwargs)
+
+
+def _fetch_csv(url, max_age, offline, cache_dir, read_csv_kwargs):
+    max_age = MAX_AGE if max_age is None else max_age
+    offline = OFFLINE if offline is None else offline
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+
+    index = _load_index(cache_dir)
+    entry = index.get(url)
+    if entry is not None and (offline or time.time() - entry['fetched'] < max_age):
+        return _parsed_frame(cache_dir, entry['sha256'], read_csv_kwargs)
+    if offline:
+        raise FileNotFoundError(f'No cached copy of {url} in {cache_dir} (offline mode)')
+
+    try:
+        data = _download(url)
+    except OSError as err:
+        if entry is None:
+            raise
+        warnings.warn(f'Download of {url} failed ({err}); using cached copy from '
+                      f'{time.ctime(entry["fetched"])}')
+        return _parsed_frame(cache_dir, entry['sha256'], read_csv_kwargs)
+
+    sha = hashlib.sha256(data).hexdigest()
+    blob_path = os.path.join(cache_dir, 'blobs', f'{sha}.csv')
+    if not os.path.exists(blob_path):
+        _atomic_write(blob_path, data)
+    _update_index(cache_dir, url, {'sha256': sha, 'fetched': time.time()})
+    return _parsed_frame(cache_dir, sha, read_csv_kwargs)
+
+
+def clear_memory_cache():
+    '''
+    Drops the in-process frames and index copies (the on-disk cache is kept).
+    '''
+    with _lock:
+        _frames.clear()
+        _indexes.clear()
@@ -0,0 +1,165 @@
+'''
+Typed, column-pruned loaders for the CSV files in data/.
+
+Each file has an explicit schema: only the listed columns are read, region identifiers
+are categoricals and counts are 32-bit.  Counts that are never missing are int32; counts
+with gaps are float32 (so NaN is preserved).  Dates are converted directly from their 
+integer (YYYYMMDD) or ISO string form.  Large files can be streamed in chunks, and any 
+loaded frame can be written to / read from Parquet (requires pyarrow or fastparquet).
+
+DATA_DIR and IMAGES_DIR are the default locations of the input files and saved figures 
+for every module.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Input data and saved figures; override with COVID_DATA_DIR / COVID_IMAGES_DIR
+DATA_DIR = os.environ.get('COVID_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+IMAGES_DIR = os.environ.get('COVID_IMAGES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'images'))
+
+# COVID Tracking Project daily state data (us_states_covid19_daily.csv); 'date' is YYYYMMDD
+COVID_TRACKING_SCHEMA = {'date': 'int32', 'state': 'category', 
+                         'positiveIncrease': 'float32', 'positive': 'float32', 
+                         'negativeIncrease': 'float32', 'negative': 'float32', 'pending': 'float32', 
+                         'deathIncrease': 'float32', 'death': 'float32', 'recovered': 'float32', 
+                         'hospitalizedIncrease': 'float32', 'hospitalized': 'float32', 
+                         'totalTestResultsIncrease': 'float32', 'totalTestResults': 'int32', 
+                         'posNeg': 'int32', 'total': 'int32'}
+
+# Our World in Data country data (owid-covid-data.csv); 'date' is YYYY-MM-DD
+OWID_SCHEMA = {'iso_code': 'category', 'location': 'category', 'date': 'str', 
+               'total_cases': 'int32', 'new_cases': 'int32', 
+               'total_deaths': 'int32', 'new_deaths': 'int32', 
+               'total_cases_per_million': 'float32', 'new_cases_per_million': 'float32', 
+               'total_deaths_per_million': 'float32', 'new_deaths_per_million': 'float32', 
+               'total_tests': 'float32', 'new_tests': 'float32', 
+               'total_tests_per_thousand': 'float32', 'new_tests_per_thousand': 'float32', 
+               'tests_units': 'category', 'population': 'float32'}
+
+# Census 2019 state population estimates (us_state_population_2019.csv)
+STATE_POPULATION_SCHEMA = {'NAME': 'str', 'ABBR': 'str', 
+                           'POPESTIMATE2019': 'int32', 'POPEST18PLUS2019': 'int32'}
+
+
+def int_to_datetime(dates):
+    '''
+    Converts YYYYMMDD integers to datetime64 without going through strings.
+    '''
+    dates = np.asarray(dates, dtype=np.int64)
+    return pd.to_datetime(pd.DataFrame({'year': dates // 10000, 
+                                        'month': dates // 100 % 100, 
+                                        'day': dates % 100}))
+
+
+def _concat_chunks(chunks):
+    '''
+    Concatenates chunks, merging per-chunk categories instead of falling back to object.
+    '''
+    chunks = list(chunks)
+    if len(chunks) == 1:
+        return chunks[0]
+    categorical = [col for col in chunks[0].columns if isinstance(chunks[0][col].dtype, pd.CategoricalDtype)]
+    df = pd.concat(chunks, ignore_index=True)
+    for col in categorical:
+        df[col] = union_categoricals([chunk[col] for chunk in chunks])
+    return df
+
+
+def read_typed_csv(path, schema, columns = None, chunksize = None, convert = None):
+    '''
+    Reads a CSV with an explicit schema, keeping only the needed columns.
+    
+    INPUT:
+        - path: CSV file
+        - schema: {column: dtype} for every column that may be read
+        - columns: (Optional) subset of the schema's columns to read (default: all of them)
+        - chunksize: (Optional) rows per chunk; the file is streamed and each chunk is
+            typed (and converted) before the next one is read
+        - convert: (Optional) function applied to each chunk after reading
+    OUTPUT: 
+        - df: typed DataFrame
+    '''
+    columns = list(schema) if columns is None else list(columns)
+    dtype = {col: schema[col] for col in columns}
+    reader = pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=chunksize)
+    chunks = [reader] if chunksize is None else reader
+    if convert is not None:
+        chunks = (convert(chunk) for chunk in chunks)
+    return _concat_chunks(chunks)
+
+
+def load_covid_tracking(path = None, columns = None, chunksize = None):
+    '''
+    Loads the COVID Tracking Project daily state file with 'datetime' and 'd_o_y' columns added.
+    
+    INPUT:
+        - path: CSV file (default: data/us_states_covid19_daily.csv)
+        - columns, chunksize: as for read_typed_csv ('date' and 'state' are always read)
+    OUTPUT: 
+        - df_usa_rates: typed frame, one row per state per day
+    '''
+    path = os.path.join(DATA_DIR, 'us_states_covid19_daily.csv') if path is None else path
+    if columns is not None:
+        columns = ['date', 'state'] + [col for col in columns if col not in ('date', 'state')]
+
+    def convert(df):
+        df.insert(0, 'datetime', int_to_datetime(df['date']).to_numpy())
+        df.insert(1, 'd_o_y', df['datetime'].dt.dayofyear.astype('int16'))
+        return df
+    return read_typed_csv(path, COVID_TRACKING_SCHEMA, columns, chunksize, convert)
+
+
+def load_owid(path = None, columns = None, chunksize = None):
+    '''
+    Loads the Our World in Data country file with 'date' parsed to datetime.
+    
+    INPUT:
+        - path: CSV file (default: data/owid-covid-data.csv)
+        - columns, chunksize: as for read_typed_csv ('iso_code', 'location' and 'date' are 
+            always read)
+    OUTPUT: 
+        - df_owid: typed frame, one row per country per day
+    '''
+    path = os.path.join(DATA_DIR, 'owid-covid-data.csv') if path is None else path
+    if columns is not None:
+        keys = ['iso_code', 'location', 'date']
+        columns = keys + [col for col in columns if col not in keys]
+
+    def convert(df):
+        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
+        return df
+    return read_typed_csv(path, OWID_SCHEMA, columns, chunksize, convert)
+
+
+def load_state_population(path = None):
+    '''
+    Loads the 2019 census state population estimates (default: data/us_state_population_2019.csv).
+    '''
+    path = os.path.join(DATA_DIR, 'us_state_population_2019.csv') if path is None else path
+    return read_typed_csv(path, STATE_POPULATION_SCHEMA)
+
+
+def all_states(path = None):
+    '''
+    Returns a ('State', '') region tuple for every state and DC in the population file 
+        (the national total and Puerto Rico are left out).
+    '''
+    df_states = load_state_population(path)
+    return [(name, '') for name in df_states['NAME'] if name not in ('United States', 'Puerto Rico Commonwealth')]
+
+
+def save_columnar(df, path):
+    '''
+    Writes a loaded frame to Parquet, keeping its dtypes (categoricals included).
+    '''
+    df.to_parquet(path, index=False)
+
+
+def load_columnar(path, columns = None):
+    '''
+    Reads a frame written by save_columnar, optionally only some of its columns.
+    '''
+    return pd.read_parquet(path, columns=columns)
@@ -0,0 +1,143 @@
+'''
+Group-wise derived series for every region of a national frame in one vectorized pass.
+
+The frame is sorted once by (region, date); daily increments come from a grouped diff,
+and centered rolling means for every requested window come from a single cumulative sum
+over the whole frame, with windows that cross a region boundary (or contain a gap in the
+data) set to NaN, exactly as a per-region rolling(window, center=True).mean() would.
+'''
+import numpy as np
+import pandas as pd
+
+# CDC guideline threshold of 10 reported infections per 100k pop every 14 days
+REOPEN_THRESH = 10./100000/14
+
+
+def _grouped_centered_means(values, group_start, group_stop, windows):
+    '''
+    Centered rolling means of a sorted, grouped array for several window sizes.
+    
+    INPUT:
+        - values: float array, rows sorted by (region, date)
+        - group_start, group_stop: for every row, the first and one-past-last row of its region
+        - windows: iterable of window sizes
+    OUTPUT: 
+        - {window: float array of rolling means, NaN where the window is incomplete}
+    '''
+    n = len(values)
+    is_nan = np.isnan(values)
+    csum = np.concatenate(([0.], np.cumsum(np.where(is_nan, 0., values))))
+    cnan = np.concatenate(([0], np.cumsum(is_nan)))
+    rows = np.arange(n)
+    means = {}
+    for window in windows:
+        # pandas labels a centered window of size w at row lo + w//2
+        lo = rows - window // 2
+        hi = lo + window
+        valid = (lo >= group_start) & (hi <= group_stop)
+        lo_c, hi_c = np.clip(lo, 0, n), np.clip(hi, 0, n)
+        valid &= (cnan[hi_c] - cnan[lo_c]) == 0
+        means[window] = np.where(valid, (csum[hi_c] - csum[lo_c]) / window, np.nan)
+    return means
+
+
+def _daily_and_rolling(column, starts, group_start, group_stop, diff_cols, smooth_cols, windows):
+    '''
+    Daily increments and centered rolling means of sorted, grouped columns.
+    
+    INPUT:
+        - column: function returning an existing column's values by name
+        - starts: first row of every region
+        - group_start, group_stop, windows: as for _grouped_centered_means
+        - diff_cols, smooth_cols: as for add_region_features
+    OUTPUT: 
+        - new_cols: {new column: float array}
+        - rolled_cols: names of the rolling-mean columns
+    '''
+    new_cols = {}
+    for cum_col, daily_col in (diff_cols or {}).items():
+        cum = np.asarray(column(cum_col), dtype=float)
+        daily = np.empty_like(cum)
+        daily[1:] = cum[1:] - cum[:-1]
+        daily[starts] = 0
+        new_cols[daily_col] = np.nan_to_num(daily, nan=0.)
+    
+    rolled_cols = []
+    for col in smooth_cols:
+        values = new_cols[col] if col in new_cols else np.asarray(column(col), dtype=float)
+        for window, mean in _grouped_centered_means(values, group_start, group_stop, windows).items():
+            new_cols[f'{col}_roll{window}mean'] = mean
+            rolled_cols.append(f'{col}_roll{window}mean')
+    return new_cols, rolled_cols
+
+
+def add_series_features(columns, diff_cols = None, smooth_cols = (), windows = (7,)):
+    '''
+    Daily increments and centered rolling means of a single region's series, computed 
+        exactly as add_region_features does for every region of a frame.
+    
+    INPUT:
+        - columns: {name: array} of one region's series, ordered by date (read-only arrays,
+            e.g. views of a memory-mapped store, are fine; they are not modified)
+        - diff_cols, smooth_cols, windows: as for add_region_features
+    OUTPUT: 
+        - new_cols: {new column: float array}
+    '''
+    n = len(next(iter(columns.values())))
+    starts = np.array([0] if n else [], dtype=np.int64)
+    new_cols, _ = _daily_and_rolling(columns.__getitem__, starts, np.zeros(n, dtype=np.int64), 
+                                     np.full(n, n, dtype=np.int64), diff_cols, smooth_cols, windows)
+    return new_cols
+
+
+def add_region_features(df, key_cols, date_col, diff_cols = None, smooth_cols = (), windows = (7,),
+                        population = None, reopen_thresh = REOPEN_THRESH):
+    '''
+    Adds daily increments, centered rolling means, per-capita rates and reopen-threshold
+        flags for every region of a national frame.
+    
+    INPUT:
+        - df: national frame with one row per region per date
+        - key_cols: column name(s) identifying a region, e.g. 'state_id' or ('state', 'county')
+        - date_col: column ordering each region's rows
+        - diff_cols: (Optional) {cumulative column: new daily column}; the first day of each
+            region and days next to missing totals are 0, as in get_state_or_county_data
+        - smooth_cols: columns (existing or created by diff_cols) to smooth; each gets 
+            '{col}_roll{n}mean' for every n in windows
+        - windows: centered rolling-mean window sizes in days
+        - population: (Optional) column name, or dict mapping region key tuples to population.
+            When given, adds 'population', '{col}_per100k' for every smoothed column and 
+            rolling mean, 'reopen_thresh' (daily count threshold, ceil(population * reopen_thresh))
+            and '{col}_roll{n}mean_below_reopen' flags
+        - reopen_thresh: daily infections per person considered low incidence
+    OUTPUT: 
+        - df: new frame sorted by (key_cols, date_col) with the feature columns added
+    '''
+    key_cols = [key_cols] if isinstance(key_cols, str) else list(key_cols)
+    df = df.sort_values(key_cols + [date_col], kind='mergesort').reset_index(drop=True)
+    
+    # Row ranges of each region in the sorted frame
+    group_id = df.groupby(key_cols, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    starts = np.flatnonzero(np.r_[True, group_id[1:] != group_id[:-1]])
+    stops = np.r_[starts[1:], len(df)]
+    sizes = stops - starts
+    group_start, group_stop = np.repeat(starts, sizes), np.repeat(stops, sizes)
+    
+    new_cols, rolled_cols = _daily_and_rolling(lambda col: df[col].to_numpy(dtype=float), starts, group_start, group_stop,
+                                               diff_cols, smooth_cols, windows)
+    
+    if population is not None:
+        if isinstance(population, str):
+            pop = df[population].to_numpy(dtype=float)
+        else:
+            keys = zip(*(df[col].to_numpy()[starts] for col in key_cols))
+            pop = np.repeat(np.array([population.get(key, np.nan) for key in keys], dtype=float), sizes)
+        new_cols['population'] = pop
+        for col in list(smooth_cols) + rolled_cols:
+            values = new_cols[col] if col in new_cols else df[col].to_numpy(dtype=float)
+            new_cols[f'{col}_per100k'] = values / pop * 100000
+        new_cols['reopen_thresh'] = np.ceil(pop * reopen_thresh)
+        for col in rolled_cols:
+            new_cols[f'{col}_below_reopen'] = new_cols[col] <= new_cols['reopen_thresh']
+    
+    return pd.concat([df.drop(columns=[col for col in new_cols if col in df]), pd.DataFrame(new_cols)], axis=1)
@@ -0,0 +1,176 @@
+'''
+Batch SEIR fitting over many regions on a process pool.
+
+Region data is loaded once in the parent process (through the data cache and region 
+store), reduced to the compact arrays a fit needs, and only those arrays are sent to the
+workers.  With a memory-mapped series store (see export_region_series), the workers 
+instead map the store themselves and slice their regions without any copy being sent.
+Each fit's summary is appended to the results table as soon as it finishes, and a region
+that fails (missing data, solver error) is recorded as a failed row rather than stopping
+the batch.
+'''
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from infection_model import get_state_or_county_data, get_region_series_mapped, fit_seir
+import data_loader
+import instrument
+
+# parameters to fit; form: {parameter: (initial guess, minimum value, max value)}
+DEFAULT_PARAMS_INIT_MIN_MAX = {"R_0_start": (3.0, 2.0, 20.0), 
+                               "k": (2.5, 0.01, 5.0), 
+                               "x0": (20, 0, 120), 
+                               "R_0_end": (0.9, 0.3, 8.0)}
+
+# Fit statistics of the results table, in order; the finite-difference path leaves njev and n_rhs empty
+FIT_STAT_COLUMNS = ['nfev', 'njev', 'n_rhs', 'chisqr', 'redchi', 'rmse', 'max_abs_residual', 'success', 'message']
+
+
+def result_columns(params_init_min_max):
+    '''
+    Returns the fixed column order of the results table for a set of fitted parameters.
+    '''
+    return (['state', 'county', 'N', 'n_days'] + list(params_init_min_max) + FIT_STAT_COLUMNS 
+            + ['wall_time', 'status', 'error'])
+
+
+def region_fit_inputs(region, num_days_smooth = 7, fit_days = 40, store_path = None):
+    '''
+    Extracts the arrays a fit needs for one region.
+    
+    INPUT:
+        - region: ('State', 'County') tuple, as for get_state_or_county_data
+        - num_days_smooth: days of the centered rolling mean that is fitted
+        - fit_days: number of leading days of the series to fit
+        - store_path: (Optional) read the region from this memory-mapped series store
+            root (see get_region_series_mapped) instead of the downloaded NYT data
+    OUTPUT: 
+        - infect_data: float array of the smoothed daily infections
+        - N: population of the region
+    '''
+    if store_path is not None:
+        df, N, _ = get_region_series_mapped(region, num_days_smooth, store_path)
+    else:
+        df, N, _ = get_state_or_county_data(region, num_days_smooth)
+    infect_data = df[f'daily_cases_roll{num_days_smooth}mean'].to_numpy(dtype=float)[:fit_days]
+    return np.nan_to_num(infect_data), float(N)
+
+
+def _result_row(region, N, n_days, wall_time, summary=None, error=''):
+    row = {'state': region[0], 'county': region[1], 'N': N, 'n_days': n_days}
+    if summary is not None:
+        row.update(summary['best_values'])
+        row.update({key: value for key, value in summary.items() if key != 'best_values'})
+    row.update({'wall_time': wall_time, 'status': 'failed' if error else 'ok', 'error': error})
+    return row
+
+
+def _fit_worker(region, infect_data, N, params_init_min_max, outbreak_shift, jacobian, profile = False):
+    '''
+    Runs one region's fit in a worker process; exceptions are returned in the row.
+    With profile, also returns this fit's instrumentation report (else None).
+    '''
+    if profile:
+        instrument.enable()
+        instrument.reset()
+    start = time.perf_counter()
+    try:
+        with instrument.tag_region(region):
+            summary = fit_seir(infect_data, N, params_init_min_max, outbreak_shift, jacobian)
+        row = _result_row(region, N, len(infect_data), time.perf_counter() - start, summary)
+    except Exception:
+        row = _result_row(region, N, len(infect_data), time.perf_counter() - start, 
+                          error=traceback.format_exc(limit=3))
+    return row, instrument.report() if profile else None
+
+
+def _mapped_fit_worker(region, store_path, num_days_smooth, fit_days, params_init_min_max, outbreak_shift, 
+                       jacobian, profile = False):
+    '''
+    Reads one region from the mapped series store in the worker, then fits it like _fit_worker.
+    '''
+    try:
+        infect_data, N = region_fit_inputs(region, num_days_smooth, fit_days, store_path)
+    except Exception:
+        return _result_row(region, np.nan, 0, 0.0, error=traceback.format_exc(limit=3)), None
+    return _fit_worker(region, infect_data, N, params_init_min_max, outbreak_shift, jacobian, profile)
+
+
+def fit_regions(regions, params_init_min_max = None, num_days_smooth = 7, fit_days = 40, 
+                outbreak_shift = 0, jacobian = 'finite_difference', max_workers = None, results_path = None, 
+                store_path = None):
+    '''
+    Fits the SEIR model to every region in a list, in parallel.
+    
+    INPUT:
+        - regions: list of ('State', 'County') tuples
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)};
+            defaults to DEFAULT_PARAMS_INIT_MIN_MAX
+        - num_days_smooth: days of the centered rolling mean that is fitted
+        - fit_days: number of leading days of each series to fit
+        - outbreak_shift, jacobian: passed to fit_seir
+        - max_workers: number of worker processes (default: os.cpu_count())
+        - results_path: (Optional) CSV file, truncated at the start, that each result row is 
+            appended to as it arrives (all rows share the result_columns layout)
+        - store_path: (Optional) memory-mapped series store root; workers read their regions 
+            from it directly (see export_region_series)
+    OUTPUT: 
+        - df_results: one row per region with best-fit values, residual statistics,
+            function evaluations, wall time and status ('ok' / 'failed' with the error)
+    '''
+    if params_init_min_max is None:
+        params_init_min_max = DEFAULT_PARAMS_INIT_MIN_MAX
+    columns = result_columns(params_init_min_max)
+    rows = []
+    if results_path is not None:
+        pd.DataFrame(columns=columns).to_csv(results_path, index=False)
+
+    def record(row):
+        rows.append(row)
+        if results_path is not None:
+            pd.DataFrame([row]).reindex(columns=columns).to_csv(results_path, mode='a', index=False, 
+                                                                header=False)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for region in regions:
+            if store_path is not None:
+                future = pool.submit(_mapped_fit_worker, region, store_path, num_days_smooth, fit_days, 
+                                     params_init_min_max, outbreak_shift, jacobian, instrument.enabled())
+                futures[future] = (region, np.nan, 0)
+                continue
+            try:
+                infect_data, N = region_fit_inputs(region, num_days_smooth, fit_days)
+            except Exception:
+                record(_result_row(region, np.nan, 0, 0.0, error=traceback.format_exc(limit=3)))
+                continue
+            future = pool.submit(_fit_worker, region, infect_data, N, params_init_min_max, 
+                                 outbreak_shift, jacobian, instrument.enabled())
+            futures[future] = (region, N, len(infect_data))
+
+        for future in as_completed(futures):
+            try:
+                row, profile = future.result()
+                if profile is not None:
+                    instrument.merge(profile)
+            except Exception:
+                # The worker process itself died (e.g. BrokenProcessPool)
+                region, N, n_days = futures[future]
+                row = _result_row(region, N, n_days, np.nan, error=traceback.format_exc(limit=3))
+            record(row)
+
+    return pd.DataFrame(rows).reindex(columns=columns)
+
+
+if __name__ == "__main__":
+    regions = data_loader.all_states()
+
+    start = time.perf_counter()
+    df_results = fit_regions(regions, results_path=os.path.join(data_loader.DATA_DIR, 'fit_results.csv'))
+    print(df_results[['state', 'R_0_start', 'k', 'x0', 'R_0_end', 'rmse', 'nfev', 'wall_time', 'status']])
+    print(f'{len(regions)} regions in {time.perf_counter() - start:.1f} s')
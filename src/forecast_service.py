@@ -0,0 +1,303 @@
+'''
+Long-running local forecast service.
+
+Keeps region data, fitted SEIR parameters and forecast trajectories in memory and serves
+them as JSON over HTTP (TCP or a Unix socket), using only the standard library on top of
+the modules in this directory.
+
+    python forecast_service.py --port 8750
+    curl 'http://localhost:8750/forecast?state=Colorado&horizon=120'
+    curl 'http://localhost:8750/forecast?state=Colorado&county=Denver&R_0_start=4&k=0.5&x0=30&R_0_end=0.9'
+
+Endpoints:
+    GET  /forecast?state=..&county=..&horizon=..[&R_0_start=..&k=..&x0=..&R_0_end=..]
+         trajectory for the fitted parameters, or for the given parameter set
+    GET  /stats          cache sizes and hit/miss counts
+    GET  /health
+    POST /invalidate?state=..&county=..   drop a region's data, fit and trajectories
+                                           (no state: drop everything)
+
+Each region's fit is cached together with a version of its data (length, last date and
+totals of the series).  The version is re-checked on every request against the data
+cache, which refreshes downloads after COVID_CACHE_MAX_AGE, so new data invalidates the
+region's fit and trajectories.  Trajectories live in a bounded LRU cache keyed by
+(region, data version, horizon, parameters).  Concurrent requests for the same region's
+data, fit or trajectory wait for a single computation instead of repeating it.
+'''
+import argparse
+import json
+import os
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from infection_model import get_region_series, Model, fit_seir, PARAM_NAMES
+from fit_regions import DEFAULT_PARAMS_INIT_MIN_MAX
+
+
+class LRUCache:
+    '''
+    Thread-safe, size-bounded mapping that evicts the least recently used entry.
+    '''
+    def __init__(self, maxsize = 256):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default = None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def discard_if(self, predicate):
+        with self.lock:
+            for key in [key for key in self.data if predicate(key)]:
+                del self.data[key]
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SingleFlight:
+    '''
+    Runs at most one computation per key at a time; concurrent callers share its result.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def run(self, key, compute):
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(compute())
+        except BaseException as err:
+            future.set_exception(err)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return future.result()
+
+
+class ForecastService:
+    '''
+    In-memory store of region fits and trajectories behind the HTTP handler.
+
+    INPUT:
+        - num_days_smooth: days of the centered rolling mean that is fitted
+        - fit_days: number of leading days to fit (None fits the full history)
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)}
+        - max_trajectories: size of the trajectory LRU cache
+    '''
+    def __init__(self, num_days_smooth = 7, fit_days = 40, params_init_min_max = None, max_trajectories = 512):
+        self.num_days_smooth = num_days_smooth
+        self.fit_days = fit_days
+        self.params_init_min_max = DEFAULT_PARAMS_INIT_MIN_MAX if params_init_min_max is None else params_init_min_max
+        self.fits = {}
+        self.fits_lock = threading.Lock()
+        self.trajectories = LRUCache(max_trajectories)
+        self.flights = SingleFlight()
+        self.fit_count = 0
+
+    def region_data(self, region):
+        '''
+        Returns the region's series (shared, read-only), population and data version.
+            Concurrent cold requests for a region share one load (and download).
+        '''
+        def load():
+            df_region, N, _ = get_region_series(region, self.num_days_smooth)
+            last = df_region.iloc[-1]
+            version = (len(df_region), str(last['date']), float(last['cases']), float(last['deaths']))
+            return df_region, N, version
+        return self.flights.run(('data', region), load)
+
+    def fitted(self, region):
+        '''
+        Returns (best_values, N, version) for a region, refitting only when its data changed.
+        '''
+        df_region, N, version = self.region_data(region)
+        with self.fits_lock:
+            cached = self.fits.get(region)
+        if cached is not None and cached['version'] == version:
+            return cached['best_values'], N, version
+        if cached is not None:
+            # New data: everything computed from the old version is stale
+            self.trajectories.discard_if(lambda key: key[0] == region)
+
+        def fit():
+            infect_data = df_region[f'daily_cases_roll{self.num_days_smooth}mean'].to_numpy(dtype=float)
+            if self.fit_days is not None:
+                infect_data = infect_data[:self.fit_days]
+            summary = fit_seir(infect_data, N, self.params_init_min_max, jacobian='sensitivity')
+            with self.fits_lock:
+                self.fits[region] = {'version': version, 'best_values': summary['best_values'],
+                                     'fitted_at': time.time()}
+                self.fit_count += 1
+            return summary['best_values']
+        return self.flights.run(('fit', region, version), fit), N, version
+
+    def forecast(self, region, horizon = 120, params = None):
+        '''
+        Returns the JSON-ready trajectory for a region, from the LRU cache when possible.
+
+        INPUT:
+            - region: ('State', 'County') tuple
+            - horizon: number of days to model from the start of the outbreak (at least 1)
+            - params: (Optional) {R_0_start, k, x0, R_0_end}; default the region's fit
+        '''
+        if horizon < 1:
+            raise ValueError(f'horizon must be at least 1, not {horizon}')
+        if params is None:
+            params, N, version = self.fitted(region)
+        else:
+            _, N, version = self.region_data(region)
+        param_values = tuple(float(params[name]) for name in PARAM_NAMES)
+        key = (region, version, horizon, param_values)
+        response = self.trajectories.get(key)
+        if response is not None:
+            return {**response, 'cached': True}
+
+        def compute():
+            t, S, E, I, R, R_0_t = Model(horizon, N, *param_values)
+            response = {'region': list(region), 'N': float(N), 'horizon': horizon,
+                        'params': dict(zip(PARAM_NAMES, param_values)), 'data_version': list(version),
+                        't': t.tolist(), 'S': S.tolist(), 'E': E.tolist(), 'I': I.tolist(),
+                        'R': R.tolist(), 'R_0_t': np.asarray(R_0_t, dtype=float).tolist()}
+            self.trajectories.put(key, response)
+            return response
+        return {**self.flights.run(('trajectory',) + key, compute), 'cached': False}
+
+    def invalidate(self, region = None):
+        with self.fits_lock:
+            if region is None:
+                self.fits.clear()
+            else:
+                self.fits.pop(region, None)
+        self.trajectories.discard_if(lambda key: region is None or key[0] == region)
+
+    def stats(self):
+        return {'regions_fitted': len(self.fits), 'fits_computed': self.fit_count,
+                'trajectories_cached': len(self.trajectories),
+                'trajectory_hits': self.trajectories.hits, 'trajectory_misses': self.trajectories.misses}
+
+
+class ForecastHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _region(self, query):
+        return (query.get('state', [''])[0], query.get('county', [''])[0])
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path == '/forecast':
+                if 'state' not in query:
+                    return self._send(400, {'error': 'state is required'})
+                params = None
+                if any(name in query for name in PARAM_NAMES):
+                    missing = [name for name in PARAM_NAMES if name not in query]
+                    if missing:
+                        return self._send(400, {'error': f"missing parameters: {', '.join(missing)}"})
+                    params = {name: float(query[name][0]) for name in PARAM_NAMES}
+                horizon = int(query.get('horizon', ['120'])[0])
+                return self._send(200, self.service.forecast(self._region(query), horizon, params))
+            if url.path == '/stats':
+                return self._send(200, self.service.stats())
+            if url.path == '/health':
+                return self._send(200, {'status': 'ok'})
+            return self._send(404, {'error': f'unknown path {url.path}'})
+        except KeyError as err:
+            # Unknown region
+            return self._send(404, {'error': str(err.args[0]) if err.args else repr(err)})
+        except ValueError as err:
+            return self._send(400, {'error': str(err)})
+        except Exception as err:
+            return self._send(500, {'error': repr(err)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path != '/invalidate':
+                return self._send(404, {'error': f'unknown path {url.path}'})
+            self.service.invalidate(self._region(query) if 'state' in query else None)
+            return self._send(200, {'status': 'invalidated'})
+        except Exception as err:
+            return self._send(500, {'error': repr(err)})
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        if os.environ.get('COVID_SERVICE_LOG'):
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def make_server(service, host = '127.0.0.1', port = 8750, socket_path = None):
+    '''
+    Creates (without starting) an HTTP server for a ForecastService, on TCP or a Unix socket.
+    '''
+    handler = type('Handler', (ForecastHandler,), {'service': service})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve SEIR forecasts from memory.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8750)
+    parser.add_argument('--socket', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--max-trajectories', type=int, default=512)
+    args = parser.parse_args()
+
+    server = make_server(ForecastService(max_trajectories=args.max_trajectories), args.host, args.port, args.socket)
+    print(f'Serving forecasts on {args.socket or f"http://{args.host}:{args.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,211 @@
+'''
+Incremental daily update of region time series and warm-started SEIR refits.
+
+For each region the processed frame (as returned by get_state_or_county_data) and the 
+last best-fit parameters are kept in a state directory.  On each run only rows newer than
+the stored frame are appended: their daily differences are taken from the last stored
+cumulative totals, and the centered rolling mean is recomputed only over the trailing
+rows whose window reaches the new data.  Regions whose data did not change are skipped, 
+and refits start from the previous best values instead of the hard-coded guesses.
+
+If earlier rows were revised upstream, the region is recomputed from scratch.
+'''
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from infection_model import get_region_series, add_daily_columns, fit_seir
+from features import add_series_features
+from fit_regions import DEFAULT_PARAMS_INIT_MIN_MAX
+from data_cache import RegionPickleCache
+import data_loader
+
+
+def append_daily_rows(df_cases_region, df_new_rows, num_days = 7):
+    '''
+    Appends new raw rows to a processed region frame, updating the derived columns 
+        only where they change.
+    
+    INPUT:
+        - df_cases_region: processed frame from get_state_or_county_data / add_daily_columns
+        - df_new_rows: raw rows (cumulative 'cases' and 'deaths') dated after the last row
+            of df_cases_region, ordered by date
+        - num_days: number of days of the centered rolling average
+    OUTPUT: 
+        - df_cases_region: frame with the new rows appended; equal to recomputing 
+            add_daily_columns over the full history
+    '''
+    roll_col = f'daily_cases_roll{num_days}mean'
+    n_old = len(df_cases_region)
+    df_new = df_new_rows.reset_index().copy()
+    if n_old == 0:
+        return add_daily_columns(df_new, num_days)
+
+    # Differences from the last stored totals, with the same code as add_daily_columns
+    last = df_cases_region.iloc[-1]
+    new_daily = add_series_features({col: np.r_[float(last[col]), df_new[col].to_numpy(dtype=float)] 
+                                     for col in ('cases', 'deaths')},
+                                    diff_cols={'cases': 'daily_cases', 'deaths': 'daily_deaths'})
+    df_new['daily_cases'] = new_daily['daily_cases'][1:]
+    df_new['daily_deaths'] = new_daily['daily_deaths'][1:]
+
+    # Only the last (num_days - 1) stored rows have windows that reach the new rows; their
+    # windows in turn reach back at most (num_days - 1) rows further
+    n_affected = min(num_days - 1, n_old)
+    n_context = min(2 * (num_days - 1), n_old)
+    daily = np.concatenate((df_cases_region['daily_cases'].to_numpy(dtype=float)[n_old - n_context:], 
+                            df_new['daily_cases'].to_numpy(dtype=float)))
+    rolled = add_series_features({'daily_cases': daily}, smooth_cols=['daily_cases'], 
+                                 windows=(num_days,))[roll_col]
+
+    df_cases_region = df_cases_region.copy()
+    if n_affected:
+        df_cases_region.iloc[n_old - n_affected:, df_cases_region.columns.get_loc(roll_col)] = \
+            rolled[n_context - n_affected:n_context]
+    df_new[roll_col] = rolled[n_context:]
+    return pd.concat([df_cases_region, df_new[df_cases_region.columns]], ignore_index=True)
+
+
+def warm_start_params(params_init_min_max, best_values):
+    '''
+    Replaces the initial guesses with previous best-fit values, clipped to the bounds.
+    '''
+    if not best_values:
+        return dict(params_init_min_max)
+    return {name: (float(np.clip(best_values.get(name, init), mini, maxi)), mini, maxi) 
+            for name, (init, mini, maxi) in params_init_min_max.items()}
+
+
+def data_signature(*arrays):
+    '''
+    Returns a hash of the bytes of arrays, to detect whether fitted data changed.
+    '''
+    digest = hashlib.sha1()
+    for arr in arrays:
+        digest.update(np.ascontiguousarray(arr).tobytes())
+    return digest.hexdigest()
+
+
+def _fit_worker(infect_data, N, params, jacobian):
+    '''
+    Runs fit_seir and times it in the worker, so queueing time is not counted.
+    '''
+    start = time.perf_counter()
+    summary = fit_seir(infect_data, N, params, 0, jacobian)
+    return {**summary, 'wall_time': time.perf_counter() - start}
+
+
+class IncrementalUpdater:
+    '''
+    Keeps per-region processed frames and fits in a state directory and brings them up to date.
+    
+    INPUT:
+        - state_dir: directory holding one pickle per region
+        - num_days_smooth: days of the centered rolling mean that is fitted
+        - fit_days: number of leading days to fit (None fits the full history)
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)}; the
+            guesses are only used for a region's first fit
+        - jacobian: passed to fit_seir
+    '''
+    def __init__(self, state_dir, num_days_smooth = 7, fit_days = None, params_init_min_max = None, 
+                 jacobian = 'sensitivity'):
+        self.state_dir = state_dir
+        self.num_days_smooth = num_days_smooth
+        self.fit_days = fit_days
+        self.params_init_min_max = DEFAULT_PARAMS_INIT_MIN_MAX if params_init_min_max is None else params_init_min_max
+        self.jacobian = jacobian
+        # Stored frames carry the rolling mean of one window size
+        self.cache = RegionPickleCache(state_dir, repr((num_days_smooth,)))
+
+    def update_data(self, region):
+        '''
+        Brings one region's processed frame up to date with the latest (cached) download.
+        
+        OUTPUT: 
+            - state: dict with 'frame', 'N', 'best_values' and 'fit_signature'
+            - status: 'new', 'appended', 'revised' or 'unchanged'
+            - n_new_rows: number of rows appended (or the full length when recomputed)
+        '''
+        df_raw, N, _ = get_region_series(region)
+        state = self.cache.load(region)
+        if state is not None:
+            df_old = state['frame']
+            n_old = len(df_old)
+            # Missing totals (NaN) in an unchanged history compare equal
+            unrevised = (len(df_raw) >= n_old and 
+                         all(np.array_equal(df_raw[col].to_numpy(dtype=float)[:n_old], 
+                                            df_old[col].to_numpy(dtype=float), equal_nan=True)
+                             for col in ('cases', 'deaths')))
+            if unrevised and len(df_raw) == n_old and state['N'] == N:
+                return state, 'unchanged', 0
+            if unrevised:
+                state['frame'] = append_daily_rows(df_old, df_raw.iloc[n_old:], self.num_days_smooth)
+                state['N'] = N
+                return state, 'appended', len(df_raw) - n_old
+        status = 'new' if state is None else 'revised'
+        state = {'best_values': None, 'fit_signature': None} if state is None else state
+        state['frame'] = add_daily_columns(df_raw.reset_index(), self.num_days_smooth)
+        state['N'] = N
+        return state, status, len(df_raw)
+
+    def fit_inputs(self, state):
+        infect_data = state['frame'][f'daily_cases_roll{self.num_days_smooth}mean'].to_numpy(dtype=float)
+        if self.fit_days is not None:
+            infect_data = infect_data[:self.fit_days]
+        infect_data = np.nan_to_num(infect_data)
+        return infect_data, data_signature(infect_data, np.array([state['N']], dtype=float))
+
+    def run(self, regions, max_workers = None):
+        '''
+        Updates every region's data and refits those whose fitted series changed.
+        
+        INPUT:
+            - regions: list of ('State', 'County') tuples
+            - max_workers: worker processes for the refits (default: os.cpu_count())
+        OUTPUT: 
+            - df_summary: one row per region with the data status, rows added, whether it 
+                was refit, best-fit values, function evaluations and wall time
+        '''
+        rows, pending = [], {}
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for region in regions:
+                row = {'state': region[0], 'county': region[1]}
+                try:
+                    state, status, n_new_rows = self.update_data(region)
+                except Exception as err:
+                    rows.append({**row, 'status': 'failed', 'error': repr(err)})
+                    continue
+                row.update(status=status, n_new_rows=n_new_rows, refit=False)
+                infect_data, fit_signature = self.fit_inputs(state)
+                if fit_signature == state['fit_signature'] and state['best_values'] is not None:
+                    if status != 'unchanged':
+                        self.cache.save(region, state)
+                    rows.append({**row, **state['best_values']})
+                    continue
+                params = warm_start_params(self.params_init_min_max, state['best_values'])
+                future = pool.submit(_fit_worker, infect_data, state['N'], params, self.jacobian)
+                pending[future] = (region, state, fit_signature, row)
+
+            for future, (region, state, fit_signature, row) in pending.items():
+                try:
+                    summary = future.result()
+                except Exception as err:
+                    # Keep the updated data; the fit is retried on the next run
+                    self.cache.save(region, state)
+                    rows.append({**row, 'status': 'fit_failed', 'error': repr(err)})
+                    continue
+                state.update(best_values=summary['best_values'], fit_signature=fit_signature)
+                self.cache.save(region, state)
+                rows.append({**row, **summary['best_values'], 'refit': True, 'nfev': summary['nfev'], 
+                             'rmse': summary['rmse'], 'wall_time': summary['wall_time']})
+        return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    updater = IncrementalUpdater(os.path.join(data_loader.DATA_DIR, 'incremental_state'))
+    regions = data_loader.all_states()
+    print(updater.run(regions))
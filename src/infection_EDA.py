@@ -1,48 +1,58 @@
-import math
+import os
 import numpy as np
-import pandas as pd
 
-from datetime import datetime
+from region_store import region_store_for
 
-import matplotlib.pyplot as plt
-from scipy.integrate import odeint
-import statsmodels.api as sm
+import data_loader
+from data_loader import load_state_population
+from infection_rates import open_merge_files, metric_dict
+import instrument
 
-from matplotlib.ticker import MultipleLocator, FormatStrFormatter
-
-plt.style.use('ggplot')
-plt.rcParams.update({'font.size': 12})
-
-from infection_rates import open_merge_files
-
-def plot_state_daily_data(state_list, metric = 'infection'):
-    metric_dict = {'infection' : ['positive_daily_incr', 'Infections', 'Infection Counts', 'infection_counts'],
-                   'hospitalized' : ['hospitalized_daily_incr', 'Hospitializations', 'Hospitializations', 'hospitializations'],
-                   'death' : ['death_daily_incr', 'Deaths', 'Deaths', 'deaths']}
+def plot_state_daily_data(state_list, metric = 'infection', df_usa = None, show = True):
+    '''
+    Plots daily counts of a metric, one panel per state, and saves the plot to IMAGES_DIR.
+    
+    INPUT:
+        - state_list: state abbreviations
+        - metric: 'infection', 'hospitalized' or 'death'
+        - df_usa: merged frame from open_merge_files (default: loaded from DATA_DIR)
+        - show: call plt.show(); see render_batch.render_infection_trends to render headless
+    OUTPUT: 
+        - fig: the saved figure
+    '''
+    import matplotlib.pyplot as plt
+    plt.style.use('ggplot')
+    plt.rcParams.update({'font.size': 12})
+    if df_usa is None:
+        df_usa = open_merge_files(os.path.join(data_loader.DATA_DIR, 'us_states_covid19_daily.csv'), 
+                                  load_state_population())
     plt_row = np.maximum(len(state_list) // 2, 1)
     if len(state_list) > 1:
         plt_cl = 2
     else:
         plt_cl = 1
     fig_sz_rw = 2 + 3 * plt_row
-    fig, axes = plt.subplots(plt_row,plt_cl,figsize = (15,fig_sz_rw), sharex=True, sharey=True)
+    fig, axes = plt.subplots(plt_row,plt_cl,figsize = (15,fig_sz_rw), sharex=True, sharey=True, squeeze=False)
     for ax, state in zip(axes.flat, state_list):
-        df2 = df_usa[df_usa['state_id']==state]
+        df2 = region_store_for(df_usa, 'state_id', 'd_o_y').slice(state)
         ax.bar(df2.d_o_y, df2[metric_dict[metric][0]], label = f"{state}")
         ax.legend(loc='upper left')
         ax.set_xlabel('Day of Year (2020)') 
         ax.set_ylabel(f'Reported {metric_dict[metric][1]}') 
         ax.label_outer()
     plt.suptitle(f'{metric_dict[metric][2]} By Day of Year, By State', fontsize=16, y = 0.95)
-    plt.show()
+    if show:
+        plt.show()
     states_str = "-".join(state_list)
-    fig.savefig(f"../images/{metric_dict[metric][3]}_by_doy-{states_str}.png", dpi=250)
+    with instrument.stage('savefig', states_str):
+        fig.savefig(os.path.join(data_loader.IMAGES_DIR, f"{metric_dict[metric][3]}_by_doy-{states_str}.png"), dpi=250)
+    return fig
 
 
 if __name__ == "__main__":
-    df_usa_pop = pd.read_csv('../data/us_state_population_2019.csv')
-    df_usa = open_merge_files('../data/us_states_covid19_daily.csv', df_usa_pop)
+    df_usa = open_merge_files(os.path.join(data_loader.DATA_DIR, 'us_states_covid19_daily.csv'), 
+                              load_state_population())
     
-    plot_state_daily_data(['NY', 'NJ'], metric = 'infection')
-    plot_state_daily_data(['CO', 'FL', 'CA', 'MO'], metric = 'infection')
-    plot_state_daily_data(['NY', 'NJ'], metric = 'death')
+    plot_state_daily_data(['NY', 'NJ'], metric = 'infection', df_usa = df_usa)
+    plot_state_daily_data(['CO', 'FL', 'CA', 'MO'], metric = 'infection', df_usa = df_usa)
+    plot_state_daily_data(['NY', 'NJ'], metric = 'death', df_usa = df_usa)
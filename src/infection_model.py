@@ -1,99 +1,292 @@
 import math
+import os
 import numpy as np
 import pandas as pd
 
-from datetime import datetime
-from datetime import date
+from data_cache import fetch_csv
+from region_store import RegionStore, region_store_for, population_index_for, memoize_for_frame
+from features import add_region_features, add_series_features, REOPEN_THRESH
+from series_store import write_series_store, open_series_store
+import data_loader
+from data_loader import load_covid_tracking, load_state_population
+import instrument
 
-import matplotlib.pyplot as plt
-from scipy.integrate import odeint
-import statsmodels.api as sm
+# scipy, matplotlib and lmfit are imported by the functions that integrate, fit or plot, so 
+# that data-only code paths start without them (see cli.py)
+font_size = 14
 
-from matplotlib.ticker import MultipleLocator, FormatStrFormatter
+def _pyplot():
+    '''
+    Imports pyplot (on first use) with the plot style applied.
+    '''
+    import matplotlib.pyplot as plt
+    plt.style.use('ggplot')
+    plt.rcParams.update({'font.size': font_size})
+    return plt
 
-import pymc3 as pm
-from pymc3.ode import DifferentialEquation
-import arviz as az
-import theano
+# Default SEIR rates; overridden in __main__ when experimenting
+D = 4.0 # infections last 4 days
+gamma = 1.0 / D
+delta = 1.0 / 3 # incubation period of 3 days
 
+# Parameters of the logistic R_0 transition (see logistic_R_0), in the order Model takes them
+PARAM_NAMES = ['R_0_start', 'k', 'x0', 'R_0_end']
 
-import lmfit
-from lmfit.lineshapes import gaussian, lorentzian
+# Source files; override with COVID_NYT_STATES_URL / COVID_NYT_COUNTIES_URL / COVID_CENSUS_URL (e.g. a mirror)
+NYT_STATES_URL = os.environ.get('COVID_NYT_STATES_URL', 
+                                'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-states.csv')
+NYT_COUNTIES_URL = os.environ.get('COVID_NYT_COUNTIES_URL', 
+                                  'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv')
+CENSUS_COUNTIES_URL = os.environ.get('COVID_CENSUS_URL', 
+                                     'https://www2.census.gov/programs-surveys/popest/datasets/2010-2019/counties/totals/co-est2019-alldata.csv')
 
-plt.style.use('ggplot')
-font_size = 14
-plt.rcParams.update({'font.size': font_size})
+# Memory-mapped region series written by export_region_series (one subdirectory per level)
+SERIES_STORE_DIR = os.environ.get('COVID_SERIES_STORE', os.path.join(data_loader.DATA_DIR, 'series_store'))
 
 
 # Get data
-def get_state_or_county_data(region, num_days = 7):
+def region_feature_store(df_cases, key_cols, num_days = 7):
     '''
-    Extracts the daily and cumulative totals of infections and deaths for a given region,
-        as well as population for that region.  
+    Returns a RegionStore over a national NYT frame with 'daily_cases', 'daily_deaths' and
+        'daily_cases_roll{num_days}mean' computed for every region in one pass (see features.py).
+        Built once per downloaded frame and num_days.
+    '''
+    key_cols = tuple(key_cols)
+    def build():
+        df_features = add_region_features(df_cases, key_cols, 'date', 
+                                           diff_cols={'cases': 'daily_cases', 'deaths': 'daily_deaths'},
+                                           smooth_cols=['daily_cases'], windows=(num_days,))
+        return RegionStore(df_features, key_cols, 'date')
+    return memoize_for_frame(df_cases, ('features', key_cols, num_days), build)
+
+def get_region_series(region, num_days = None):
+    '''
+    Looks up the raw cumulative NYT time series and the population for a given region.
     
     INPUT:
-        - region: A tuple for the region of interest, of the form ('State':'County').
-            The County should not have the term 'County' in it.
-            Data for the entire state can be extracted by listing the 'Entire State' for the county.
-        - num_days: number of days to apply centered rolling average
+        - region: as for get_state_or_county_data
+        - num_days: (Optional) if given, the series also carries the daily and rolling-mean
+            columns, precomputed for all regions by region_feature_store
     OUTPUT: 
-        - df_cases_deaths: A Pandas dataframe with time series of infections 
-            and deaths (total and daily) for the specified region
+        - df_region: the region's rows of the national frame, ordered by date.  It is a 
+            slice of a shared frame, so copy it before modifying.
         - region_pop: (Int64) Population (2019 estimate) for the specified region 
+        - date_range: (first date plotted, latest date in the national data)
     '''
     def get_full_date_range(df):
-        df['date'] = pd.to_datetime(df.date, format = "%Y/%m/%d")
         date_range = (pd.Timestamp('2020-03-01'), df['date'].max())
         return date_range
     
+    # Downloads go through the local cache (see data_cache.py); frames are shared, so only slice them.
+    # Regions are looked up in a store indexed once per downloaded frame (see region_store.py).
     if region[1]=='Entire State' or region[1]=='':
-        df_cases = pd.read_csv('https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-states.csv')
+        df_cases = fetch_csv(NYT_STATES_URL, parse_dates=['date'], dtype={'fips': str})
         date_range = get_full_date_range(df_cases)
-        df_cases_region = df_cases.loc[(df_cases['state']==region[0])].reset_index()
+        region_key = (region[0],)
+        key_cols = ('state',)
         county_popul = region[0]
     else:
-        df_cases = pd.read_csv('https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv')
+        df_cases = fetch_csv(NYT_COUNTIES_URL, parse_dates=['date'], dtype={'fips': str})
         date_range = get_full_date_range(df_cases)
-        df_cases_region = df_cases.loc[(df_cases['state']==region[0]) & (df_cases['county'].str.startswith(region[1]))].reset_index()
-        county_popul = region[1] + ' County'
-    
-    df_cases_region['daily_cases'] = df_cases_region['cases'] - df_cases_region['cases'].shift(1)
-    df_cases_region['daily_cases'].fillna(value=0, inplace=True)
-    df_cases_region['daily_deaths'] = df_cases_region['deaths'] - df_cases_region['deaths'].shift(1)
-    df_cases_region['daily_deaths'].fillna(value=0, inplace=True)
-    df_cases_region[f'daily_cases_roll{num_days}mean'] = df_cases_region['daily_cases'].rolling(window=num_days, center = True).mean()
+        county = region[1][:-len(' County')] if region[1].endswith(' County') else region[1]
+        region_key = (region[0], county)
+        key_cols = ('state', 'county')
+        county_popul = county + ' County'
+    if num_days is None:
+        store = region_store_for(df_cases, key_cols, 'date')
+    else:
+        store = region_feature_store(df_cases, key_cols, num_days)
+    if region_key not in store:
+        raise KeyError(f'No case data for region {region}')
+    
+    df_pop = fetch_csv(CENSUS_COUNTIES_URL, encoding='latin-1', 
+                       usecols=['STNAME', 'CTYNAME', 'POPESTIMATE2019'])
+    region_pop = population_index_for(df_pop, ('STNAME', 'CTYNAME'), 'POPESTIMATE2019')[(region[0], county_popul)]
+    
+    return store.slice(region_key), region_pop, date_range
+
+def region_populations(level = 'state', states = None):
+    '''
+    Lists every state, or every county, with its population from the census table
+        used by get_region_series.
+
+    INPUT:
+        - level: 'state' or 'county'
+        - states: (Optional) only include these states (or their counties)
+    OUTPUT:
+        - regions: list of ('State', '') or ('State', 'County') tuples, as for
+            get_state_or_county_data
+        - populations: float array of the regions' populations (2019 estimate)
+    '''
+    if level not in ('state', 'county'):
+        raise ValueError(f"level must be 'state' or 'county', not {level!r}")
+    df_pop = fetch_csv(CENSUS_COUNTIES_URL, encoding='latin-1',
+                       usecols=['STNAME', 'CTYNAME', 'POPESTIMATE2019'])
+    df_pop = df_pop[df_pop['STNAME'] != 'United States']
+    if states is not None:
+        df_pop = df_pop[df_pop['STNAME'].isin(states)]
+    # Each state's total row comes before its counties (CTYNAME == STNAME, also for DC)
+    state_rows = ~df_pop.duplicated('STNAME')
+    df_pop = df_pop[state_rows] if level == 'state' else df_pop[~state_rows]
+    if level == 'state':
+        regions = [(state, '') for state in df_pop['STNAME']]
+    else:
+        regions = [(state, county[:-len(' County')] if county.endswith(' County') else county)
+                   for state, county in zip(df_pop['STNAME'], df_pop['CTYNAME'])]
+    return regions, df_pop['POPESTIMATE2019'].to_numpy(dtype=float)
+
+def export_region_series(level = 'state', path = None, tracking_path = None):
+    '''
+    Writes cases, deaths, hospitalizations and tests of every state (or county) to a
+        memory-mapped series store (see series_store.py), for get_region_series_mapped.
+    
+    INPUT:
+        - level: 'state' or 'county'
+        - path: (Optional) store root; default SERIES_STORE_DIR.  The level is a subdirectory.
+        - tracking_path: (Optional) COVID Tracking Project file for state hospitalizations
+            and tests (see data_loader.load_covid_tracking); counties have none (NaN)
+    OUTPUT: 
+        - store_path: the directory written
+    '''
+    if level not in ('state', 'county'):
+        raise ValueError(f"level must be 'state' or 'county', not {level!r}")
+    store_path = os.path.join(SERIES_STORE_DIR if path is None else path, level)
+    df_pop = fetch_csv(CENSUS_COUNTIES_URL, encoding='latin-1', 
+                       usecols=['STNAME', 'CTYNAME', 'POPESTIMATE2019'])
+    census = population_index_for(df_pop, ('STNAME', 'CTYNAME'), 'POPESTIMATE2019')
+    if level == 'state':
+        df_cases = fetch_csv(NYT_STATES_URL, parse_dates=['date'], dtype={'fips': str})
+        df_tracking = load_covid_tracking(tracking_path, columns=['hospitalized', 'totalTestResults'])
+        df_state_pop = load_state_population()
+        abbr_to_name = dict(zip(df_state_pop['ABBR'], df_state_pop['NAME']))
+        df_tracking = pd.DataFrame({'state': df_tracking['state'].astype(str).map(abbr_to_name), 
+                                    'date': df_tracking['datetime'], 
+                                    'hospitalized': df_tracking['hospitalized'], 
+                                    'tests': df_tracking['totalTestResults']})
+        df = df_cases[['state', 'date', 'cases', 'deaths']].merge(df_tracking, on=['state', 'date'], how='left')
+        key_cols = ['state']
+        populations = {(state,): census.get((state, state)) for state in df['state'].unique()}
+    else:
+        df = fetch_csv(NYT_COUNTIES_URL, parse_dates=['date'], dtype={'fips': str})[['state', 'county', 'date', 'cases', 'deaths']]
+        df = df.assign(hospitalized=np.nan, tests=np.nan)
+        key_cols = ['state', 'county']
+        populations = {key: census.get((key[0], key[1] + ' County')) 
+                       for key in df[key_cols].drop_duplicates().itertuples(index=False, name=None)}
+    metrics = {'cases': 'cases', 'deaths': 'deaths', 'hospitalized': 'hospitalized', 'tests': 'tests'}
+    with instrument.stage('export_region_series'):
+        return write_series_store(store_path, df, key_cols, 'date', metrics, populations)
+
+def get_region_series_mapped(region, num_days = None, path = None):
+    '''
+    Like get_region_series, but reads the memory-mapped store written by export_region_series.
+        The cumulative columns are views of the mapped file (no copy, shared between processes); 
+        with num_days the daily and rolling-mean columns are computed for this region only, 
+        with the same code as the national frames (see features.add_series_features).
+    
+    INPUT:
+        - region, num_days: as for get_region_series
+        - path: (Optional) store root; default SERIES_STORE_DIR
+    OUTPUT: 
+        - df_region: 'date', 'cases', 'deaths', 'hospitalized', 'tests' (and, with num_days, 
+            'daily_cases', 'daily_deaths', 'daily_cases_roll{num_days}mean'); read-only
+        - region_pop, date_range: as for get_region_series
+    '''
+    root = SERIES_STORE_DIR if path is None else path
+    if region[1]=='Entire State' or region[1]=='':
+        store, key = open_series_store(os.path.join(root, 'state')), (region[0],)
+    else:
+        county = region[1][:-len(' County')] if region[1].endswith(' County') else region[1]
+        store, key = open_series_store(os.path.join(root, 'county')), (region[0], county)
+    if key not in store:
+        raise KeyError(f'No case data for region {region}')
+    
+    daily_columns = {}
+    if num_days is not None:
+        daily_columns = add_series_features({metric: store.series(key, metric) for metric in ('cases', 'deaths')},
+                                            diff_cols={'cases': 'daily_cases', 'deaths': 'daily_deaths'},
+                                            smooth_cols=['daily_cases'], windows=(num_days,))
+    df_region = store.frame(key, daily_columns)
+    date_range = (pd.Timestamp('2020-03-01'), pd.Timestamp(store.dates[-1]))
+    return df_region, store.population(key), date_range
+
+def add_daily_columns(df_cases_region, num_days = 7):
+    '''
+    Adds daily infections and deaths (differences of the cumulative totals) and the centered
+        rolling mean of daily infections to a single region's time series.
+    
+    INPUT:
+        - df_cases_region: one region's rows with cumulative 'cases' and 'deaths', ordered by date
+        - num_days: number of days to apply centered rolling average
+    OUTPUT: 
+        - df_cases_region: a new frame with 'daily_cases', 'daily_cases_roll{num_days}mean'
+            and 'daily_deaths' added (see features.add_series_features), and the cumulative 
+            columns moved to the end
+    '''
+    new_cols = add_series_features({col: df_cases_region[col].to_numpy(dtype=float) for col in ('cases', 'deaths')},
+                                   diff_cols={'cases': 'daily_cases', 'deaths': 'daily_deaths'},
+                                   smooth_cols=['daily_cases'], windows=(num_days,))
+    df_cases_region = df_cases_region.assign(**new_cols)
    
     cols_to_move = ['cases', 'daily_deaths','deaths']
-    df_cases_region = df_cases_region[[ col for col in df_cases_region.columns if col not in cols_to_move] + cols_to_move]
-    
-    df_pop = pd.read_csv('https://www2.census.gov/programs-surveys/popest/datasets/2010-2019/counties/totals/co-est2019-alldata.csv', encoding='latin-1')
-    region_pop = df_pop.loc[(df_pop['STNAME']==region[0]) & (df_pop['CTYNAME']==county_popul), 'POPESTIMATE2019'].values[0]
+    return df_cases_region[[ col for col in df_cases_region.columns if col not in cols_to_move] + cols_to_move]
+
+def get_state_or_county_data(region, num_days = 7):
+    '''
+    Extracts the daily and cumulative totals of infections and deaths for a given region,
+        as well as population for that region.  
     
+    INPUT:
+        - region: A tuple for the region of interest, of the form ('State':'County').
+            The County should not have the term 'County' in it, and must match the county
+            name exactly (e.g., 'Washington' does not select 'Washington Parish').
+            Data for the entire state can be extracted by listing the 'Entire State' for the county.
+        - num_days: number of days to apply centered rolling average
+    OUTPUT: 
+        - df_cases_deaths: A Pandas dataframe with time series of infections 
+            and deaths (total and daily) for the specified region
+        - region_pop: (Int64) Population (2019 estimate) for the specified region 
+    '''
+    with instrument.tag_region(region), instrument.stage('get_state_or_county_data'):
+        df_region, region_pop, date_range = get_region_series(region, num_days)
+        df_cases_region = df_region.reset_index()
+        
+        cols_to_move = ['cases', 'daily_deaths','deaths']
+        df_cases_region = df_cases_region[[ col for col in df_cases_region.columns if col not in cols_to_move] + cols_to_move]
+        instrument.count('rows_processed', len(df_cases_region))
     return df_cases_region, region_pop, date_range
 
 
-def plot_region_infections(df, states_pop, date_range, region_init, num_days_smooth = 7, save_fig = False):
+def region_label(region):
+    '''
+    Returns the display label of a ('State', 'County') region tuple.
+    '''
+    if region[1] == 'Entire State' or region[1] == '':
+        return f'{region[0]} (Full State)'
+    return f'{region[1]} County, {region[0]}'
+
+def plot_region_infections(df, states_pop, date_range, region_init, num_days_smooth = 7, save_fig = False, 
+                           show = True):
     '''
     Plots the infections of a region over time wiht a smooth fit and a reopen target threshold.
     
     INPUT:
-        - df:
-        - states_pop:
-        - date_range:
-        - region_init:
-        - num_days_smooth: 
-        - save_fig:
+        - df: region data from get_state_or_county_data
+        - states_pop: population of the region, used for the reopen threshold
+        - date_range: (first, last) dates shown
+        - region_init: ('State', 'County') tuple of the region
+        - num_days_smooth: days of the centered rolling mean plotted
+        - save_fig: save the plot to IMAGES_DIR (see data_loader.py)
+        - show: call plt.show(); see render_batch.py to render many regions headless
     OUTPUT: 
-        - Plot of infections over time
+        - fig: the figure of infections over time
         - (Optional) Plot saved as a .png file.
     '''
+    plt = _pyplot()
     fig, ax = plt.subplots(figsize = (12,6))
 
-    if region_init[1] == 'Entire State' or region_init[1] == '':
-        label_text = f'{region_init[0]} (Full State)'
-    else:
-        label_text = f'{region_init[1]} County, {region_init[0]}'
+    label_text = region_label(region_init)
     latest_data_pull = max(df.date).strftime("%y_%m_%d")
+    state_reopen_thresh = math.ceil(states_pop * REOPEN_THRESH)
 
     plt.plot(df.date, df[f'daily_cases_roll{num_days_smooth}mean'], 
              label = f"{label_text}: {num_days_smooth}-Day Smooth", color='blue')
@@ -107,9 +300,29 @@ def plot_region_infections(df, states_pop, date_range, region_init, num_days_smo
     plt.xlim(date_range[0], date_range[1])
     plt.xticks(np.arange(date_range[0], max(df.date) + pd.DateOffset(1), 1000000*60*60*24*30))
     plt.suptitle(f'Infection Counts By Date - {label_text}', fontsize=16, y = 0.95)
-    plt.show()
+    if show:
+        plt.show()
     if save_fig:
-        fig.savefig(f'../images/daily_infection_rates_target_{label_text.replace(" ", "_")}_{latest_data_pull}.png', dpi=250)
+        with instrument.stage('savefig', region_init):
+            fig.savefig(os.path.join(data_loader.IMAGES_DIR, 
+                                     f'daily_infection_rates_target_{label_text.replace(" ", "_")}_{latest_data_pull}.png'), 
+                        dpi=250)
+    return fig
+
+def integrate(func, y0, t, **kwargs):
+    '''
+    Calls odeint; when instrumentation is on, also records the RHS and Jacobian evaluations
+        and solver steps it took (see instrument.py).
+    '''
+    from scipy.integrate import odeint
+    if not instrument.enabled():
+        return odeint(func, y0, t, **kwargs)
+    with instrument.stage('odeint'):
+        ret, info = odeint(func, y0, t, full_output=True, **kwargs)
+    instrument.count(f'{func.__name__}_evals', int(info['nfe'][-1]))
+    instrument.count('jacobian_evals', int(info['nje'][-1]))
+    instrument.count('solver_steps', int(info['nst'][-1]))
+    return ret
 
 def deriv_seir(y, t, N, beta, gamma, delta):
     '''
@@ -139,6 +352,22 @@ def deriv_seir(y, t, N, beta, gamma, delta):
     
     return dSdt, dEdt, dIdt, dRdt
 
+def deriv_seir_jac(y, t, N, beta, gamma, delta):
+    '''
+    Analytic Jacobian of deriv_seir with respect to (S, E, I, R), for use as odeint's Dfun.
+    
+    INPUT:
+        - same as deriv_seir
+    OUTPUT: 
+        - jac: 4x4 array, jac[i][j] = d(dy_i/dt) / dy_j
+    '''
+    S, E, I, _ = y
+    b = beta(t) / N
+    return np.array([[-b * I, 0,      -b * S, 0],
+                     [ b * I, -delta,  b * S, 0],
+                     [ 0,      delta, -gamma, 0],
+                     [ 0,      0,      gamma, 0]])
+
 def logistic_R_0(t, R_0_start, k, x0, R_0_end):
     '''
     Models the expected change in R_0 (R-naught) from a behavior change event (e.g., lockdown or opening up)
@@ -194,12 +423,86 @@ def Model(days, N, R_0_start, k, x0, R_0_end):
     t = np.linspace(0,days-1,days)
     
     # Integrate the SIR equations over the time grid, t.
-    ret = odeint(deriv_seir, y0, t, args=(N, beta, gamma, delta))
+    ret = integrate(deriv_seir, y0, t, args=(N, beta, gamma, delta), Dfun=deriv_seir_jac)
     S, E, I, R = ret.T
     R_0_t = [beta(i)/gamma for i in range(len(t))]
     return t, S, E, I, R, R_0_t
 
-def plot_generic(t, S, E, I, R, R_0, x_ticks=None):
+def deriv_seir_ensemble(y, t, N, R_0_start, k, x0, R_0_end, gamma, delta):
+    '''
+    Calculates the net change in population for each compartment of the SEIR model
+        for every member of an ensemble at a given time t.
+    
+    INPUT:
+        - y:     flat array of length 4*M, packed member by member as (S, E, I, R)
+        - t:     the time at which the rates will be calculated
+        - N:     array (M,) of total populations for each member
+        - R_0_start, k, x0, R_0_end: arrays (M,) of logistic R_0 parameters per member
+        - gamma: the fraction of infected people recovering per day
+        - delta: the fraction of exposed people becoming infected per day
+    OUTPUT: 
+        - dydt: flat array of length 4*M with (dSdt, dEdt, dIdt, dRdt) for each member
+    '''
+    y = y.reshape(-1, 4)
+    S, E, I = y[:, 0], y[:, 1], y[:, 2]
+    new_exposed = logistic_R_0(t, R_0_start, k, x0, R_0_end) * gamma * S * I / N
+
+    dydt = np.empty_like(y)
+    dydt[:, 0] = -new_exposed
+    dydt[:, 1] = new_exposed - delta * E
+    dydt[:, 2] = delta * E - gamma * I
+    dydt[:, 3] = gamma * I
+    return dydt.ravel()
+
+def Model_ensemble(days, N, R_0_start, k, x0, R_0_end):
+    '''
+    Creates the SEIR model for an ensemble of parameter sets and populations, 
+        integrated together in a single odeint call.
+    
+    The members are independent, so the Jacobian of the stacked system is block 
+        diagonal with 4x4 blocks; odeint is told it is banded so the solver cost
+        grows linearly with the ensemble size.
+    
+    INPUT:
+        - days: number of days to model
+        - N: population(s); scalar or array broadcastable against the parameters
+        - R_0_start, k, x0, R_0_end: scalars or arrays of logistic R_0 parameters.
+            All inputs are broadcast to a common ensemble size M.
+    OUTPUT: 
+        - t: the times at which the compartments were calculated, shape (days,)
+        - y: array (M, days, 4) with the S, E, I and R time series of each member
+        - R_0_t: array (M, days) with the R_0 transition of each member
+    '''
+    N, R_0_start, k, x0, R_0_end = [np.ravel(arr).astype(float) for arr in 
+                                    np.broadcast_arrays(N, R_0_start, k, x0, R_0_end)]
+    n_members = len(N)
+    
+    # Initial conditions, one (S, E, I, R) row per member
+    y0 = np.zeros((n_members, 4))
+    y0[:, 0] = N - 1
+    y0[:, 1] = 1
+    t = np.linspace(0,days-1,days)
+    
+    ret = integrate(deriv_seir_ensemble, y0.ravel(), t, 
+                 args=(N, R_0_start, k, x0, R_0_end, gamma, delta), ml=3, mu=3)
+    y = ret.reshape(days, n_members, 4).transpose(1, 0, 2)
+    R_0_t = logistic_R_0(t[np.newaxis, :], R_0_start[:, np.newaxis], k[:, np.newaxis], 
+                         x0[:, np.newaxis], R_0_end[:, np.newaxis])
+    return t, y, R_0_t
+
+def plot_generic(t, S, E, I, R, R_0, x_ticks=None, show = True):
+    '''
+    Plots SEIR compartment curves and, in a second figure, R_0 over time.
+    
+    INPUT:
+        - t, S, E, I, R, R_0: as returned by Model
+        - x_ticks: (Optional) dates plotted instead of t
+        - show: call plt.show(); see render_batch.seir_curve_spec to render headless
+    OUTPUT: 
+        - fig_curves, fig_R_0: the two figures
+    '''
+    plt = _pyplot()
+    import matplotlib.dates as mdates
     # general SEIR curves
     f, ax = plt.subplots(1,1,figsize=(20,4))
     if x_ticks is None:
@@ -220,12 +523,14 @@ def plot_generic(t, S, E, I, R, R_0, x_ticks=None):
         
     ax.title.set_text('extended SEIR-Model')
 
-    ax.grid(b=True, which='major', c='w', lw=2, ls='-')
+    ax.grid(visible=True, which='major', c='w', lw=2, ls='-')
     legend = ax.legend()
     legend.get_frame().set_alpha(0.5)
     for spine in ('top', 'right', 'bottom', 'left'):
         ax.spines[spine].set_visible(False)
-    plt.show();
+    if show:
+        plt.show();
+    fig_curves = f
     
     # Plot R_0_t
     f = plt.figure(figsize=(20,4))
@@ -240,46 +545,233 @@ def plot_generic(t, S, E, I, R, R_0, x_ticks=None):
         f.autofmt_xdate()
 
     ax1.title.set_text('R_0 over time')
-    ax1.grid(b=True, which='major', c='w', lw=2, ls='-')
+    ax1.grid(visible=True, which='major', c='w', lw=2, ls='-')
     legend = ax1.legend()
     legend.get_frame().set_alpha(0.5)
     for spine in ('top', 'right', 'bottom', 'left'):
-        ax.spines[spine].set_visible(False)
-    plt.show();
+        ax1.spines[spine].set_visible(False)
+    if show:
+        plt.show();
+    return fig_curves, f
 
-def lmfit(params_init_min_max, outbreak_shift = 0):
-    R_0_start, k, x0, R_0_end = params_init_min_max
-    infect_data = df_cases_region[f'daily_cases_roll{num_days_smooth}mean'][0:40]
-    infect_data.fillna(value=0, inplace=True)
-    days = outbreak_shift + len(infect_data)
+def fit_seir_result(infect_data, N, params_init_min_max, outbreak_shift = 0, max_nfev = None):
+    '''
+    Fits the SEIR infected curve to an observed infection series with lmfit (least_squares).
+    
+    INPUT:
+        - infect_data: array of observed (smoothed) daily infections; NaNs are treated as 0
+        - N: population of the region
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)}
+            for R_0_start, k, x0 and R_0_end
+        - outbreak_shift: days of zero infections to prepend (positive) or
+            leading days of data to drop (negative)
+        - max_nfev: (Optional) cap on function evaluations (default: run to convergence)
+    OUTPUT: 
+        - result: the lmfit ModelResult
+    '''
+    infect_data = np.nan_to_num(np.asarray(infect_data, dtype=float))
     if outbreak_shift >= 0:
         y_data = np.concatenate((np.zeros(outbreak_shift), infect_data))
     else:
-        y_data = y_data[-outbreak_shift:]
+        y_data = infect_data[-outbreak_shift:]
+    days = len(y_data)
     x_data = np.linspace(0, days - 1, days, dtype=int)
     
     def fitter(x, R_0_start, k, x0, R_0_end):
         ret = Model(days, N, R_0_start, k, x0, R_0_end)
-        return ret[3][x]
+        return ret[3][np.asarray(x, dtype=int)]
     
-    mod = lmfit.Model(fitter)
+    from lmfit import Model as LmfitModel
+    mod = LmfitModel(fitter)
     for kwarg, (init, mini, maxi) in params_init_min_max.items():
         mod.set_param_hint(str(kwarg), value=init, min=mini, max=maxi, vary=True)
     params = mod.make_params()
-    fit_method = "leastsq"
-    result = mod.fit(y_data, params, method="least_squares", x=x_data)
+    return mod.fit(y_data, params, method="least_squares", x=x_data, max_nfev=max_nfev)
+
+def summarize_fit(result):
+    '''
+    Condenses an lmfit ModelResult into a small, picklable dict of best values and fit statistics.
+    '''
+    residual = np.asarray(result.residual)
+    return {'best_values': dict(result.best_values),
+            'nfev': result.nfev,
+            'chisqr': result.chisqr,
+            'redchi': result.redchi,
+            'rmse': float(np.sqrt(np.mean(residual**2))),
+            'max_abs_residual': float(np.max(np.abs(residual))),
+            'success': result.success,
+            'message': result.message}
+
+def fit_seir(infect_data, N, params_init_min_max, outbreak_shift = 0, jacobian = 'finite_difference', 
+             max_nfev = None):
+    '''
+    Fits the SEIR model to an infection series and returns summarize_fit's dict.
+    
+    jacobian selects the fitting path: 'finite_difference' (lmfit, see fit_seir_result) or
+        'sensitivity' (exact Jacobian, see fit_seir_sensitivity).
+    '''
+    if jacobian not in ('finite_difference', 'sensitivity'):
+        raise ValueError(f"jacobian must be 'finite_difference' or 'sensitivity', not {jacobian!r}")
+    with instrument.stage('fit'):
+        if jacobian == 'sensitivity':
+            summary = fit_seir_sensitivity(infect_data, N, params_init_min_max, outbreak_shift, max_nfev)
+        else:
+            summary = summarize_fit(fit_seir_result(infect_data, N, params_init_min_max, outbreak_shift, 
+                                                    max_nfev))
+    instrument.count('fits')
+    instrument.count('fit_evaluations', summary['nfev'])
+    return summary
+
+def deriv_seir_sensitivity(y, t, N, R_0_start, k, x0, R_0_end, gamma, delta):
+    '''
+    Calculates the SEIR rates together with the forward sensitivities of the compartments
+        to the logistic R_0 parameters (R_0_start, k, x0, R_0_end).
+    
+    For each parameter p the sensitivity s_p = dy/dp obeys ds_p/dt = J(y, t) s_p + df/dp,
+        where J is deriv_seir_jac; only the new-exposure term depends on p.
+    
+    INPUT:
+        - y: flat array of 20 values; a row-major 4x5 matrix with one row per compartment
+            (S, E, I, R) holding the compartment followed by its sensitivities to 
+            (R_0_start, k, x0, R_0_end)
+        - t: the time at which the rates will be calculated
+        - N, R_0_start, k, x0, R_0_end, gamma, delta: as for Model / deriv_seir
+    OUTPUT: 
+        - dydt: flat array of 20 values packed like y
+    '''
+    y = y.reshape(4, 5)
+    S, I = y[0, 0], y[2, 0]
+    
+    # Logistic function in its overflow-free tanh form
+    sigma = 0.5 * (1 + np.tanh(0.5 * k * (x0 - t)))
+    R_0_t = (R_0_start - R_0_end) * sigma + R_0_end
+    dsigma = (R_0_start - R_0_end) * sigma * (1 - sigma)
+    
+    # J @ y gives the sensitivity rates up to the explicit parameter dependence, and for the
+    # state column counts the bilinear new-exposure term b*S*I twice; correct both at once
+    rates = deriv_seir_jac((S, 0, I, 0), t, N, lambda t: R_0_t * gamma, gamma, delta) @ y
+    exposure_scale = gamma * S * I / N
+    correction = exposure_scale * np.array([R_0_t, -sigma, -dsigma * (x0 - t), -dsigma * k, sigma - 1])
+    rates[0] += correction
+    rates[1] -= correction
+    return rates.ravel()
+
+def Model_sensitivity(days, N, R_0_start, k, x0, R_0_end):
+    '''
+    Creates the SEIR model together with its sensitivities to the logistic R_0 parameters.
+    
+    INPUT:
+        - same as Model
+    OUTPUT: 
+        - t: the times at which the compartments were calculated
+        - y: array (days, 4) of the S, E, I and R time series
+        - sens: array (days, 4, 4); sens[:, i, j] = d(compartment i) / d(parameter j) with
+            parameters ordered (R_0_start, k, x0, R_0_end)
+        - nfe: number of RHS evaluations used by the solver
+    '''
+    from scipy.integrate import odeint
+    y0 = np.zeros((4, 5))
+    y0[:2, 0] = N-1, 1
+    t = np.linspace(0,days-1,days)
+    
+    # Needs the solver info even when instrumentation is off, so integrate() is not used
+    with instrument.stage('odeint'):
+        ret, info = odeint(deriv_seir_sensitivity, y0.ravel(), t, 
+                           args=(N, R_0_start, k, x0, R_0_end, gamma, delta), full_output=True)
+    instrument.count('deriv_seir_sensitivity_evals', int(info['nfe'][-1]))
+    instrument.count('solver_steps', int(info['nst'][-1]))
+    ret = ret.reshape(days, 4, 5)
+    return t, ret[:, :, 0], ret[:, :, 1:], int(info['nfe'][-1])
+
+def fit_seir_sensitivity(infect_data, N, params_init_min_max, outbreak_shift = 0, max_nfev = None):
+    '''
+    Fits the SEIR infected curve like fit_seir, but with scipy's least_squares using the exact
+        Jacobian from Model_sensitivity instead of finite differences.  Each optimizer step 
+        needs a single (augmented) integration, shared between the residual and its Jacobian.
+    
+    INPUT:
+        - same as fit_seir_result
+    OUTPUT: 
+        - summary: dict like summarize_fit, plus 'njev' and 'n_rhs' (RHS evaluations)
+    '''
+    from scipy.optimize import least_squares
+    infect_data = np.nan_to_num(np.asarray(infect_data, dtype=float))
+    if outbreak_shift >= 0:
+        y_data = np.concatenate((np.zeros(outbreak_shift), infect_data))
+    else:
+        y_data = infect_data[-outbreak_shift:]
+    days = len(y_data)
+    
+    names = PARAM_NAMES
+    init, lower, upper = (np.array([params_init_min_max[name][i] for name in names], dtype=float) 
+                          for i in range(3))
+    # The last integration, reused when the optimizer asks for the Jacobian at the same point
+    last = {'p': None, 'I': None, 'dI': None, 'n_rhs': 0}
+    
+    def integrate_at(p):
+        if last['p'] is None or not np.array_equal(p, last['p'], equal_nan=True):
+            _, y, sens, nfe = Model_sensitivity(days, N, *p)
+            last.update(p=p.copy(), I=y[:, 2], dI=sens[:, 2, :], n_rhs=last['n_rhs'] + nfe)
+        return last
+    
+    result = least_squares(lambda p: integrate_at(p)['I'] - y_data, 
+                           np.clip(init, lower, upper), 
+                           jac=lambda p: integrate_at(p)['dI'], 
+                           bounds=(lower, upper), method='trf', max_nfev=max_nfev)
+    
+    residual = result.fun
+    chisqr = float(np.sum(residual**2))
+    return {'best_values': dict(zip(names, result.x.tolist())),
+            'nfev': result.nfev,
+            'njev': result.njev,
+            'chisqr': chisqr,
+            'redchi': chisqr / max(days - len(names), 1),
+            'rmse': float(np.sqrt(np.mean(residual**2))),
+            'max_abs_residual': float(np.max(np.abs(residual))),
+            'success': result.success,
+            'message': result.message,
+            'n_rhs': last['n_rhs']}
+
+def lmfit(params_init_min_max, outbreak_shift = 0, n_starts = None, sampler = 'lhs', seed = None,
+          max_workers = None):
+    '''
+    Fits and plots the first 40 days of df_cases_region, and returns the best-fit values.
+
+    With n_starts, runs a parallel multi-start fit and plots its best optimum; see 
+        lmfit_multistart to also get the table of distinct optima.
+    '''
+    if n_starts is not None:
+        return lmfit_multistart(params_init_min_max, n_starts, outbreak_shift, sampler, seed, max_workers)[0]
+    infect_data = df_cases_region[f'daily_cases_roll{num_days_smooth}mean'][0:40]
+    result = fit_seir_result(infect_data, N, params_init_min_max, outbreak_shift)
     result.plot_fit(datafmt="-");
     return result.best_values
 
+def lmfit_multistart(params_init_min_max, n_starts, outbreak_shift = 0, sampler = 'lhs', seed = None,
+                     max_workers = None):
+    '''
+    Fits the first 40 days of df_cases_region from n_starts points sampled inside the bounds 
+        (see multistart.multistart_fit) and plots the best optimum.
+
+    OUTPUT:
+        - best_values: best-fit values of the best optimum
+        - df_optima: the ranked table of distinct optima
+    '''
+    from multistart import multistart_fit
+    infect_data = df_cases_region[f'daily_cases_roll{num_days_smooth}mean'][0:40]
+    df_optima, _ = multistart_fit(infect_data, N, params_init_min_max, n_starts, sampler, seed,
+                                  outbreak_shift, max_workers=max_workers)
+    best = df_optima.iloc[0]
+    best_init = {name: (best[name],) + tuple(params_init_min_max[name][1:]) for name in params_init_min_max}
+    result = fit_seir_result(infect_data, N, best_init, outbreak_shift)
+    result.plot_fit(datafmt="-");
+    return result.best_values, df_optima
 
 if __name__ == "__main__":
-    # CDC guideline threshold of 10 reported infections per 100k pop every 14 days
-    reopen_thresh = 10./100000/14
     region_init = ('Colorado','')
     num_days_smooth = 7
 
     df2, states_pop, date_range = get_state_or_county_data(region_init, num_days_smooth)
-    state_reopen_thresh = math.ceil(states_pop * reopen_thresh)
 
     plot_region_infections(df2, states_pop, date_range, region_init, 
                            num_days_smooth = num_days_smooth, save_fig = True)
@@ -1,48 +1,34 @@
-import math
+import os
 import numpy as np
 import pandas as pd
 
-from datetime import datetime
+from region_store import region_store_for, population_index_for
+import data_loader
+from data_loader import load_covid_tracking, load_state_population
+from features import add_region_features
+import instrument
 
-import matplotlib.pyplot as plt
-from scipy.integrate import odeint
-import statsmodels.api as sm
-
-from matplotlib.ticker import MultipleLocator, FormatStrFormatter
-
-plt.style.use('ggplot')
 font_size = 16
-plt.rcParams.update({'font.size': font_size})
+
+def _pyplot():
+    '''
+    Imports pyplot (on first use) with the plot style applied.
+    '''
+    import matplotlib.pyplot as plt
+    plt.style.use('ggplot')
+    plt.rcParams.update({'font.size': font_size})
+    return plt
 
 # CDC guideline threshold of 10 reported infections per 100k pop every 14 days
 reopen_thresh = 10./100000/14
 
 num_days_smooth = 7
 
-states = ['NY', 'FL', 'CA']
-# states = ['NY']
-states_pop = [df_usa_pop.loc[df_usa_pop['ABBR'] == states[i],['POPEST18PLUS2019']].iloc[0,0] for i in range(len(states))]
-state_reopen_thresh = [math.ceil(x * reopen_thresh) for x in states_pop]
-state_reopen_thresh
-
-N = states_pop[0]
-# infected person infects 1 other person per day
-beta = 0.999 
-# infections last D days
-D = 1.18 
-gamma = 1.0 / D
-# incubation period of 1/delta days
-delta = 1.0 / 0.5 
-
-E0 = 100
-S0, I0, R0 = N-E0, 0, 0
-
-t = np.linspace(50,150,100)
-# Initial conditions vector
-y0 = S0, E0, I0, R0
-# Integrate the SIR equations over the time grid, t.
-ret = odeint(deriv_seir, y0, t, args=(N, beta, gamma, delta))
-S, E, I, R = ret.T
+# metric: [daily column, axis label, title, file name stem]
+metric_dict = {'infection' : ['positive_daily_incr', 'Infections', 'Infection Counts', 'infection_counts'],
+               'hospitalized' : ['hospitalized_daily_incr', 'Hospitializations', 'Hospitializations', 'hospitializations'],
+               'death' : ['death_daily_incr', 'Deaths', 'Deaths', 'deaths']}
+
 
 def deriv_seir(y, t, N, beta, gamma, delta):
     S, E, I, _ = y
@@ -52,34 +38,74 @@ def deriv_seir(y, t, N, beta, gamma, delta):
     dRdt = gamma * I
     return dSdt, dEdt, dIdt, dRdt
 
-fig, ax = plt.subplots(figsize = (12,6))
-for state in states:
+
+def plot_seir_vs_infections(df_usa, state = 'NY', beta = 0.999, D = 1.18, delta = 1.0 / 0.5, E0 = 100, 
+                            t = np.linspace(50,150,100), save_fig = True):
+    '''
+    Plots a state's daily infections and their rolling mean against a hand-tuned SEIR curve.
+    
+    INPUT:
+        - df_usa: merged frame with state features (see load_state_data)
+        - state: state abbreviation
+        - beta: infected person infects beta other people per day
+        - D: infections last D days
+        - delta: incubation period of 1/delta days
+        - E0: initially exposed people
+        - t: days of year at which the SEIR curve is evaluated
+        - save_fig: save the plot to IMAGES_DIR (see data_loader.py)
+    '''
+    plt = _pyplot()
+    from matplotlib.ticker import MultipleLocator, FormatStrFormatter
+    from scipy.integrate import odeint
+
+    df2 = region_store_for(df_usa, 'state_id', 'd_o_y').slice(state)
+    N = df2['population'].iloc[0]
+    state_reopen_thresh = int(df2['reopen_thresh'].iloc[0])
+    gamma = 1.0 / D
+    S0, I0, R0 = N-E0, 0, 0
+    # Initial conditions vector
+    y0 = S0, E0, I0, R0
+    # Integrate the SIR equations over the time grid, t.
+    ret = odeint(deriv_seir, y0, t, args=(N, beta, gamma, delta))
+    S, E, I, R = ret.T
+
+    fig, ax = plt.subplots(figsize = (12,6))
     plt.bar(df2.d_o_y, df2['positive_daily_incr'], label = f"{state}: Daily Infections")
-    plt.plot(df2.d_o_y, df2['Rolling-{num_days_smooth}mean'], label = f"{state}: {num_days_smooth}-Day Smooth", color='blue')
+    plt.plot(df2.d_o_y, df2[f'positive_daily_incr_roll{num_days_smooth}mean'], label = f"{state}: {num_days_smooth}-Day Smooth", color='blue')
     plt.plot(t, I, label = f'Predicted Infections - SEIR, β={beta:.2f}, γ={gamma:.2f}, δ={delta:.2f}', color = 'green')
-    ax.axhline(state_reopen_thresh[0], color = 'black', ls="--", label = f"Reopen Threshold = {state_reopen_thresh[0]}")
-# ax.set_yscale('log')
-ax.xaxis.set_major_locator(MultipleLocator(5))
-ax.xaxis.set_major_formatter(FormatStrFormatter('%d'))
-# For the minor ticks, use no labels; default NullFormatter.
-ax.xaxis.set_minor_locator(MultipleLocator(1))
-ax.tick_params(direction='out', length=10)
-ax.set_xlabel('Day of Year (2020)')
-ax.set_ylabel('Infection Count')
-# ax.set_yscale('log')
-plt.title(f'Daily COVID-19 Infections in {state} (2020)')
-handles, labels = plt.gca().get_legend_handles_labels()
-order = [3,0,2,1]
-plt.legend([handles[idx] for idx in order],[labels[idx] for idx in order], fontsize=12,loc='upper left')
-plt.show();
-fig.savefig('../images/seir_fit_to_NY_infections-01.png', dpi=250)
-
-
-def plot_infection_trends(state_list, metric = 'infection'):
+    ax.axhline(state_reopen_thresh, color = 'black', ls="--", label = f"Reopen Threshold = {state_reopen_thresh}")
+    ax.xaxis.set_major_locator(MultipleLocator(5))
+    ax.xaxis.set_major_formatter(FormatStrFormatter('%d'))
+    # For the minor ticks, use no labels; default NullFormatter.
+    ax.xaxis.set_minor_locator(MultipleLocator(1))
+    ax.tick_params(direction='out', length=10)
+    ax.set_xlabel('Day of Year (2020)')
+    ax.set_ylabel('Infection Count')
+    plt.title(f'Daily COVID-19 Infections in {state} (2020)')
+    handles, labels = plt.gca().get_legend_handles_labels()
+    order = [3,0,2,1]
+    plt.legend([handles[idx] for idx in order],[labels[idx] for idx in order], fontsize=12,loc='upper left')
+    plt.show();
+    if save_fig:
+        fig.savefig(os.path.join(data_loader.IMAGES_DIR, f'seir_fit_to_{state}_infections-01.png'), dpi=250)
+
+
+def plot_infection_trends(state_list, metric = 'infection', df_usa = None, show = True):
+    '''
+    Plots daily counts of a metric with their rolling mean and reopen threshold, one panel per state.
     
-    metric_dict = {'infection' : ['positive_daily_incr', 'Infections', 'Infection Counts', 'infection_counts'],
-                   'hospitalized' : ['hospitalized_daily_incr', 'Hospitializations', 'Hospitializations', 'hospitializations'],
-                   'death' : ['death_daily_incr', 'Deaths', 'Deaths', 'deaths']}
+    INPUT:
+        - state_list: state abbreviations
+        - metric: 'infection', 'hospitalized' or 'death'
+        - df_usa: merged frame with state features (default: load_state_data())
+        - show: call plt.show(); see render_batch.render_infection_trends to render headless
+    OUTPUT: 
+        - fig: the figure, also saved to IMAGES_DIR (see data_loader.py)
+    '''
+    plt = _pyplot()
+    from matplotlib.ticker import MultipleLocator, FormatStrFormatter
+    if df_usa is None:
+        df_usa = load_state_data()
     
     # Setting up Subplot layout
     plt_row = np.maximum(len(state_list) // 2, 1)
@@ -88,17 +114,16 @@ def plot_infection_trends(state_list, metric = 'infection'):
     else:
         plt_col = 1
     fig_sz_row = 2 + 3 * plt_row
-    fig, axes = plt.subplots(plt_row,plt_col,figsize = (15,fig_sz_row), sharex=True, sharey=True)
+    fig, axes = plt.subplots(plt_row,plt_col,figsize = (15,fig_sz_row), sharex=True, sharey=True, squeeze=False)
     
+    # Rolling avg and reopen threshold are precomputed for every state (see add_state_features)
+    roll_col = f'{metric_dict[metric][0]}_roll{num_days_smooth}mean'
     for ax, state in zip(axes.flat, state_list):
-        # Setting up rolling avg and reopen threshold data
-        state_pop = df_usa_pop.loc[df_usa_pop['ABBR'] == state,['POPEST18PLUS2019']].iloc[0,0] 
-        state_reopen_thresh = math.ceil(state_pop * reopen_thresh) 
-        df2 = df_usa[df_usa['state_id']==state]
-        df2['Rolling-{num_days_smooth}mean'] = df2[metric_dict[metric][0]].rolling(window=num_days_smooth, center = True).mean()
+        df2 = region_store_for(df_usa, 'state_id', 'd_o_y').slice(state)
+        state_reopen_thresh = int(df2['reopen_thresh'].iloc[0])
         # Data plotted
         ax.bar(df2.d_o_y, df2[metric_dict[metric][0]], label = f"{state}")
-        plt.plot(df2.d_o_y, df2['Rolling-{num_days_smooth}mean'], label = f"{state}: {num_days_smooth}-Day Smooth", color='blue')
+        ax.plot(df2.d_o_y, df2[roll_col], label = f"{state}: {num_days_smooth}-Day Smooth", color='blue')
         ax.axhline(state_reopen_thresh, color = 'black', ls="--", label = f"Reopen Threshold = {state_reopen_thresh}")
         # Major & minor ticks
         ax.xaxis.set_major_locator(MultipleLocator(5))
@@ -110,24 +135,48 @@ def plot_infection_trends(state_list, metric = 'infection'):
         ax.set_ylabel(f'Reported {metric_dict[metric][1]}') 
         ax.label_outer()
         # Coerce Legend to dsplay in desired order
-        handles, labels = plt.gca().get_legend_handles_labels()
+        handles, labels = ax.get_legend_handles_labels()
         order = [2,0,1]
         ax.legend([handles[idx] for idx in order],[labels[idx] for idx in order], 
                   fontsize=12, loc='upper left')
     plt.suptitle(f'{metric_dict[metric][2]} By Day of Year, By State', fontsize=16, y = 0.95)
-    plt.show();
+    if show:
+        plt.show();
     states_str = "-".join(state_list)
-    fig.savefig(f"../images/{metric_dict[metric][3]}_by_doy_smoothed_thresh-{states_str}.png", dpi=250)
-
-
-def open_merge_files(infection_file_path, df_population):
-    df_usa_rates = pd.read_csv(infection_file_path)
-    df_usa_rates['datetime'] = pd.to_datetime(df_usa_rates['date'].astype(str), format='%Y%m%d')
-    df_usa_rates['d_o_y'] = pd.DatetimeIndex(df_usa_rates['datetime']).dayofyear
+    with instrument.stage('savefig', states_str):
+        fig.savefig(os.path.join(data_loader.IMAGES_DIR, 
+                                 f"{metric_dict[metric][3]}_by_doy_smoothed_thresh-{states_str}.png"), dpi=250)
+    return fig
+
+
+def add_state_features(df_usa, df_population, windows = (7,)):
+    '''
+    Adds rolling means, per-capita rates and reopen-threshold columns for every state and 
+        metric of the merged frame from open_merge_files, in one pass (see features.py).
+        The reopen threshold is based on each state's adult (18+) population.
+    '''
+    return add_region_features(df_usa, 'state_id', 'd_o_y', 
+                               smooth_cols=['positive_daily_incr', 'hospitalized_daily_incr', 'death_daily_incr'],
+                               windows=windows, 
+                               population=population_index_for(df_population, 'ABBR', 'POPEST18PLUS2019'),
+                               reopen_thresh=reopen_thresh)
+
+
+def open_merge_files(infection_file_path, df_population, chunksize = None):
+    with instrument.stage('open_merge_files'):
+        return _open_merge_files(infection_file_path, df_population, chunksize)
+
+
+def _open_merge_files(infection_file_path, df_population, chunksize):
+    # Typed, column-pruned read; see data_loader.py
+    df_usa_rates = load_covid_tracking(infection_file_path, chunksize=chunksize)
+    instrument.count('rows_read', len(df_usa_rates))
+    instrument.count('bytes_read', os.path.getsize(infection_file_path))
+    df_population = df_population[['ABBR', 'NAME', 'POPESTIMATE2019']]
     
     df_usa = pd.merge(df_usa_rates, df_population, how='outer', left_on='state', right_on='ABBR',
          left_index=False, right_index=False, sort=True,
-         suffixes=('_x', '_y'), copy=True, indicator=False,
+         suffixes=('_x', '_y'), copy=False, indicator=False,
          validate=None)[['datetime','d_o_y','NAME', 'state', 'POPESTIMATE2019','positiveIncrease', 
                          'positive', 'negativeIncrease', 'negative', 'pending', 'deathIncrease', 'death', 'recovered', 
                          'hospitalizedIncrease','hospitalized','totalTestResultsIncrease',
@@ -139,8 +188,19 @@ def open_merge_files(infection_file_path, df_population):
     return df_usa
 
 
+def load_state_data(windows = (num_days_smooth,), chunksize = None):
+    '''
+    Loads the COVID Tracking state file from DATA_DIR, merged with the state populations 
+        and with the state features added (see add_state_features).
+    '''
+    df_population = load_state_population()
+    df_usa = open_merge_files(os.path.join(data_loader.DATA_DIR, 'us_states_covid19_daily.csv'), df_population, 
+                              chunksize)
+    return add_state_features(df_usa, df_population, windows)
+
+
 if __name__ == "__main__":
-    df_usa_pop = pd.read_csv('../data/us_state_population_2019.csv')
-    df_usa = open_merge_files('../data/us_states_covid19_daily.csv', df_usa_pop)
+    df_usa = load_state_data(windows=(num_days_smooth,))
     
-    plot_infection_trends(['NY'], metric = 'infection')
+    plot_infection_trends(['NY'], metric = 'infection', df_usa = df_usa)
+    plot_seir_vs_infections(df_usa, 'NY')
@@ -0,0 +1,199 @@
+'''
+Low-overhead instrumentation of the forecasting pipeline.
+
+Off by default; turn it on with COVID_PROFILE=1 or instrument.enable().  With
+COVID_PROFILE_OUT=<path> the report is also written when the process exits, as collapsed
+stacks if the path ends in '.folded', else as JSON.  While enabled,
+the pipeline records:
+    - per-stage wall time, nested (e.g. get_state_or_county_data > fetch_csv > download)
+    - counters: bytes downloaded, rows parsed/processed, deriv_seir evaluations and
+      solver steps inside odeint, fit function evaluations, figures rendered
+all tagged by region when the work is done for one.  While disabled, stage() returns a 
+shared no-op context manager and count() returns immediately.
+
+Reports cover the current process; process-pool drivers (fit_regions) merge their 
+workers' reports into the parent's with merge().
+    report()          -> dict of stages and counters
+    write_json(path)  -> the same as JSON
+    write_collapsed(path) -> collapsed stacks ('region;stage;substage <microseconds>'),
+                         readable by flamegraph.pl, speedscope and similar tools
+'''
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+
+_enabled = os.environ.get('COVID_PROFILE', '0').lower() not in ('', '0', 'false', 'no')
+_local = threading.local()
+_lock = threading.Lock()
+# (stage path tuple, region label) -> [calls, total seconds, seconds in nested stages]
+_timers = {}
+# (counter name, region label) -> value
+_counters = {}
+
+_NULL = contextlib.nullcontext()
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def _region_label(region):
+    if region is None:
+        return getattr(_local, 'region', None)
+    if isinstance(region, tuple):
+        return '/'.join(part for part in region if part)
+    return str(region)
+
+
+class _Stage:
+    __slots__ = ('name', 'region', 'path', 'start', 'outer_region', 'parent')
+
+    def __init__(self, name, region):
+        self.name = name
+        self.region = region
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        # The enclosing stage is charged this stage's time as child time, whatever its region
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        self.path = (self.parent.path if self.parent else ()) + (self.name,)
+        self.region = _region_label(self.region)
+        # Stages and counters nested inside inherit this stage's region
+        self.outer_region = getattr(_local, 'region', None)
+        _local.region = self.region
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        _local.stack.pop()
+        _local.region = self.outer_region
+        with _lock:
+            entry = _timers.setdefault((self.path, self.region), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            if self.parent is not None:
+                _timers.setdefault((self.parent.path, self.parent.region), [0, 0.0, 0.0])[2] += elapsed
+        return False
+
+
+def stage(name, region = None):
+    '''
+    Context manager timing a pipeline stage (nested inside any enclosing stage).
+    
+    INPUT:
+        - name: stage name
+        - region: (Optional) region tuple or label; defaults to the region set by tag_region
+    '''
+    return _Stage(name, region) if _enabled else _NULL
+
+
+def count(name, value = 1, region = None):
+    '''
+    Adds value to a counter, tagged by region like stage().
+    '''
+    if not _enabled:
+        return
+    key = (name, _region_label(region))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextlib.contextmanager
+def _tagged(region):
+    previous = getattr(_local, 'region', None)
+    _local.region = _region_label(region)
+    try:
+        yield
+    finally:
+        _local.region = previous
+
+
+def tag_region(region):
+    '''
+    Context manager tagging all stages and counters inside it with a region.
+    '''
+    return _tagged(region) if _enabled else _NULL
+
+
+def report():
+    '''
+    Returns the recorded stages (with total and self time) and counters.  A stage's self
+        time excludes the stages nested in it, including those tagged with another region.
+    '''
+    with _lock:
+        timers = {key: list(entry) for key, entry in _timers.items()}
+        counters = dict(_counters)
+    stages = [{'stage': path[-1], 'path': '/'.join(path), 'region': region, 'calls': calls, 
+               'total_s': total, 'self_s': max(total - child, 0.0)}
+              for (path, region), (calls, total, child) in sorted(timers.items(), key=lambda item: -item[1][1])
+              if calls]
+    return {'stages': stages, 
+            'counters': [{'counter': name, 'region': region, 'value': value} 
+                         for (name, region), value in sorted(counters.items(), key=lambda item: str(item[0]))]}
+
+
+def merge(other):
+    '''
+    Adds a report() from another process (e.g. a pool worker) into this process's records.
+    '''
+    with _lock:
+        for entry in other['stages']:
+            timer = _timers.setdefault((tuple(entry['path'].split('/')), entry['region']), [0, 0.0, 0.0])
+            timer[0] += entry['calls']
+            timer[1] += entry['total_s']
+            timer[2] += entry['total_s'] - entry['self_s']
+        for entry in other['counters']:
+            key = (entry['counter'], entry['region'])
+            _counters[key] = _counters.get(key, 0) + entry['value']
+
+
+def write_json(path):
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=1)
+
+
+def write_collapsed(path):
+    '''
+    Writes stage self times in collapsed-stack format, one 'frame;frame;... microseconds' 
+        line per stack, with the region (if any) as the root frame.
+    '''
+    with open(path, 'w') as f:
+        for entry in report()['stages']:
+            frames = entry['path'].replace('/', ';')
+            if entry['region']:
+                frames = f"{entry['region'].replace(';', ',')};{frames}"
+            f.write(f"{frames} {int(round(entry['self_s'] * 1e6))}\n")
+
+
+def _write_at_exit(path):
+    if path.endswith('.folded'):
+        write_collapsed(path)
+    else:
+        write_json(path)
+
+
+if _enabled and os.environ.get('COVID_PROFILE_OUT'):
+    atexit.register(_write_at_exit, os.environ['COVID_PROFILE_OUT'])
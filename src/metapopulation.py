@@ -0,0 +1,205 @@
+'''
+Metapopulation SEIR: every state, or every county, integrated as one coupled system.
+
+Each region has the S, E, I and R compartments of deriv_seir.  Transmission between
+regions goes through a sparse, row-stochastic coupling matrix C: region i is exposed to
+the infectious fraction sum_j C_ij I_j / N_j of the regions its population mixes with.
+With C the identity this reduces to one independent deriv_seir model per region.
+
+The state is stored compartment by compartment (all S, then all E, I and R), so the RHS
+is a handful of vector operations and one sparse matrix-vector product, and the
+Jacobian is assembled as a sparse block matrix for the stiff BDF solver.  scipy is
+imported by the functions that use it (see cli.py).
+'''
+import numpy as np
+
+import infection_model
+from infection_model import logistic_R_0, region_populations
+import instrument
+
+
+def gravity_coupling(N, groups = None, mobility_fraction = 0.05, max_partners = 10):
+    '''
+    Builds a coupling matrix in which each region keeps (1 - mobility_fraction) of its
+        contacts at home and spreads the rest over the most populous other regions of its
+        group, in proportion to their populations.
+
+    INPUT:
+        - N: array (n,) of region populations, all positive
+        - groups: (Optional) array (n,) of group labels, e.g. the state of each county;
+            regions only mix within a group.  Default: one group (all regions mix).
+        - mobility_fraction: fraction of contacts made outside the home region
+        - max_partners: (Optional) mix only with this many (at least 1) of the group's most 
+            populous regions (the hubs people travel to); None mixes with the whole group.  
+            This keeps the matrix, and the solver's LU factorization, sparse.
+    OUTPUT:
+        - coupling: sparse CSR matrix (n, n) whose rows sum to 1
+    '''
+    import scipy.sparse as sp
+    if max_partners is not None and max_partners < 1:
+        raise ValueError(f'max_partners must be at least 1 or None, not {max_partners}')
+    N = np.asarray(N, dtype=float)
+    # Mixing weights are shares of the hubs' populations, so every population must be positive
+    bad = ~(np.isfinite(N) & (N > 0))
+    if bad.any():
+        raise ValueError(f'populations must be positive and finite; {bad.sum()} region(s) are not '
+                         f'(first at index {np.flatnonzero(bad)[0]})')
+    n = len(N)
+    groups = np.zeros(n, dtype=int) if groups is None else np.unique(np.asarray(groups), return_inverse=True)[1]
+    rows, cols, vals = [], [], []
+    for group in np.unique(groups):
+        members = np.flatnonzero(groups == group)
+        if len(members) < 2:
+            continue
+        # Population-weighted mixing with the hubs, excluding the region itself
+        hubs = members[np.argsort(-N[members], kind='stable')[:max_partners and max_partners + 1]]
+        weights = np.tile(N[hubs], (len(members), 1))
+        weights[members[:, np.newaxis] == hubs[np.newaxis, :]] = 0.
+        if max_partners is not None:
+            # Drop the smallest hub for members that are not themselves hubs
+            order = np.argsort(-weights, axis=1, kind='stable')[:, max_partners:]
+            np.put_along_axis(weights, order, 0., axis=1)
+        weights *= mobility_fraction / weights.sum(axis=1, keepdims=True)
+        rows.append(np.repeat(members, len(hubs)))
+        cols.append(np.tile(hubs, len(members)))
+        vals.append(weights.ravel())
+    home = np.ones(n)
+    if rows:
+        outside = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+        home -= np.asarray(outside.sum(axis=1)).ravel()
+    else:
+        outside = sp.csr_matrix((n, n))
+    coupling = (outside + sp.diags(home)).tocsr()
+    coupling.eliminate_zeros()
+    return coupling
+
+
+def coupling_from_mobility(mobility, mobility_fraction = None):
+    '''
+    Turns a sparse matrix of trips (or any nonnegative flows) from region i to region j
+        into a row-stochastic coupling matrix.
+
+    INPUT:
+        - mobility: sparse or dense (n, n) nonnegative flows; the diagonal is the home share
+        - mobility_fraction: (Optional) rescale the off-diagonal share of every row to this
+    OUTPUT:
+        - coupling: sparse CSR matrix (n, n) whose rows sum to 1
+    '''
+    import scipy.sparse as sp
+    mobility = sp.csr_matrix(mobility, dtype=float)
+    n = mobility.shape[0]
+    if mobility_fraction is not None:
+        home = sp.diags(mobility.diagonal())
+        outside = mobility - home
+        totals = np.asarray(outside.sum(axis=1)).ravel()
+        scale = np.divide(mobility_fraction, totals, out=np.zeros(n), where=totals > 0)
+        mobility = sp.diags(scale) @ outside + sp.diags(1. - mobility_fraction * (totals > 0))
+    totals = np.asarray(mobility.sum(axis=1)).ravel()
+    if np.any(totals <= 0):
+        raise ValueError('every region needs a positive row total in the mobility matrix')
+    coupling = (sp.diags(1. / totals) @ mobility).tocsr()
+    coupling.eliminate_zeros()
+    return coupling
+
+
+def deriv_seir_metapopulation(t, y, N, CN, R_0_start, k, x0, R_0_end, gamma, delta):
+    '''
+    Calculates the net change in every compartment of every region at time t.
+
+    INPUT:
+        - t: the time at which the rates will be calculated
+        - y: flat array of length 4*n, packed (S_1..S_n, E_1..E_n, I_1..I_n, R_1..R_n)
+        - N: array (n,) of region populations
+        - CN: the coupling matrix with its columns divided by N (C @ diag(1/N))
+        - R_0_start, k, x0, R_0_end: scalars or arrays (n,) of logistic R_0 parameters
+        - gamma: the fraction of infected people recovering per day
+        - delta: the fraction of exposed people becoming infected per day
+    OUTPUT:
+        - dydt: flat array of length 4*n, packed like y
+    '''
+    S, E, I, R = y.reshape(4, -1)
+    new_exposed = logistic_R_0(t, R_0_start, k, x0, R_0_end) * gamma * S * (CN @ I)
+    return np.concatenate((-new_exposed, new_exposed - delta * E, delta * E - gamma * I, gamma * I))
+
+
+def deriv_seir_metapopulation_jac(t, y, N, CN, R_0_start, k, x0, R_0_end, gamma, delta):
+    '''
+    Sparse Jacobian of deriv_seir_metapopulation with respect to y.
+    '''
+    import scipy.sparse as sp
+    S, E, I, R = y.reshape(4, -1)
+    n = len(S)
+    beta = logistic_R_0(t, R_0_start, k, x0, R_0_end) * gamma * np.ones(n)
+    force = sp.diags(beta * (CN @ I))
+    contacts = sp.diags(beta * S) @ CN
+    identity = sp.identity(n, format='csr')
+    return sp.bmat([[-force, None, -contacts, None],
+                    [force, -delta * identity, contacts, None],
+                    [None, delta * identity, -gamma * identity, None],
+                    [None, None, gamma * identity, sp.csr_matrix((n, n))]], format='csc')
+
+
+def Model_metapopulation(days, N, coupling, R_0_start, k, x0, R_0_end, E0 = 1., gamma = None, delta = None):
+    '''
+    Creates the coupled SEIR model for a set of regions.
+
+    INPUT:
+        - days: number of days to model
+        - N: array (n,) of region populations
+        - coupling: sparse (n, n) row-stochastic coupling matrix, e.g. from
+            gravity_coupling or coupling_from_mobility
+        - R_0_start, k, x0, R_0_end: scalars or arrays (n,) of logistic R_0 parameters
+        - E0: initial exposed people per region, scalar or array (n,) (e.g. zero outside
+            the regions seeding the outbreak)
+        - gamma, delta: (Optional) recovery and incubation rates; default the current
+            infection_model.gamma and infection_model.delta
+    OUTPUT:
+        - t: the times at which the compartments were calculated, shape (days,)
+        - y: array (n, days, 4) with the S, E, I and R time series of each region
+        - R_0_t: array (n, days) with the R_0 transition of each region
+    '''
+    import scipy.sparse as sp
+    from scipy.integrate import solve_ivp
+    gamma = infection_model.gamma if gamma is None else gamma
+    delta = infection_model.delta if delta is None else delta
+    N = np.asarray(N, dtype=float)
+    n = len(N)
+    R_0_start, k, x0, R_0_end = [np.broadcast_to(np.asarray(arr, dtype=float), (n,))
+                                 for arr in (R_0_start, k, x0, R_0_end)]
+    E0 = np.broadcast_to(np.asarray(E0, dtype=float), (n,))
+    CN = (sp.csr_matrix(coupling) @ sp.diags(1. / N)).tocsr()
+
+    y0 = np.concatenate((N - E0, E0, np.zeros(n), np.zeros(n)))
+    t = np.linspace(0, days-1, days)
+    args = (N, CN, R_0_start, k, x0, R_0_end, gamma, delta)
+    with instrument.stage('integrate'):
+        sol = solve_ivp(deriv_seir_metapopulation, (t[0], t[-1]), y0, method='BDF', t_eval=t,
+                        args=args, jac=deriv_seir_metapopulation_jac, rtol=1e-6, atol=1e-6)
+    if not sol.success:
+        raise RuntimeError(f'metapopulation integration failed: {sol.message}')
+    instrument.count('ode_rhs_evaluations', sol.nfev)
+    y = sol.y.reshape(4, n, days).transpose(1, 2, 0)
+    R_0_t = logistic_R_0(t[np.newaxis, :], R_0_start[:, np.newaxis], k[:, np.newaxis],
+                         x0[:, np.newaxis], R_0_end[:, np.newaxis])
+    return t, y, R_0_t
+
+
+def metapopulation_model(days, level = 'state', states = None, mobility_fraction = 0.05, max_partners = 10,
+                         R_0_start = 4.0, k = 0.5, x0 = 60, R_0_end = 0.8, E0 = 1., gamma = None, delta = None):
+    '''
+    Runs Model_metapopulation over all states, or all counties, with census populations
+        and gravity coupling (counties only mix within their state).
+
+    INPUT:
+        - days: number of days to model
+        - level, states: which regions to include, see region_populations
+        - mobility_fraction, max_partners: see gravity_coupling
+        - R_0_start, k, x0, R_0_end, E0, gamma, delta: as for Model_metapopulation
+    OUTPUT:
+        - regions: list of region tuples, in the order of the model's rows
+        - t, y, R_0_t: as for Model_metapopulation
+    '''
+    regions, N = region_populations(level, states)
+    groups = None if level == 'state' else [region[0] for region in regions]
+    coupling = gravity_coupling(N, groups, mobility_fraction, max_partners)
+    return (regions,) + Model_metapopulation(days, N, coupling, R_0_start, k, x0, R_0_end, E0, gamma, delta)
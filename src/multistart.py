@@ -0,0 +1,176 @@
+'''
+Multi-start SEIR fitting: many local fits from space-filling starting points, in parallel.
+
+The bounds in params_init_min_max are wide, and a single local least-squares fit from one
+hand-picked guess often stops in a poor local minimum.  multistart_fit draws starting
+points inside the bounds with a Latin hypercube or Sobol sequence and fits them on a
+process pool in two stages:
+
+    1. every start runs a short fit (a few function evaluations);
+    2. only the best fraction of those partial fits, ranked by chi-square, is continued to
+       convergence from where stage 1 stopped; the rest are dominated and pruned.
+
+Converged fits that land on the same parameters (within a tolerance relative to the
+bounds) are merged, and the distinct optima are returned ranked by chi-square.
+'''
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+
+from infection_model import fit_seir, PARAM_NAMES
+
+
+def start_points(params_init_min_max, n_starts, sampler = 'lhs', seed = None, include_init = True):
+    '''
+    Draws starting points for the fit inside the parameter bounds.
+
+    INPUT:
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)}
+        - n_starts: number of starting points
+        - sampler: 'lhs' (Latin hypercube) or 'sobol' (scrambled Sobol; n_starts is
+            rounded up to a power of two to keep the sequence balanced)
+        - seed: (Optional) random seed for reproducible starts
+        - include_init: replace the first sample with the hand-picked initial guess
+    OUTPUT:
+        - starts: array of shape (n_starts, 4), columns in PARAM_NAMES order
+    '''
+    init, lower, upper = (np.array([params_init_min_max[name][i] for name in PARAM_NAMES], dtype=float)
+                          for i in range(3))
+    if sampler == 'lhs':
+        unit = qmc.LatinHypercube(d=len(PARAM_NAMES), seed=seed).random(n_starts)
+    elif sampler == 'sobol':
+        unit = qmc.Sobol(d=len(PARAM_NAMES), seed=seed).random_base2(int(np.ceil(np.log2(max(n_starts, 1)))))
+    else:
+        raise ValueError(f"sampler must be 'lhs' or 'sobol', not {sampler!r}")
+    starts = qmc.scale(unit, lower, upper)
+    if include_init:
+        starts[0] = np.clip(init, lower, upper)
+    return starts
+
+
+def _with_init(params_init_min_max, values):
+    return {name: (float(value),) + tuple(params_init_min_max[name][1:])
+            for name, value in zip(PARAM_NAMES, values)}
+
+
+def _start_worker(start_id, values, infect_data, N, params_init_min_max, outbreak_shift, jacobian, max_nfev):
+    '''
+    Runs one (possibly truncated) local fit from the given starting values.
+    '''
+    start = time.perf_counter()
+    try:
+        summary = fit_seir(infect_data, N, _with_init(params_init_min_max, values), outbreak_shift,
+                           jacobian, max_nfev)
+        error = ''
+    except Exception:
+        summary, error = None, traceback.format_exc(limit=3)
+    return start_id, summary, error, time.perf_counter() - start
+
+
+def _run_stage(pool, jobs, infect_data, N, params_init_min_max, outbreak_shift, jacobian, max_nfev):
+    futures = [pool.submit(_start_worker, start_id, values, infect_data, N, params_init_min_max,
+                           outbreak_shift, jacobian, max_nfev)
+               for start_id, values in jobs]
+    return [future.result() for future in as_completed(futures)]
+
+
+def distinct_optima(df_fits, params_init_min_max, tol = 1e-2):
+    '''
+    Merges converged fits whose parameters agree within tol (as a fraction of each
+    parameter's bound width) and ranks the distinct optima by chi-square.
+
+    INPUT:
+        - df_fits: one row per fit with PARAM_NAMES columns, chisqr, start_id and nfev
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)}
+        - tol: relative distance below which two optima are the same
+    OUTPUT:
+        - df_optima: one row per distinct optimum, best first, with the number of starts
+            that reached it ('n_starts'), the best of those starts ('start_id') and their
+            summed function evaluations ('nfev')
+    '''
+    width = np.array([params_init_min_max[name][2] - params_init_min_max[name][1] for name in PARAM_NAMES],
+                     dtype=float)
+    df_fits = df_fits.sort_values('chisqr', kind='stable').reset_index(drop=True)
+    scaled = df_fits[PARAM_NAMES].to_numpy(dtype=float) / width
+    centers, members = [], []
+    for i, point in enumerate(scaled):
+        for j, center in enumerate(centers):
+            if np.max(np.abs(point - center)) <= tol:
+                members[j].append(i)
+                break
+        else:
+            centers.append(point)
+            members.append([i])
+    df_optima = df_fits.loc[[group[0] for group in members]].reset_index(drop=True)
+    df_optima['nfev'] = [int(df_fits['nfev'].iloc[group].sum()) for group in members]
+    df_optima['n_starts'] = [len(group) for group in members]
+    df_optima.insert(0, 'rank', np.arange(1, len(df_optima) + 1))
+    return df_optima
+
+
+def multistart_fit(infect_data, N, params_init_min_max, n_starts = 32, sampler = 'lhs', seed = None,
+                   outbreak_shift = 0, jacobian = 'sensitivity', prune_nfev = 8, keep_fraction = 0.25,
+                   tol = 1e-2, max_workers = None):
+    '''
+    Fits the SEIR model to an infection series from many starting points in parallel.
+
+    INPUT:
+        - infect_data: array of observed (smoothed) daily infections
+        - N: population of the region
+        - params_init_min_max: {parameter: (initial guess, minimum value, max value)}
+        - n_starts, sampler, seed: starting points, see start_points
+        - outbreak_shift, jacobian: passed to fit_seir
+        - prune_nfev: function evaluations of the short first-stage fits
+        - keep_fraction: fraction of starts (at least one) continued to convergence
+        - tol: parameter tolerance for merging optima, see distinct_optima
+        - max_workers: number of worker processes (default: os.cpu_count())
+    OUTPUT:
+        - df_optima: ranked table of distinct optima (parameters, chi-square, rmse,
+            function evaluations summed over the starts that reached it, n_starts), best first
+        - df_starts: one row per start with its stage-1 and final chi-square
+            (NaN when pruned) and any error
+    '''
+    infect_data = np.nan_to_num(np.asarray(infect_data, dtype=float))
+    starts = start_points(params_init_min_max, n_starts, sampler, seed)
+    df_starts = pd.DataFrame(starts, columns=[f'{name}_start' for name in PARAM_NAMES])
+    df_starts.index.name = 'start_id'
+    df_starts['stage1_chisqr'] = np.nan
+    df_starts['chisqr'] = np.nan
+    df_starts['error'] = ''
+    stage1 = {}
+    fits = []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for start_id, summary, error, _ in _run_stage(pool, enumerate(starts), infect_data, N,
+                                                       params_init_min_max, outbreak_shift, jacobian, prune_nfev):
+            if summary is None:
+                df_starts.loc[start_id, 'error'] = error
+                continue
+            stage1[start_id] = summary
+            df_starts.loc[start_id, 'stage1_chisqr'] = summary['chisqr']
+
+        if not stage1:
+            raise RuntimeError(f'all {len(starts)} starts failed; first error:\n{df_starts["error"].iloc[0]}')
+        n_keep = max(1, int(np.ceil(keep_fraction * len(stage1))))
+        survivors = sorted(stage1, key=lambda start_id: stage1[start_id]['chisqr'])[:n_keep]
+        jobs = [(start_id, [stage1[start_id]['best_values'][name] for name in PARAM_NAMES])
+                for start_id in survivors]
+
+        for start_id, summary, error, wall_time in _run_stage(pool, jobs, infect_data, N, params_init_min_max,
+                                                               outbreak_shift, jacobian, None):
+            if summary is None:
+                df_starts.loc[start_id, 'error'] = error
+                continue
+            df_starts.loc[start_id, 'chisqr'] = summary['chisqr']
+            fits.append({'start_id': start_id, **summary['best_values'],
+                         'chisqr': summary['chisqr'], 'rmse': summary['rmse'],
+                         'nfev': stage1[start_id]['nfev'] + summary['nfev'],
+                         'success': summary['success'], 'wall_time': wall_time})
+
+    if not fits:
+        raise RuntimeError('every surviving start failed to converge')
+    return distinct_optima(pd.DataFrame(fits), params_init_min_max, tol), df_starts
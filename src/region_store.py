@@ -0,0 +1,136 @@
+'''
+Pre-indexed storage of national time-series frames for constant-time region lookup.
+
+The national frames (NYT states/counties, COVID Tracking states) hold every region 
+stacked together.  A RegionStore sorts such a frame once by region key and date and keeps
+a dictionary from region key to the (start, stop) rows of its contiguous block, so a 
+region's time series is an iloc slice instead of a boolean mask over the whole frame.
+'''
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+
+
+class RegionStore:
+    '''
+    Frame sorted by (key columns, date) with an index of each region's contiguous rows.
+    
+    INPUT:
+        - df: national frame with one row per region per date
+        - key_cols: column name(s) identifying a region, e.g. ('state', 'county')
+        - date_col: column used to order each region's rows
+        - populations: (Optional) dict mapping region key -> population
+    '''
+    def __init__(self, df, key_cols, date_col, populations=None):
+        self.key_cols = tuple([key_cols] if isinstance(key_cols, str) else key_cols)
+        self.date_col = date_col
+        self.df = df.sort_values(list(self.key_cols) + [date_col], kind='mergesort').reset_index(drop=True)
+        self.populations = {} if populations is None else populations
+
+        # Sorted, so every key's rows form one block; record where the key changes
+        if len(self.df):
+            changed = np.zeros(len(self.df), dtype=bool)
+            changed[0] = True
+            for col in self.key_cols:
+                values = self.df[col].to_numpy()
+                changed[1:] |= ~((values[1:] == values[:-1]) | (pd.isna(values[1:]) & pd.isna(values[:-1])))
+            starts = np.flatnonzero(changed)
+        else:
+            starts = np.array([], dtype=int)
+        stops = np.append(starts[1:], len(self.df))
+        key_values = zip(*(self.df[col].to_numpy()[starts] for col in self.key_cols))
+        self.offsets = {key: (int(start), int(stop)) for key, start, stop in zip(key_values, starts, stops)}
+
+    @staticmethod
+    def _as_key(key):
+        return key if isinstance(key, tuple) else (key,)
+
+    def __contains__(self, key):
+        return self._as_key(key) in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def slice(self, key):
+        '''
+        Returns the rows of one region, ordered by date.
+        
+        INPUT:
+            - key: region key; a tuple matching key_cols, or a scalar for a single key column
+        OUTPUT: 
+            - df: contiguous row slice of the sorted frame (treat as read-only)
+        '''
+        start, stop = self.offsets[self._as_key(key)]
+        return self.df.iloc[start:stop]
+
+    def population(self, key):
+        return self.populations[self._as_key(key)]
+
+
+def population_index(df_pop, key_cols, pop_col):
+    '''
+    Builds a dict mapping region key tuples to population from a census-style frame.
+    '''
+    key_cols = [key_cols] if isinstance(key_cols, str) else list(key_cols)
+    return dict(zip(zip(*(df_pop[col] for col in key_cols)), df_pop[pop_col]))
+
+
+# Stores/indexes already built for a given frame object: id(df) -> (weakref to df, result)
+_built = {}
+# Guards _built (stores are requested from forecast_service's server threads); re-entrant
+# because a weakref callback can run during garbage collection while it is held
+_built_lock = threading.RLock()
+
+
+def memoize_for_frame(df, args, builder):
+    '''
+    Returns builder() computed once per (frame object, args) while the frame is alive.
+    '''
+    memo_key = (id(df), args)
+    with _built_lock:
+        cached = _built.get(memo_key)
+        if cached is not None and cached[0]() is df:
+            return cached[1]
+    result = builder()
+    with _built_lock:
+        # Another thread may have built it meanwhile; keep (and return) the first one stored
+        cached = _built.get(memo_key)
+        if cached is not None and cached[0]() is df:
+            return cached[1]
+        _built[memo_key] = (weakref.ref(df, _forget(memo_key)), result)
+    return result
+
+
+def _forget(memo_key):
+    '''
+    Returns the weakref callback dropping memo_key once its frame is garbage collected.
+    '''
+    def callback(ref):
+        with _built_lock:
+            # The id may already have been reused by a newer frame with its own entry
+            if _built.get(memo_key, (None,))[0] is ref:
+                del _built[memo_key]
+    return callback
+
+
+def region_store_for(df, key_cols, date_col):
+    '''
+    Returns the RegionStore for a frame, building it only the first time it is requested.
+    '''
+    key_cols = tuple([key_cols] if isinstance(key_cols, str) else key_cols)
+    return memoize_for_frame(df, ('store', key_cols, date_col), 
+                          lambda: RegionStore(df, key_cols, date_col))
+
+
+def population_index_for(df_pop, key_cols, pop_col):
+    '''
+    Returns population_index(df_pop, key_cols, pop_col), building it only once per frame.
+    '''
+    key_cols = tuple([key_cols] if isinstance(key_cols, str) else key_cols)
+    return memoize_for_frame(df_pop, ('population', key_cols, pop_col), 
+                          lambda: population_index(df_pop, key_cols, pop_col))
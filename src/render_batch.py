@@ -0,0 +1,313 @@
+'''
+Headless batch rendering of the pipeline's charts.
+
+Charts are drawn on the non-interactive Agg backend.  Each worker process builds one 
+figure template per chart kind and, for each chart, only updates the artists' data before
+saving, instead of building a new figure.  RegionChart (bar patches, smoothed line, 
+threshold line, title) covers plot_region_infections, and one state's panel of 
+plot_infection_trends and plot_state_daily_data; SeirChart covers plot_generic.
+Region data is prepared in the parent and sent to the workers as compact arrays, and 
+file names depend only on the region and the latest data date, so reruns overwrite the
+same files.
+'''
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from matplotlib.patches import Rectangle
+from matplotlib.ticker import ScalarFormatter
+
+from features import REOPEN_THRESH
+import data_loader
+import instrument
+
+
+class RegionChart:
+    '''
+    Reusable figure of daily counts (bars), their rolling mean (line) and a threshold line.
+    '''
+    def __init__(self, figsize = (12,6)):
+        plt.style.use('ggplot')
+        plt.rcParams.update({'font.size': 14})
+        self.fig, self.ax = plt.subplots(figsize = figsize)
+        self.line, = self.ax.plot([], [], color='blue')
+        self.thresh = self.ax.axhline(0, color = 'black', ls="--")
+        self.title = self.fig.suptitle('', fontsize=16, y = 0.95)
+        self.bars = []
+        self.bar_color = plt.rcParams['axes.prop_cycle'].by_key()['color'][1]
+
+    def _set_bars(self, x, heights, width):
+        # Grow the patch pool if needed; hide the patches this region does not use
+        while len(self.bars) < len(x):
+            self.bars.append(self.ax.add_patch(Rectangle((0, 0), 0, 0, color=self.bar_color)))
+        for bar, xi, height in zip(self.bars, x, heights):
+            bar.set_bounds(xi - width / 2, 0, width, height)
+            bar.set_visible(True)
+        for bar in self.bars[len(x):]:
+            bar.set_visible(False)
+
+    def update(self, spec):
+        '''
+        Points the template at one region's data.
+        
+        INPUT:
+            - spec: dict with 'x' (float days; matplotlib date numbers for dates), 'daily', 
+                'smooth', 'thresh', 'label', 'smooth_label', 'title', 'xlabel', 'ylabel',
+                'xlim' and 'xticks' (for date axes, 'xticks' are date numbers); 'smooth' and
+                'thresh' may be None to draw the bars alone
+        '''
+        x = np.asarray(spec['x'], dtype=float)
+        daily = np.nan_to_num(np.asarray(spec['daily'], dtype=float))
+        self._set_bars(x, daily, 0.8)
+        handles, labels = [], []
+        ymax = np.max(daily, initial=0)
+        self.line.set_visible(spec['smooth'] is not None)
+        if spec['smooth'] is not None:
+            self.line.set_data(x, spec['smooth'])
+            handles.append(self.line)
+            labels.append(spec['smooth_label'])
+            ymax = max(ymax, np.nanmax(spec['smooth'], initial=0))
+        self.thresh.set_visible(spec['thresh'] is not None)
+        if spec['thresh'] is not None:
+            self.thresh.set_ydata([spec['thresh'], spec['thresh']])
+            handles.append(self.thresh)
+            labels.append(f"Reopen Threshold = {spec['thresh']}")
+            ymax = max(ymax, spec['thresh'])
+        self.ax.legend(handles + self.bars[:1], labels + [spec['label']], loc='upper left')
+
+        self.ax.set_xlim(*spec['xlim'])
+        self.ax.set_ylim(min(np.min(daily, initial=0), 0) * 1.05, ymax * 1.05 + 1)
+        if spec.get('dates', False):
+            self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+        else:
+            self.ax.xaxis.set_major_formatter(ScalarFormatter())
+        self.ax.set_xticks(spec['xticks'])
+        self.ax.set_xlabel(spec['xlabel'])
+        self.ax.set_ylabel(spec['ylabel'])
+        self.title.set_text(spec['title'])
+
+    def save(self, path, dpi):
+        self.fig.savefig(path, dpi=dpi)
+
+
+class SeirChart:
+    '''
+    Reusable figure of the SEIR compartment curves (top) and R_0 over time (bottom).
+    '''
+    colors = {'S': 'b', 'E': 'y', 'I': 'r', 'R': 'g'}
+    names = {'S': 'Susceptible', 'E': 'Exposed', 'I': 'Infected', 'R': 'Recovered'}
+
+    def __init__(self, figsize = (20,8)):
+        plt.style.use('ggplot')
+        plt.rcParams.update({'font.size': 14})
+        self.fig, (self.ax, self.ax_R_0) = plt.subplots(2, 1, figsize = figsize, sharex=True)
+        self.lines = {key: self.ax.plot([], [], color, alpha=0.7, linewidth=2, label=self.names[key])[0]
+                      for key, color in self.colors.items()}
+        self.line_R_0, = self.ax_R_0.plot([], [], 'b--', alpha=0.7, linewidth=2, label='R_0')
+        for ax in (self.ax, self.ax_R_0):
+            ax.grid(visible=True, which='major', c='w', lw=2, ls='-')
+            ax.legend().get_frame().set_alpha(0.5)
+            for spine in ax.spines.values():
+                spine.set_visible(False)
+        self.ax_R_0.title.set_text('R_0 over time')
+        self.title = self.fig.suptitle('', fontsize=16, y = 0.95)
+
+    def update(self, spec):
+        '''
+        Points the template at one model run.
+        
+        INPUT:
+            - spec: dict with 'x' (days), 'S', 'E', 'I', 'R', 'R_0' and 'title'
+        '''
+        x = np.asarray(spec['x'], dtype=float)
+        for key, line in self.lines.items():
+            line.set_data(x, spec[key])
+        self.line_R_0.set_data(x, spec['R_0'])
+        for ax in (self.ax, self.ax_R_0):
+            ax.relim()
+            ax.autoscale_view()
+        self.title.set_text(spec['title'])
+
+    def save(self, path, dpi):
+        self.fig.savefig(path, dpi=dpi)
+
+
+CHART_KINDS = {'region': RegionChart, 'seir': SeirChart}
+
+
+def region_infection_spec(df, region_pop, date_range, region, num_days_smooth = 7):
+    '''
+    Builds the chart spec of plot_region_infections for one region.
+    
+    INPUT:
+        - df, region_pop, date_range: from get_state_or_county_data
+        - region: ('State', 'County') tuple
+        - num_days_smooth: days of the centered rolling mean plotted
+    OUTPUT: 
+        - spec: dict for RegionChart.update plus 'name', the deterministic file name stem
+    '''
+    from infection_model import region_label
+    label_text = region_label(region)
+    latest = max(df.date)
+    ticks = np.arange(date_range[0], latest + pd.DateOffset(1), pd.Timedelta(days=30))
+    return {'name': f'daily_infection_rates_target_{label_text.replace(" ", "_")}_{latest.strftime("%y_%m_%d")}',
+            'x': mdates.date2num(df.date), 
+            'daily': df['daily_cases'].to_numpy(dtype=float),
+            'smooth': df[f'daily_cases_roll{num_days_smooth}mean'].to_numpy(dtype=float),
+            'thresh': math.ceil(region_pop * REOPEN_THRESH),
+            'label': label_text, 
+            'smooth_label': f"{label_text}: {num_days_smooth}-Day Smooth",
+            'title': f'Infection Counts By Date - {label_text}', 
+            'xlabel': 'Date', 'ylabel': 'Reported Infections',
+            'xlim': mdates.date2num([date_range[0], date_range[1]]), 
+            'xticks': mdates.date2num(pd.DatetimeIndex(ticks)),
+            'dates': True}
+
+
+def infection_trend_spec(df_usa, state, metric = 'infection', smoothed = True):
+    '''
+    Builds the chart spec of one state's panel of plot_infection_trends (smoothed) or
+        plot_state_daily_data (not smoothed).
+    
+    INPUT:
+        - df_usa: merged frame with state features (see infection_rates.load_state_data)
+        - state: state abbreviation
+        - metric: 'infection', 'hospitalized' or 'death'
+        - smoothed: draw the rolling mean and reopen threshold over the daily bars
+    OUTPUT: 
+        - spec: dict for RegionChart.update plus 'name', the deterministic file name stem
+    '''
+    from infection_rates import metric_dict, num_days_smooth
+    from region_store import region_store_for
+    column, axis_label, title, file_stem = metric_dict[metric]
+    df = region_store_for(df_usa, 'state_id', 'd_o_y').slice(state)
+    x = df['d_o_y'].to_numpy(dtype=float)
+    first, last = np.nanmin(x), np.nanmax(x)
+    return {'name': f"{file_stem}_by_doy{'_smoothed_thresh' if smoothed else ''}-{state}",
+            'x': x,
+            'daily': df[column].to_numpy(dtype=float),
+            'smooth': df[f'{column}_roll{num_days_smooth}mean'].to_numpy(dtype=float) if smoothed else None,
+            'thresh': int(df['reopen_thresh'].iloc[0]) if smoothed else None,
+            'label': state,
+            'smooth_label': f"{state}: {num_days_smooth}-Day Smooth",
+            'title': f'{title} By Day of Year - {state}',
+            'xlabel': 'Day of Year (2020)', 'ylabel': f'Reported {axis_label}',
+            'xlim': (first - 1, last + 1),
+            'xticks': np.arange(first - first % 5, last + 1, 5)}
+
+
+def seir_curve_spec(t, S, E, I, R, R_0, name, title = 'extended SEIR-Model'):
+    '''
+    Builds the chart spec of plot_generic for one model run (e.g. from Model).
+    
+    INPUT:
+        - t, S, E, I, R, R_0: as returned by Model
+        - name: file name stem
+        - title: figure title
+    OUTPUT: 
+        - spec: dict for SeirChart.update plus 'kind' and 'name'
+    '''
+    return {'kind': 'seir', 'name': name, 'label': name, 'title': title,
+            'x': np.asarray(t, dtype=float), 'S': np.asarray(S, dtype=float), 'E': np.asarray(E, dtype=float),
+            'I': np.asarray(I, dtype=float), 'R': np.asarray(R, dtype=float), 'R_0': np.asarray(R_0, dtype=float)}
+
+
+# One template per chart kind and worker process, created on first use
+_charts = {}
+
+
+def _render(spec, out_dir, dpi, fmt):
+    kind = spec.get('kind', 'region')
+    if kind not in _charts:
+        _charts[kind] = CHART_KINDS[kind]()
+    chart = _charts[kind]
+    with instrument.stage('render', spec['label']):
+        chart.update(spec)
+        path = os.path.join(out_dir, f"{spec['name']}.{fmt}")
+        with instrument.stage('savefig'):
+            chart.save(path, dpi)
+    instrument.count('figures_rendered', region=spec['label'])
+    return path
+
+
+def render_specs(specs, out_dir = None, dpi = 100, fmt = 'png', max_workers = None):
+    '''
+    Renders chart specs to files, spread over a process pool.
+    
+    INPUT:
+        - specs: list of dicts from region_infection_spec, infection_trend_spec or 
+            seir_curve_spec (or built the same way)
+        - out_dir: output directory (default: IMAGES_DIR, see data_loader.py)
+        - dpi: resolution; rendering time grows with dpi**2 for raster formats 
+            (the interactive functions save at 250)
+        - fmt: 'png', or a vector format ('svg', 'pdf') whose cost does not depend on dpi
+        - max_workers: worker processes (default: os.cpu_count()); 1 renders in this process
+    OUTPUT: 
+        - paths: written files, in the order of specs
+    '''
+    out_dir = data_loader.IMAGES_DIR if out_dir is None else out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    if max_workers == 1:
+        return [_render(spec, out_dir, dpi, fmt) for spec in specs]
+    n_workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(specs) // (4 * n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(_render, specs, [out_dir] * len(specs), [dpi] * len(specs), 
+                             [fmt] * len(specs), chunksize=chunksize))
+
+
+def render_region_infections(regions, out_dir = None, dpi = 100, fmt = 'png', num_days_smooth = 7, 
+                             max_workers = None):
+    '''
+    Renders the plot_region_infections chart for every region, headless and in parallel.
+    
+    INPUT:
+        - regions: list of ('State', 'County') tuples
+        - out_dir, dpi, fmt, max_workers: as for render_specs
+        - num_days_smooth: days of the centered rolling mean plotted
+    OUTPUT: 
+        - paths: written files; regions without data are skipped
+    '''
+    from infection_model import get_state_or_county_data
+    specs = []
+    for region in regions:
+        try:
+            df, region_pop, date_range = get_state_or_county_data(region, num_days_smooth)
+        except KeyError:
+            continue
+        specs.append(region_infection_spec(df, region_pop, date_range, region, num_days_smooth))
+    return render_specs(specs, out_dir, dpi, fmt, max_workers)
+
+
+def render_infection_trends(state_list, metric = 'infection', df_usa = None, smoothed = True, out_dir = None, 
+                            dpi = 100, fmt = 'png', max_workers = None):
+    '''
+    Renders the plot_infection_trends (or, not smoothed, plot_state_daily_data) panel of 
+        every state as its own chart, headless and in parallel.
+    
+    INPUT:
+        - state_list: state abbreviations
+        - metric: 'infection', 'hospitalized' or 'death'
+        - df_usa: merged frame with state features (default: infection_rates.load_state_data())
+        - smoothed: as for infection_trend_spec
+        - out_dir, dpi, fmt, max_workers: as for render_specs
+    OUTPUT: 
+        - paths: written files, in the order of state_list
+    '''
+    if df_usa is None:
+        from infection_rates import load_state_data
+        df_usa = load_state_data()
+    specs = [infection_trend_spec(df_usa, state, metric, smoothed) for state in state_list]
+    return render_specs(specs, out_dir, dpi, fmt, max_workers)
+
+
+if __name__ == "__main__":
+    regions = data_loader.all_states()
+    for path in render_region_infections(regions):
+        print(path)
@@ -0,0 +1,200 @@
+'''
+Memory-mapped store of dense per-region time series.
+
+A store is a directory holding one fixed-dtype array for every region, metric and date,
+written once by an export step and then memory-mapped read-only by any number of
+processes.  Worker processes open the store themselves instead of receiving pickled
+frames, so the operating system shares one copy of the pages between all of them, and
+slicing a region returns views rather than copies.
+
+Each export writes a complete new version directory and then switches the 'current' 
+pointer file to it with one atomic rename, so a reader always sees the values, dates and
+index of a single export.  The previous version is kept for readers that are still 
+opening it; older ones are removed.
+
+    current      name of the version directory in use
+    <version>/
+      values.npy   float64 array (n_regions, n_metrics, n_dates), NaN where there is no data;
+                   cumulative counts need the 53-bit mantissa (float32 is exact only below 2**24)
+      dates.npy    datetime64[D] array (n_dates,), the shared date axis
+      index.json   metric names, key columns, and per region its key, row offset in
+                   values.npy, first/last date offset with data, the offsets of the days 
+                   inside that span that had no row, and population
+'''
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def write_series_store(path, df, key_cols, date_col, metrics, populations = None, dtype = 'float64'):
+    '''
+    Writes a long frame (one row per region per date) as a memory-mappable series store.
+
+    INPUT:
+        - path: directory of the store (created if needed; a new version replaces the current one)
+        - df: frame with the key, date and metric columns
+        - key_cols: column(s) identifying a region, e.g. ('state',) or ('state', 'county')
+        - date_col: date column
+        - metrics: {store metric name: df column}, e.g. {'cases': 'cases'}
+        - populations: (Optional) {region key tuple: population}
+        - dtype: dtype of the values array
+    OUTPUT:
+        - path: the store directory
+    '''
+    key_cols = [key_cols] if isinstance(key_cols, str) else list(key_cols)
+    os.makedirs(path, exist_ok=True)
+    version_path = tempfile.mkdtemp(prefix='v', dir=path)
+    dates = pd.to_datetime(df[date_col]).to_numpy().astype('datetime64[D]')
+    first, last = dates.min(), dates.max()
+    date_axis = np.arange(first, last + 1)
+
+    codes, uniques = pd.MultiIndex.from_frame(df[key_cols].astype(str)).factorize()
+    keys = list(uniques)
+    day = (dates - first).astype(np.int64)
+
+    values = np.lib.format.open_memmap(os.path.join(version_path, 'values.npy'), mode='w+', dtype=dtype,
+                                       shape=(len(keys), len(metrics), len(date_axis)))
+    values[:] = np.nan
+    for j, col in enumerate(metrics.values()):
+        values[codes, j, day] = df[col].to_numpy(dtype=float)
+    values.flush()
+    del values
+
+    # First and last day with data, per region (the span a region's frame covers)
+    starts = np.full(len(keys), len(date_axis), dtype=np.int64)
+    stops = np.zeros(len(keys), dtype=np.int64)
+    np.minimum.at(starts, codes, day)
+    np.maximum.at(stops, codes, day + 1)
+    # Days inside a region's span without a row; readers leave them out, like the frame path
+    present = np.zeros((len(keys), len(date_axis)), dtype=bool)
+    present[codes, day] = True
+    n_rows = present.sum(axis=1)
+    populations = {} if populations is None else populations
+    regions = [{'key': list(key), 'offset': i, 'start': int(starts[i]), 'stop': int(stops[i]),
+                'gaps': (np.flatnonzero(~present[i, starts[i]:stops[i]]).tolist() 
+                         if n_rows[i] < stops[i] - starts[i] else []),
+                'population': None if pd.isna(populations.get(tuple(key), np.nan)) else float(populations[tuple(key)])}
+               for i, key in enumerate(keys)]
+
+    np.save(os.path.join(version_path, 'dates.npy'), date_axis)
+    with open(os.path.join(version_path, 'index.json'), 'w') as f:
+        json.dump({'key_cols': key_cols, 'metrics': list(metrics), 'regions': regions}, f)
+    
+    previous = _current_version(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='current.', dir=path)
+    with os.fdopen(fd, 'w') as f:
+        f.write(os.path.basename(version_path))
+    os.replace(tmp_path, os.path.join(path, 'current'))
+    keep = {os.path.basename(version_path), previous}
+    for name in os.listdir(path):
+        if name.startswith('v') and name not in keep and os.path.isdir(os.path.join(path, name)):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    return path
+
+
+def _current_version(path):
+    '''
+    Returns the name of a store's current version directory (None if it was never written).
+    '''
+    try:
+        with open(os.path.join(path, 'current')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+class SeriesStore:
+    '''
+    Read-only view of one version of a series store directory written by write_series_store
+        (by default the current one).
+    '''
+    def __init__(self, path, version = None):
+        self.path = path
+        self.version = _current_version(path) if version is None else version
+        if self.version is None:
+            raise FileNotFoundError(f'No series store in {path}')
+        version_path = os.path.join(path, self.version)
+        with open(os.path.join(version_path, 'index.json')) as f:
+            index = json.load(f)
+        self.key_cols = index['key_cols']
+        self.metrics = index['metrics']
+        self.regions = {tuple(region['key']): region for region in index['regions']}
+        self.dates = np.load(os.path.join(version_path, 'dates.npy'))
+        self.values = np.load(os.path.join(version_path, 'values.npy'), mmap_mode='r')
+
+    @staticmethod
+    def _as_key(key):
+        return key if isinstance(key, tuple) else (key,)
+
+    def __contains__(self, key):
+        return self._as_key(key) in self.regions
+
+    def __len__(self):
+        return len(self.regions)
+
+    def keys(self):
+        return list(self.regions)
+
+    def _region(self, key):
+        try:
+            return self.regions[self._as_key(key)]
+        except KeyError:
+            raise KeyError(f'No series for region {key}') from None
+
+    @staticmethod
+    def _days(region):
+        # A slice over the region's span, or the day offsets of its rows when days are missing
+        if not region['gaps']:
+            return slice(region['start'], region['stop'])
+        return np.delete(np.arange(region['start'], region['stop']), region['gaps'])
+
+    def block(self, key):
+        '''
+        Returns a region's (n_metrics, n_rows) values on the days it has rows (a view, or a 
+            copy for a region with missing days).
+        '''
+        region = self._region(key)
+        return self.values[region['offset']][:, self._days(region)]
+
+    def series(self, key, metric):
+        '''
+        Returns one metric of a region on the days it has rows (see block).
+        '''
+        return self.block(key)[self.metrics.index(metric)]
+
+    def region_dates(self, key):
+        return self.dates[self._days(self._region(key))]
+
+    def population(self, key):
+        return self._region(key)['population']
+
+    def frame(self, key, extra_columns = None):
+        '''
+        Returns a region's frame with 'date' and one column per metric; the metric columns
+            share memory with the mapped file.  extra_columns ({name: array}) are appended.
+        '''
+        columns = {'date': self.region_dates(key).astype('datetime64[ns]')}
+        columns.update(zip(self.metrics, self.block(key)))
+        columns.update(extra_columns or {})
+        return pd.DataFrame(columns, copy=False)
+
+
+# Stores already mapped by this process: path -> SeriesStore of its current version
+_opened = {}
+
+
+def open_series_store(path):
+    '''
+    Returns the SeriesStore for a directory, mapping it once per process (and again only
+        after a new version has been written).
+    '''
+    path = os.path.abspath(path)
+    version = _current_version(path)
+    cached = _opened.get(path)
+    if cached is None or cached.version != version:
+        cached = _opened[path] = SeriesStore(path, version)
+    return cached
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backtest import Backtester, centered_mean, _origin_worker
+from fit_regions import DEFAULT_PARAMS_INIT_MIN_MAX
+from infection_model import Model, gamma
+
+REGION = ('Test', None)
+
+
+def _daily_series(n_days, N=1e6):
+    # New infections per day of a fitted-model-like curve
+    I = Model(n_days, N, 3.0, 0.4, 30., 0.8)[3]
+    return np.round(I * gamma)
+
+
+class SyntheticBacktester(Backtester):
+    '''
+    Backtester over fixed in-memory series instead of downloaded region data.
+    '''
+    def __init__(self, cache_dir, series, **kwargs):
+        super().__init__(cache_dir, **kwargs)
+        self.series = series
+
+    def region_inputs(self, region):
+        daily = self.series[region]
+        dates = pd.date_range('2020-03-01', periods=len(daily))
+        return dates, daily, 1e6, np.arange(self.min_train_days, len(daily) + 1, self.step)
+
+
+@pytest.mark.parametrize('num_days', [4, 7])
+def test_centered_mean_drops_incomplete_trailing_windows(num_days):
+    daily = np.random.default_rng(0).integers(0, 100, 30).astype(float)
+    expected = pd.Series(daily).rolling(num_days, center=True).mean().to_numpy()
+    rolled = centered_mean(daily, num_days)
+
+    assert len(rolled) == len(daily) - (num_days - num_days // 2 - 1)
+    np.testing.assert_array_equal(rolled, expected[:len(rolled)])
+    assert not np.isnan(rolled[-1])
+
+
+def test_score_aligns_forecast_horizons_with_observed_days(tmp_path):
+    # With daily[d] = d the centered mean observed on day d is d, and the trajectory value
+    # on day d is d too, so every observed horizon must score zero error
+    backtester = Backtester(str(tmp_path), num_days_smooth=7, max_horizon=5)
+    n_days = 35
+    dates = pd.date_range('2020-03-01', periods=n_days)
+    daily = np.arange(n_days, dtype=float)
+    cutoffs = np.array([10, 20, 30])
+    cached = {REGION: {dates[cutoff - 1].strftime('%Y-%m-%d'): 
+                       {'trajectory': np.arange(cutoff + 5, dtype=np.float32)} for cutoff in cutoffs}}
+
+    df_errors, df_crossing = backtester.score({REGION: (dates, daily, 1e6, cutoffs)}, cached)
+
+    assert len(df_errors) == len(cutoffs) * 5 and len(df_crossing) == len(cutoffs)
+    np.testing.assert_array_equal(df_errors['horizon'], np.tile(np.arange(1, 6), len(cutoffs)))
+    np.testing.assert_array_equal(df_errors['cutoff'].unique(), dates[cutoffs - 1])
+    np.testing.assert_array_equal(df_errors['forecast'], np.concatenate([cutoff + np.arange(5) for cutoff in cutoffs]))
+    # Days 32-34 have no complete centered window yet, so the last origin is only partly scored
+    scored = df_errors.dropna(subset=['actual'])
+    assert len(scored) == 2 * 5 + 2
+    np.testing.assert_array_equal(scored['abs_error'], 0.)
+    np.testing.assert_array_equal(Backtester.metrics(df_errors)['n'], [3, 3, 2, 2, 2])
+
+
+def test_origin_worker_only_uses_data_before_cutoff():
+    daily = _daily_series(60)
+    revised = daily.copy()
+    revised[40:] *= 3
+    args = (1e6, [30, 40], None, 7, 14, DEFAULT_PARAMS_INIT_MIN_MAX, 'sensitivity')
+
+    results = _origin_worker(REGION, daily, *args)
+    results_revised = _origin_worker(REGION, revised, *args)
+
+    assert [result['cutoff'] for result in results] == [30, 40]
+    for result, result_revised in zip(results, results_revised):
+        assert result['error'] == ''
+        assert len(result['trajectory']) == result['cutoff'] + 14
+        assert result['best_values'] == result_revised['best_values']
+        np.testing.assert_array_equal(result['trajectory'], result_revised['trajectory'])
+
+
+def test_run_reuses_cached_origins_and_fits_new_ones(tmp_path):
+    daily = _daily_series(50)
+    kwargs = dict(min_train_days=30, step=10, max_horizon=7)
+    backtester = SyntheticBacktester(str(tmp_path), {REGION: daily[:45]}, **kwargs)
+
+    df_errors, df_metrics, df_crossing, df_runs = backtester.run([REGION], max_workers=1)
+    assert df_runs[['n_fitted', 'n_cached', 'n_failed']].values.tolist() == [[2, 0, 0]]
+    assert len(df_errors) == 2 * 7
+    np.testing.assert_array_equal(df_metrics['horizon'], np.arange(1, 8))
+
+    # Appending days adds the origin at day 50 only; the earlier ones come from the cache
+    backtester = SyntheticBacktester(str(tmp_path), {REGION: daily}, **kwargs)
+    df_errors_new, _, _, df_runs = backtester.run([REGION], max_workers=1)
+    assert df_runs[['n_fitted', 'n_cached', 'n_failed']].values.tolist() == [[1, 2, 0]]
+    first = df_errors_new[df_errors_new['cutoff'].isin(df_errors['cutoff'])].reset_index(drop=True)
+    np.testing.assert_array_equal(first['forecast'], df_errors['forecast'])
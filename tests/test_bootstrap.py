@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from bootstrap import P2Quantile, StreamingQuantiles
+
+
+def test_p2_reproduces_published_example():
+    # Worked example of Jain & Chlamtac (1985), Table I: median of 20 observations
+    observations = [0.02, 0.15, 0.74, 3.39, 0.83, 22.37, 10.15, 15.43, 38.62, 15.92,
+                    34.60, 10.28, 1.47, 0.40, 0.05, 11.39, 0.27, 0.42, 0.09, 11.37]
+    estimator = P2Quantile(0.5, 1)
+    for x in observations:
+        estimator.update([x])
+
+    np.testing.assert_allclose(estimator.q.ravel(), [0.02, 0.49, 4.44, 17.20, 38.62], atol=0.005)
+    np.testing.assert_array_equal(estimator.n.ravel(), [1, 6, 10, 16, 20])
+    assert estimator.value()[0] == pytest.approx(4.44, abs=0.005)
+
+
+@pytest.mark.parametrize('p', [0.025, 0.1, 0.5, 0.9, 0.975])
+def test_p2_tracks_sample_quantiles_elementwise(p):
+    rng = np.random.default_rng(0)
+    n = 2000
+    samples = np.column_stack([rng.normal(size=n), rng.exponential(size=n), rng.uniform(size=n), 
+                               100 * rng.lognormal(size=n)])
+    estimator = P2Quantile(p, samples.shape[1])
+    for x in samples:
+        estimator.update(x)
+
+    expected = np.quantile(samples, p, axis=0)
+    iqr = np.subtract(*np.quantile(samples, [0.75, 0.25], axis=0))
+    tolerance = 0.02 if p == 0.5 else 0.15
+    assert np.all(np.abs(estimator.value() - expected) <= tolerance * iqr)
+
+
+def test_p2_before_five_observations_is_exact():
+    estimator = P2Quantile(0.5, 2)
+    assert np.isnan(estimator.value()).all()
+    for x in ([3., 30.], [1., 10.], [2., 20.]):
+        estimator.update(x)
+    np.testing.assert_array_equal(estimator.value(), [2., 20.])
+
+
+def test_streaming_quantiles_keep_shape():
+    quantiles = StreamingQuantiles([0.05, 0.5, 0.95], (3, 4))
+    rng = np.random.default_rng(1)
+    samples = rng.normal(size=(500, 3, 4)) + np.arange(12).reshape(3, 4)
+    for x in samples:
+        quantiles.update(x)
+
+    values = quantiles.values()
+    assert set(values) == {0.05, 0.5, 0.95}
+    for p, value in values.items():
+        assert value.shape == (3, 4)
+        np.testing.assert_allclose(value, np.quantile(samples, p, axis=0), atol=0.25)
+    assert np.all(values[0.05] < values[0.5]) and np.all(values[0.5] < values[0.95])
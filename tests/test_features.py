@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from features import add_region_features, add_series_features, REOPEN_THRESH
+
+
+@pytest.fixture
+def df_regions():
+    '''
+    Shuffled national-style frame: regions of different lengths (one shorter than the
+        windows, one with a single row), a missing total and a missing county key.
+    '''
+    rng = np.random.default_rng(0)
+    rows = []
+    for (state, county), n_days in {('NY', 'Kings'): 40, ('NY', 'Queens'): 25, ('WA', 'King'): 5,
+                                    ('WA', 'Pierce'): 1, ('WA', None): 18}.items():
+        cases = np.cumsum(rng.integers(0, 50, n_days)).astype(float)
+        rows.append(pd.DataFrame({'state': state, 'county': county, 'date': np.arange(n_days), 
+                                  'cases': cases, 'deaths': np.floor(cases / 20)}))
+    df = pd.concat(rows, ignore_index=True)
+    df.loc[(df['county'] == 'Kings') & (df['date'] == 17), 'cases'] = np.nan
+    return df.sample(frac=1, random_state=1).reset_index(drop=True)
+
+
+def _pandas_features(df, windows):
+    df = df.sort_values(['state', 'county', 'date']).reset_index(drop=True)
+    grouped = df.groupby(['state', 'county'], dropna=False, sort=False)
+    expected = {'daily_cases': grouped['cases'].diff().fillna(0).to_numpy(),
+                'daily_deaths': grouped['deaths'].diff().fillna(0).to_numpy()}
+    daily = pd.Series(expected['daily_cases'])
+    for window in windows:
+        expected[f'daily_cases_roll{window}mean'] = daily.groupby([df['state'], df['county'].fillna('')]).transform(
+            lambda s: s.rolling(window, center=True).mean()).to_numpy()
+    return df, expected
+
+
+@pytest.mark.parametrize('windows', [(7,), (3, 4, 14)])
+def test_grouped_rolling_means_match_pandas(df_regions, windows):
+    df_features = add_region_features(df_regions, ('state', 'county'), 'date', 
+                                      diff_cols={'cases': 'daily_cases', 'deaths': 'daily_deaths'},
+                                      smooth_cols=['daily_cases'], windows=windows)
+    df_sorted, expected = _pandas_features(df_regions, windows)
+
+    pd.testing.assert_frame_equal(df_features[df_regions.columns], df_sorted)
+    for col, values in expected.items():
+        np.testing.assert_allclose(df_features[col].to_numpy(), values, rtol=1e-12, atol=1e-9, err_msg=col)
+
+
+def test_population_columns(df_regions):
+    population = {('NY', 'Kings'): 2.5e6, ('NY', 'Queens'): 2.2e6, ('WA', 'King'): 2.2e6}
+    df_features = add_region_features(df_regions, ('state', 'county'), 'date', diff_cols={'cases': 'daily_cases'},
+                                      smooth_cols=['daily_cases'], population=population)
+
+    pop = df_features['population'].to_numpy()
+    keys = list(zip(df_features['state'], df_features['county']))
+    np.testing.assert_array_equal(pop, [population.get(key, np.nan) for key in keys])
+    np.testing.assert_allclose(df_features['daily_cases_roll7mean_per100k'], 
+                               df_features['daily_cases_roll7mean'] / pop * 100000)
+    np.testing.assert_array_equal(df_features['reopen_thresh'], np.ceil(pop * REOPEN_THRESH))
+
+
+def test_series_features_match_region_features(df_regions):
+    df_features = add_region_features(df_regions, ('state', 'county'), 'date', diff_cols={'cases': 'daily_cases'},
+                                      smooth_cols=['daily_cases'], windows=(7, 14))
+    region = df_features[(df_features['state'] == 'NY') & (df_features['county'] == 'Kings')]
+    cases = region['cases'].to_numpy()
+    cases.setflags(write=False)
+
+    new_cols = add_series_features({'cases': cases}, diff_cols={'cases': 'daily_cases'}, 
+                                   smooth_cols=['daily_cases'], windows=(7, 14))
+
+    for col, values in new_cols.items():
+        np.testing.assert_array_equal(values, region[col].to_numpy(), err_msg=col)
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from infection_model import (Model, Model_ensemble, Model_sensitivity, deriv_seir, deriv_seir_jac, fit_seir,
+                             gamma, delta, PARAM_NAMES)
+from fit_regions import DEFAULT_PARAMS_INIT_MIN_MAX
+
+TRUE_PARAMS = np.array([3.0, 0.4, 30., 0.8])
+
+
+@pytest.mark.parametrize('y', [(999., 1., 0., 0.), (400., 150., 300., 150.)])
+def test_deriv_seir_jac_matches_finite_differences(y):
+    N = 1000.
+    beta = lambda t: 2.5 * gamma
+    y = np.array(y)
+    jac = np.asarray(deriv_seir_jac(y, 3., N, beta, gamma, delta))
+    h = 1e-3
+    for j in range(4):
+        dy = np.zeros(4)
+        dy[j] = h
+        column = (np.asarray(deriv_seir(y + dy, 3., N, beta, gamma, delta)) -
+                  np.asarray(deriv_seir(y - dy, 3., N, beta, gamma, delta))) / (2 * h)
+        np.testing.assert_allclose(jac[:, j], column, rtol=1e-6, atol=1e-9)
+
+
+def test_model_ensemble_matches_model_per_member():
+    # Members with different populations and transitions, integrated together with a 
+    # banded Jacobian, must reproduce the single-member integration
+    N = np.array([1e4, 5e5, 2e6, 3.9e7])
+    R_0_start = np.array([2.0, 3.0, 4.5, 6.0])
+    k = np.array([0.1, 0.5, 2.5, 5.0])
+    x0 = np.array([10., 25., 40., 60.])
+    R_0_end = np.array([0.5, 0.9, 1.2, 0.3])
+    days = 120
+
+    t, y, R_0_t = Model_ensemble(days, N, R_0_start, k, x0, R_0_end)
+
+    assert y.shape == (len(N), days, 4)
+    for m in range(len(N)):
+        t_m, S, E, I, R, R_0_m = Model(days, N[m], R_0_start[m], k[m], x0[m], R_0_end[m])
+        np.testing.assert_array_equal(t, t_m)
+        np.testing.assert_allclose(y[m], np.column_stack((S, E, I, R)), rtol=1e-4, atol=1e-6 * N[m])
+        np.testing.assert_allclose(R_0_t[m], R_0_m)
+    # People only move between compartments
+    np.testing.assert_allclose(y.sum(axis=2), np.broadcast_to(N[:, None], (len(N), days)), rtol=1e-6)
+
+
+def test_model_ensemble_broadcasts_scalars():
+    t, y, R_0_t = Model_ensemble(60, 1e6, [2.5, 3.5], 0.4, 30, 0.8)
+    assert y.shape == (2, 60, 4)
+    np.testing.assert_allclose(y[1], np.column_stack(Model(60, 1e6, 3.5, 0.4, 30, 0.8)[1:5]), 
+                               rtol=1e-4, atol=1.)
+
+
+def test_model_sensitivity_matches_model_and_finite_differences():
+    N, days = 1e6, 60
+    t, y, sens, n_rhs = Model_sensitivity(days, N, *TRUE_PARAMS)
+    I = Model(days, N, *TRUE_PARAMS)[3]
+
+    assert sens.shape == (days, 4, 4) and n_rhs > 0
+    np.testing.assert_allclose(y[:, 2], I, rtol=1e-5, atol=1e-3)
+    for j, name in enumerate(PARAM_NAMES):
+        h = 1e-5 * max(abs(TRUE_PARAMS[j]), 1)
+        dp = np.zeros(4)
+        dp[j] = h
+        dI = (Model(days, N, *(TRUE_PARAMS + dp))[3] - Model(days, N, *(TRUE_PARAMS - dp))[3]) / (2 * h)
+        np.testing.assert_allclose(sens[:, 2, j], dI, rtol=0, atol=1e-4 * np.abs(dI).max(), err_msg=name)
+
+
+@pytest.mark.parametrize('noise', [0., 0.1])
+def test_sensitivity_fit_matches_finite_difference_fit(noise):
+    N = 1e6
+    I = Model(60, N, *TRUE_PARAMS)[3]
+    infect_data = I * (1 + noise * np.random.default_rng(0).standard_normal(len(I)))
+
+    fd = fit_seir(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX, jacobian='finite_difference')
+    exact = fit_seir(infect_data, N, DEFAULT_PARAMS_INIT_MIN_MAX, jacobian='sensitivity')
+
+    assert exact['success'] and exact['njev'] > 0 and exact['n_rhs'] > 0
+    for name in PARAM_NAMES:
+        assert exact['best_values'][name] == pytest.approx(fd['best_values'][name], rel=1e-4, abs=1e-6), name
+    assert exact['chisqr'] == pytest.approx(fd['chisqr'], rel=1e-6, abs=1e-12 * np.sum(infect_data**2))
+    if noise == 0:
+        np.testing.assert_allclose([exact['best_values'][name] for name in PARAM_NAMES], TRUE_PARAMS, rtol=1e-4)
+
+
+def test_fit_seir_rejects_unknown_jacobian():
+    with pytest.raises(ValueError):
+        fit_seir(np.ones(10), 1e6, DEFAULT_PARAMS_INIT_MIN_MAX, jacobian='analytic')
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from series_store import SeriesStore, write_series_store, open_series_store
+
+
+@pytest.fixture
+def df_regions():
+    dates = pd.date_range('2020-03-01', periods=10)
+    df = pd.DataFrame({'state': ['NY'] * 10 + ['WA'] * 6, 
+                       'date': list(dates) + list(dates[2:8]),
+                       'cases': np.arange(16, dtype=float), 'deaths': np.arange(16, dtype=float) / 10})
+    # WA is missing two days in the middle of its span
+    return df.drop(index=[12, 13]).sample(frac=1, random_state=0)
+
+
+def test_series_match_frame_rows_including_gaps(tmp_path, df_regions):
+    write_series_store(str(tmp_path), df_regions, ('state',), 'date', {'cases': 'cases', 'deaths': 'deaths'},
+                       populations={('NY',): 1.9e7, ('WA',): 7.6e6})
+    store = SeriesStore(str(tmp_path))
+
+    assert sorted(store.keys()) == [('NY',), ('WA',)] and store.population('WA') == 7.6e6
+    for state, df_state in df_regions.sort_values('date').groupby('state'):
+        df_store = store.frame(state)
+        np.testing.assert_array_equal(df_store['date'].to_numpy(), df_state['date'].to_numpy())
+        np.testing.assert_array_equal(store.series(state, 'cases'), df_state['cases'].to_numpy())
+        np.testing.assert_array_equal(store.block(state)[1], df_state['deaths'].to_numpy())
+
+
+def test_new_version_replaces_current_and_old_readers_keep_theirs(tmp_path, df_regions):
+    path = str(tmp_path)
+    write_series_store(path, df_regions, ('state',), 'date', {'cases': 'cases'})
+    old = open_series_store(path)
+    old_cases = np.array(old.series('NY', 'cases'))
+
+    write_series_store(path, df_regions.assign(cases=df_regions['cases'] * 2), ('state',), 'date', {'cases': 'cases'})
+    new = open_series_store(path)
+
+    assert new.version != old.version and open_series_store(path) is new
+    np.testing.assert_array_equal(new.series('NY', 'cases'), old_cases * 2)
+    # The previous version stays on disk for readers that still map it
+    np.testing.assert_array_equal(old.series('NY', 'cases'), old_cases)
+
+    write_series_store(path, df_regions, ('state',), 'date', {'cases': 'cases'})
+    versions = [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+    assert sorted(versions) == sorted([new.version, open_series_store(path).version])
+
+
+def test_missing_store_raises(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        SeriesStore(str(tmp_path))